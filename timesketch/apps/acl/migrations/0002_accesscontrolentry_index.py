@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Auto generated by Django migrate
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('acl', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='accesscontrolentry',
+            index_together=set([('content_type', 'object_id', 'user')]),
+        ),
+    ]
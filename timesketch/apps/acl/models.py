@@ -14,10 +14,16 @@
 """Django database model for creating Access Control Lists."""
 
 from django.db import models
+from django.db.models import Q
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from timesketch.apps.acl import permissioncache
 
 
 class AccessControlEntry(models.Model):
@@ -42,21 +48,87 @@ class AccessControlEntry(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = [('content_type', 'object_id', 'user')]
+
     def __unicode__(self):
         return 'ACE for %s on %s %s' % (
             self.user, self.content_type, self.content_object)
 
 
+class AccessControlQuerySet(models.QuerySet):
+    """QuerySet for models with generic relationship with AccessControlEntry.
+    Filters on the permission system in the database, with the same rules as
+    AccessControlMixIn, instead of checking every object in Python.
+    """
+    def _readable_ids(self, users):
+        """Get a subquery for the IDs of objects readable by users.
+
+        Args:
+            users. Q object matching the user field of the ACEs to use
+        Returns:
+            QuerySet of object IDs
+        """
+        content_type = ContentType.objects.get_for_model(self.model)
+        return AccessControlEntry.objects.filter(
+            users, content_type=content_type,
+            permission_read=True).values('object_id')
+
+    def public(self):
+        """Get objects that are readable by everyone.
+
+        Returns:
+            QuerySet with the public objects
+        """
+        return self.filter(id__in=self._readable_ids(Q(user=None)))
+
+    def readable_by(self, user):
+        """Get objects that the user have read access to.
+        Objects are readable if the user owns them, if they are public, or if
+        the user have an AccessControlEntry with the read permission set.
+
+        Args:
+            user. user object (instance of django.contrib.auth.models.User)
+        Returns:
+            QuerySet with the readable objects
+        """
+        return self.filter(Q(user=user) | Q(id__in=self._readable_ids(
+            Q(user=None) | Q(user=user))))
+
+
 class AccessControlMixIn(object):
     """MixIn for classes with generic relationship with AccessControlEntry.
     Common functions to manipulate and use the permission system.
+
+    Decisions are cached with permissioncache, and the cache for an object
+    is cleared when its ACL or the object itself is saved or deleted.
     """
+    def _cached_decision(self, user, permission, check):
+        """Get a permission decision from the cache or by calling check.
+
+        Args:
+            user. user object or None for everyone
+            permission. name of the permission
+            check. function that makes the decision
+        Returns:
+            Boolean value of the decision.
+        """
+        if self.pk is None:
+            return check()
+        content_type = ContentType.objects.get_for_model(self)
+        return permissioncache.get_decision(
+            content_type.id, self.pk, getattr(user, 'id', None), permission,
+            check)
+
     def is_public(self):
         """Determine if the ACL is open to everyone for the specific object.
 
         Returns:
             Boolean value to indicate if the object is readable by everyone.
         """
+        return self._cached_decision(None, 'public', self._is_public)
+
+    def _is_public(self):
         try:
             self.acl.get(user=None, permission_read=True)
             return True
@@ -109,6 +181,10 @@ class AccessControlMixIn(object):
         Returns:
             Boolean value to indicate if the object is readable by user.
         """
+        return self._cached_decision(
+            user, 'read', lambda: self._can_read(user))
+
+    def _can_read(self, user):
         if self.user == user:
             return True
         if self.is_public():
@@ -134,6 +210,10 @@ class AccessControlMixIn(object):
         Returns:
             Boolean value to indicate if the object is writable by user.
         """
+        return self._cached_decision(
+            user, 'write', lambda: self._can_write(user))
+
+    def _can_write(self, user):
         if self.user == user:
             return True
         try:
@@ -153,3 +233,18 @@ class AccessControlMixIn(object):
             if ace.user and not ace.user == self.user:
                 collaborators_set.add(ace)
         return collaborators_set
+
+
+@receiver(post_save, sender=AccessControlEntry)
+@receiver(post_delete, sender=AccessControlEntry)
+def _ace_changed(instance, **unused_kwargs):
+    permissioncache.invalidate(instance.content_type_id, instance.object_id)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def _object_changed(instance, **unused_kwargs):
+    # The owner of an object decides some permissions.
+    if isinstance(instance, AccessControlMixIn) and instance.pk is not None:
+        permissioncache.invalidate(
+            ContentType.objects.get_for_model(instance).id, instance.pk)
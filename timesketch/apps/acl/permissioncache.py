@@ -0,0 +1,156 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache for access control decisions.
+
+Decisions are kept for the rest of the request in the thread handling it,
+and in the Django cache for ACL_CACHE_TTL seconds so that other requests and
+processes can use them. Every decision has a key of its own in the shared
+cache that includes the generation of the object. When the ACL or the object
+itself changes the object gets a new generation, so decisions made before the
+change are never read again, even if they are written after it.
+"""
+
+import collections
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.core.signals import request_started
+
+# Seconds to keep decisions in the shared cache, 0 disables it.
+ACL_CACHE_TTL = getattr(settings, 'ACL_CACHE_TTL', 30)
+
+_local = threading.local()
+_counters = collections.Counter()
+_counters_lock = threading.Lock()
+
+
+def _cache_key(content_type_id, object_id):
+    return 'timesketch:acl:%s:%s' % (content_type_id, object_id)
+
+
+def _generation(key):
+    """Get the current generation of an object, starting a new one if needed.
+
+    A new generation is random so that it never matches one that was
+    evicted from the cache.
+    """
+    generation_key = key + ':generation'
+    generation = cache.get(generation_key)
+    if generation is None:
+        cache.add(generation_key, uuid.uuid4().hex, None)
+        generation = cache.get(generation_key)
+    return generation
+
+
+def _request_cache():
+    """Get the decisions made in the current request."""
+    try:
+        return _local.decisions
+    except AttributeError:
+        _local.decisions = {}
+        return _local.decisions
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def get_decision(content_type_id, object_id, user_id, permission, check):
+    """Get an access control decision, making it if it is not cached.
+
+    Args:
+        content_type_id -- integer, content type ID of the object
+        object_id -- integer, ID of the object
+        user_id -- integer, ID of the user or None for everyone
+        permission -- string, name of the permission
+        check -- function that makes the decision when it is not cached
+
+    Returns:
+        Boolean value of the decision
+    """
+    key = _cache_key(content_type_id, object_id)
+    decision_key = '%s:%s' % (user_id, permission)
+    request_decisions = _request_cache().setdefault(key, {})
+    if decision_key in request_decisions:
+        _count('request_hits')
+        return request_decisions[decision_key]
+    shared_key = None
+    if ACL_CACHE_TTL:
+        # The generation is read before the decision is made, a decision
+        # made while the object changes is stored under the old generation.
+        shared_key = '%s:%s:%s' % (key, _generation(key), decision_key)
+        decision = cache.get(shared_key)
+        if decision is not None:
+            _count('shared_hits')
+            request_decisions[decision_key] = decision
+            return decision
+    _count('misses')
+    decision = bool(check())
+    request_decisions[decision_key] = decision
+    if shared_key:
+        cache.set(shared_key, decision, ACL_CACHE_TTL)
+    return decision
+
+
+def invalidate(content_type_id, object_id):
+    """Remove the cached decisions for an object.
+
+    Args:
+        content_type_id -- integer, content type ID of the object
+        object_id -- integer, ID of the object
+    """
+    key = _cache_key(content_type_id, object_id)
+    _request_cache().pop(key, None)
+    cache.set(key + ':generation', uuid.uuid4().hex, None)
+
+
+def clear_request_cache(**unused_kwargs):
+    """Forget the decisions made in the current request."""
+    _local.decisions = {}
+
+
+def get_stats():
+    """Get the number of cache hits and misses.
+
+    Returns:
+        Dictionary with the number of hits in the request cache
+        (request_hits) and in the shared cache (shared_hits), the number of
+        decisions that had to be made (misses) and the share of hits
+        (hit_rate).
+    """
+    with _counters_lock:
+        stats = {
+            'request_hits': _counters['request_hits'],
+            'shared_hits': _counters['shared_hits'],
+            'misses': _counters['misses'],
+        }
+    total = sum(stats.values())
+    stats['hit_rate'] = (
+        float(stats['request_hits'] + stats['shared_hits']) / total
+        if total else 0.0)
+    return stats
+
+
+def reset_stats():
+    """Set the hit and miss counters to zero."""
+    with _counters_lock:
+        _counters.clear()
+
+
+request_started.connect(clear_request_cache)
+request_finished.connect(clear_request_cache)
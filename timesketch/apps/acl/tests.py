@@ -14,8 +14,10 @@
 """Tests for acl models."""
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
 
+from timesketch.apps.acl import permissioncache
 from timesketch.apps.acl.models import AccessControlEntry
 from timesketch.apps.sketch.models import Sketch
 
@@ -42,3 +44,91 @@ class ModelAccessControlEntryTest(TestCase):
         self.assertEqual(self.sketch2.can_read(self.user), True)
         self.assertIsInstance(self.sketch1.get_collaborators(), set)
         self.assertIsInstance(self.ace, AccessControlEntry)
+
+
+class AccessControlQuerySetTest(TestCase):
+    """Test filtering on permissions with AccessControlQuerySet."""
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.user = User.objects.create(username='user')
+        self.public = Sketch.objects.create(user=self.owner, title='public')
+        self.public.make_public(self.owner)
+        self.shared = Sketch.objects.create(user=self.owner, title='shared')
+        self.shared.acl.create(user=self.user, permission_read=True)
+        self.private = Sketch.objects.create(user=self.owner, title='private')
+        self.private.acl.create(user=self.user, permission_write=True)
+        self.own = Sketch.objects.create(user=self.user, title='own')
+
+    def test_public(self):
+        """Test that only public objects are returned."""
+        self.assertEqual(list(Sketch.objects.public()), [self.public])
+
+    def test_readable_by(self):
+        """Test that readable_by() agrees with can_read()."""
+        for user in (self.owner, self.user):
+            with self.assertNumQueries(1):
+                readable = set(Sketch.objects.readable_by(user))
+            self.assertEqual(readable, set(
+                sketch for sketch in Sketch.objects.all()
+                if sketch.can_read(user)))
+        self.assertEqual(
+            set(Sketch.objects.readable_by(self.user)),
+            set([self.public, self.shared, self.own]))
+
+
+class PermissionCacheTest(TestCase):
+    """Test caching of access control decisions."""
+    def setUp(self):
+        cache.clear()
+        permissioncache.clear_request_cache()
+        permissioncache.reset_stats()
+        self.owner = User.objects.create(username='owner')
+        self.user = User.objects.create(username='user')
+        self.sketch = Sketch.objects.create(user=self.owner, title='sketch')
+
+    def test_decisions_are_cached(self):
+        """Test that decisions are reused in and across requests."""
+        self.assertFalse(self.sketch.can_read(self.user))
+        with self.assertNumQueries(0):
+            self.assertFalse(self.sketch.can_read(self.user))
+        permissioncache.clear_request_cache()
+        sketch = Sketch.objects.get(id=self.sketch.id)
+        with self.assertNumQueries(0):
+            self.assertFalse(sketch.can_read(self.user))
+        stats = permissioncache.get_stats()
+        self.assertEqual(stats['request_hits'], 1)
+        self.assertEqual(stats['shared_hits'], 1)
+        # can_read() and the is_public() it calls.
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_invalidate_during_check(self):
+        """Test that a decision made during a change is not kept."""
+        def check():
+            # The ACL changes while the decision is being made.
+            permissioncache.invalidate(1, 2)
+            return True
+        self.assertTrue(
+            permissioncache.get_decision(1, 2, 3, 'read', check))
+        permissioncache.clear_request_cache()
+        self.assertFalse(
+            permissioncache.get_decision(1, 2, 3, 'read', lambda: False))
+
+    def test_changes_invalidate(self):
+        """Test that changing the ACL clears cached decisions."""
+        self.assertFalse(self.sketch.can_read(self.user))
+        self.assertFalse(self.sketch.can_write(self.user))
+        ace = self.sketch.acl.create(user=self.user, permission_read=True)
+        self.assertTrue(self.sketch.can_read(self.user))
+        self.assertFalse(self.sketch.can_write(self.user))
+        ace.permission_write = True
+        ace.save()
+        self.assertTrue(self.sketch.can_write(self.user))
+        ace.delete()
+        self.assertFalse(self.sketch.can_read(self.user))
+        self.sketch.make_public(self.owner)
+        self.assertTrue(self.sketch.is_public())
+        self.assertTrue(self.sketch.can_read(self.user))
+        self.sketch.user = self.user
+        self.sketch.save()
+        self.assertTrue(self.sketch.can_write(self.user))
@@ -13,17 +13,31 @@
 # limitations under the License.
 """Tests for the resources exposed by Timesketch API version 1."""
 
+import copy
+import gzip
 import json
 import mock
+import StringIO
+import unittest
 
 from django.contrib.auth.models import User
+from django.test.client import RequestFactory
 from tastypie.test import TestApiClient
 from tastypie.test import ResourceTestCase
 
+from timesketch.apps.api.v1_resources import DatastoreObject
+from timesketch.apps.api.v1_resources import SearchResource
+from timesketch.apps.api.v1_resources import msgpack
+from timesketch.apps.api.v1_resources import prune_indexes
+from timesketch.apps.api.v1_resources import to_columns
 from timesketch.lib.datastore import DataStore
 from timesketch.apps.sketch.models import EventComment
+from timesketch.apps.sketch.models import EventLabel
 from timesketch.apps.sketch.models import SavedView
 from timesketch.apps.sketch.models import Sketch
+from timesketch.apps.sketch.models import SketchTimeline
+from timesketch.apps.sketch.models import Timeline
+from timesketch.apps.sketch.searchhistory import search_history
 
 
 class MockDataStore(DataStore):
@@ -56,13 +70,6 @@ class MockDataStore(DataStore):
                         "timestamp_desc": "A timestamp",
                         "timestamp": 1410900180184000,
                         "tag": [],
-                        "timesketch_label": [
-                            {
-                                "sketch": "1",
-                                "name": "__ts_star",
-                                "user": 1
-                            }
-                        ],
                         "message": "Test event",
                         "datetime": "2014-09-16T20:43:00+00:00",
                         },
@@ -83,10 +90,24 @@ class MockDataStore(DataStore):
         "timed_out": "false"
     }
 
-    def __init__(self, _):
-        self.index_list = []
+    def histogram(
+            self, unused_sketch, unused_query, unused_filters,
+            unused_indexes, interval=None):
+        """Mock a histogram for a search.
 
-    def get_single_event(self, unused_event_id):
+        Returns:
+            A dictionary with the histogram.
+        """
+        return {
+            'interval': interval or 'hour',
+            'buckets': [
+                {'time': 1410897600000,
+                 'datetime': '2014-09-16T20:00:00.000Z', 'count': 1}
+            ],
+            'took': 2
+        }
+
+    def get_single_event(self, unused_index, unused_event_id):
         """Mock returning a single event from the datastore.
 
         Returns:
@@ -94,13 +115,51 @@ class MockDataStore(DataStore):
         """
         return self.get_event_dict
 
-    def add_label_to_event(
-            self, unused_event, unused_sketch, unused_user, unused_label,
-            toggle=False):
-        """Mock adding a label to an event."""
-        return
+    def get_events(self, events, source=True):
+        """Mock returning many events from the datastore.
+
+        Returns:
+            A list of events, where events in an index named "missing" are
+            not found.
+        """
+        result = []
+        for index, event in events:
+            if index == 'missing':
+                result.append({'_index': index, '_id': event, 'found': False})
+                continue
+            doc = dict(self.get_event_dict, _index=index, _id=event)
+            doc['_source'] = dict(self.get_event_dict['_source'])
+            if not source:
+                del doc['_source']
+            doc['found'] = True
+            result.append(doc)
+        return result
+
+    def get_time_bounds(self, unused_index):
+        """Mock the time of the first and last event in an index.
+
+        Returns:
+            A tuple with the time of the event in the search result.
+        """
+        return 1410900180000, 1410900180000
+
+    def get_statistics(self, unused_index, fields, size=10):
+        """Mock statistics for an index.
+
+        Returns:
+            A dictionary with statistics for the event in the search result.
+        """
+        return {
+            'count': 1,
+            'min_timestamp': 1410900180000,
+            'max_timestamp': 1410900180000,
+            'top_values': dict((field, []) for field in fields),
+            'fields': ['datetime', 'message', 'timestamp', 'timestamp_desc']
+        }
 
-    def search(self, unused_sketch, unused_query, unused_filters):
+    def search(
+            self, unused_sketch, unused_query, unused_filters,
+            unused_indexes, size=500, cursor=None, fields=None):
         """Mock a search query.
 
         Returns:
@@ -108,15 +167,33 @@ class MockDataStore(DataStore):
         """
         return self.search_result_dict
 
+    def scroll(
+            self, unused_sketch, unused_query, unused_filters,
+            unused_indexes, chunk_size=1000):
+        """Mock iterating over all events in a search.
+
+        Returns:
+            A generator of events.
+        """
+        for event in self.search_result_dict['hits']['hits']:
+            yield event
+
 
 class BaseResourceTest(ResourceTestCase):
     """Base class that creates common objects and handles authentication."""
     def setUp(self):
         super(BaseResourceTest, self).setUp()
+        search_history.clear()
         self.user, self.password = self._create_user()
         self.sketch = self._create_sketch(self.user)
         self.api_client = TestApiClient()
 
+    def tearDown(self):
+        # Searches left pending would be written to the real database when
+        # the test run exits.
+        search_history.clear()
+        super(BaseResourceTest, self).tearDown()
+
     def _create_user(self):
         """Creates a user to be used in the tests.
 
@@ -145,9 +222,7 @@ class BaseResourceTest(ResourceTestCase):
             filter=json.dumps({'foo': 'bar'}), name="Test")
         return sketch
 
-    @mock.patch(
-        'timesketch.lib.datastores.elasticsearch_datastore.ElasticSearchDataStore',
-        MockDataStore)
+    @mock.patch('timesketch.apps.api.v1_resources.DATASTORE', MockDataStore)
     def api_request(self, method='get', data=None, auth=True):
         """Make a HTTP request to the api."""
         resource_url = '/api/v1/%s/' % self.resource_name
@@ -233,10 +308,57 @@ class CommentResourceTest(BaseResourceTest):
             expected_keys=self.expected_get_keys)
         self.assertTrue(response['objects'][0]['created'].endswith("+0000"))
 
+    def test_get_many_events(self):
+        """Comments for many events should be fetched in one request."""
+        EventComment.objects.create(
+            user=self.user, body='other', sketch=self.sketch,
+            datastore_id='other', datastore_index='test')
+        response = self._test_get_resources(
+            request_data={
+                'events': json.dumps([
+                    {'index': 'test', 'id': 'test'},
+                    {'index': 'test', 'id': 'other'}]),
+                'sketch': 1},
+            expected_keys=self.expected_get_keys)
+        self.assertEqual(
+            [comment['body'] for comment in response['objects']],
+            ['test', 'other'])
+
     def test_post_resources(self):
         self._test_post_resources(
             request_data=self.request_post_data,
             expected_keys=self.expected_post_keys)
+        self.assertTrue(EventLabel.objects.filter(
+            datastore_id='test', name=EventLabel.COMMENT).exists())
+
+
+class CommentCountResourceTest(BaseResourceTest):
+    """Test the comment count API resource."""
+
+    resource_name = 'comment_count'
+    request_get_data = {
+        'events': json.dumps([
+            {'index': 'test', 'id': 'test'},
+            {'index': 'test', 'id': 'missing'}]),
+        'sketch': 1
+    }
+    expected_get_keys = frozenset([
+        u'es_index',
+        u'es_id',
+        u'count',
+        u'resource_uri'])
+
+    def test_get_resources(self):
+        response = self._test_get_resources(
+            request_data=self.request_get_data,
+            expected_keys=self.expected_get_keys)
+        self.assertEqual(
+            [event['count'] for event in response['objects']], [1, 0])
+
+    def test_get_invalid_events(self):
+        response = self.api_request(
+            method='get', data={'events': 'invalid', 'sketch': 1})
+        self.assertHttpBadRequest(response)
 
 
 class EventResourceTest(BaseResourceTest):
@@ -280,6 +402,35 @@ class EventResourceTest(BaseResourceTest):
             expected_keys=self.expected_get_keys)
 
 
+class MultiEventResourceTest(BaseResourceTest):
+    """Test the multi event API resource."""
+
+    resource_name = 'multi_event'
+    request_get_data = {
+        'events': json.dumps([
+            {'index': 'test', 'id': 'test1'},
+            {'index': 'missing', 'id': 'test2'},
+            {'index': 'test', 'id': 'test3'}
+        ])
+    }
+    expected_get_keys = EventResourceTest.expected_get_keys | frozenset([
+        u'found'])
+
+    def test_get_resources(self):
+        response = self._test_get_resources(
+            request_data=self.request_get_data,
+            expected_keys=self.expected_get_keys)
+        self.assertEqual(
+            [e['es_id'] for e in response['objects']],
+            ['test1', 'test2', 'test3'])
+        self.assertEqual(
+            [e['found'] for e in response['objects']], [True, False, True])
+
+    def test_get_invalid_events(self):
+        response = self.api_request(data={'events': 'test'})
+        self.assertHttpBadRequest(response)
+
+
 class SearchResourceTest(BaseResourceTest):
     """Test the search API resource."""
 
@@ -306,6 +457,413 @@ class SearchResourceTest(BaseResourceTest):
             request_data=self.request_get_data,
             expected_keys=self.expected_get_keys)
 
+    def test_get_extra_fields(self):
+        """Fields asked for in the request should be in the response."""
+        request_data = dict(self.request_get_data)
+        request_data['fields'] = 'hostname,message'
+        self._test_get_resources(
+            request_data=request_data,
+            expected_keys=self.expected_get_keys | frozenset([u'hostname']))
+
+    def test_search_cache_stats(self):
+        """The search cache counters should be in the meta."""
+        response = self.api_request(data=self.request_get_data)
+        stats = self.deserialize(response)['meta']['search_cache']
+        self.assertEqual(sorted(stats), [u'hits', u'misses', u'size'])
+
+    @mock.patch('timesketch.apps.api.v1_resources.DATASTORE', MockDataStore)
+    def test_search_state_is_per_request(self):
+        """Searches should not share state through the resource."""
+        resource = SearchResource()
+        bundles = []
+        for fields in ['hostname', '']:
+            request = RequestFactory().get(
+                '/api/v1/search/',
+                dict(self.request_get_data, fields=fields))
+            request.user = self.user
+            bundles.append(resource.build_bundle(request=request))
+        for bundle in bundles:
+            resource._search(bundle)
+        self.assertEqual(bundles[0].request.search_extra_fields, ['hostname'])
+        self.assertEqual(bundles[1].request.search_extra_fields, [])
+        self.assertEqual(bundles[0].request.search_result['took'], 24)
+
+    def test_serialize_hits_matches_dehydrate(self):
+        """The fast path should give the same output as tastypie."""
+        resource = SearchResource()
+        hit = copy.deepcopy(
+            MockDataStore.search_result_dict['hits']['hits'][0])
+        hit['_source']['timesketch_label'] = [
+            {'name': EventLabel.STAR, 'user': 2, 'sketch': '1'},
+            {'name': 'mine', 'user': 1, 'sketch': '1'},
+            {'name': 'other', 'user': 2, 'sketch': '1'},
+            {'name': 'mine', 'user': 1, 'sketch': '2'}]
+        del hit['_source']['timestamp_desc']
+        fast = resource.serialize_hits([copy.deepcopy(hit)], 1, '1')[0]
+        hit['_source']['req_user'] = 1
+        hit['_source']['sketch'] = '1'
+        bundle = resource.full_dehydrate(
+            resource.build_bundle(obj=DatastoreObject(initial=hit)),
+            for_list=True)
+        self.assertEqual(
+            sorted(fast.pop('label')), sorted(bundle.data.pop('label')))
+        self.assertEqual(fast, bundle.data)
+
+    def test_get_labels(self):
+        """Labels should be added to the events from the label table."""
+        EventLabel.objects.create(
+            user=self.user, sketch=self.sketch, datastore_index='abc123',
+            datastore_id='def345', name=EventLabel.STAR)
+        response = self._test_get_resources(
+            request_data=self.request_get_data,
+            expected_keys=self.expected_get_keys)
+        self.assertEqual(
+            response['objects'][0]['label'], [EventLabel.STAR])
+
+    def test_get_starred(self):
+        """The starred view should only have the starred events."""
+        for event_id in ['test2', 'test1']:
+            EventLabel.objects.create(
+                user=self.user, sketch=self.sketch, datastore_index='test',
+                datastore_id=event_id, name=EventLabel.STAR)
+        request_data = dict(self.request_get_data)
+        request_data['filter'] = json.dumps({'star': True})
+        request_data['limit'] = 1
+        response = self._test_get_resources(
+            request_data=request_data, expected_keys=self.expected_get_keys)
+        self.assertEqual(response['meta']['es_total_count'], 2)
+        self.assertEqual(response['objects'][0]['es_id'], 'test1')
+        self.assertEqual(response['objects'][0]['label'], [EventLabel.STAR])
+        request_data['next'] = response['meta']['next']
+        response = self._test_get_resources(
+            request_data=request_data, expected_keys=self.expected_get_keys)
+        self.assertEqual(response['objects'][0]['es_id'], 'test2')
+        self.assertIsNone(response['meta']['next'])
+
+    def test_get_saves_history(self):
+        """Searches should be saved in batches and not on every request."""
+        views = SavedView.objects.count()
+        self._test_get_resources(
+            request_data=self.request_get_data,
+            expected_keys=self.expected_get_keys)
+        self._test_get_resources(
+            request_data=self.request_get_data,
+            expected_keys=self.expected_get_keys)
+        self.assertEqual(SavedView.objects.count(), views)
+        self.assertEqual(search_history.flush(), 1)
+        self.assertEqual(SavedView.objects.count(), views + 1)
+
+    def test_get_next_page(self):
+        """Fetching a page with a cursor should not save a new view."""
+        request_data = dict(self.request_get_data)
+        request_data['next'] = 'abc123'
+        views = SavedView.objects.count()
+        response = self._test_get_resources(
+            request_data=request_data, expected_keys=self.expected_get_keys)
+        self.assertIn('next', response['meta'])
+        self.assertEqual(SavedView.objects.count(), views)
+
+    def _search_pages(self, request_data, count):
+        """Search with a mock datastore that has count events.
+
+        Returns:
+            Tuple of the response and the size asked from the datastore
+        """
+        hit = MockDataStore.search_result_dict['hits']['hits'][0]
+        sizes = []
+
+        def search(unused_sketch, unused_query, unused_filters,
+                   unused_indexes, size=500, **unused_kwargs):
+            sizes.append(size)
+            hits = []
+            for i in range(min(size, count)):
+                event = copy.deepcopy(hit)
+                event['_id'] = 'event%d' % i
+                hits.append(event)
+            return {
+                'took': 1, 'hits': {'hits': hits, 'total': count},
+                'next_cursor': hits[-1]['_id'] if count > size else None}
+
+        with mock.patch.object(MockDataStore, 'search', side_effect=search):
+            response = self.deserialize(
+                self.api_request(data=request_data))
+        return response, sizes[0]
+
+    def test_get_pages_without_limit(self):
+        """The cursor should point after the last event in the response."""
+        response, size = self._search_pages(self.request_get_data, 600)
+        self.assertEqual(size, 500)
+        self.assertEqual(len(response['objects']), 500)
+        self.assertEqual(response['objects'][-1]['es_id'], 'event499')
+        self.assertEqual(response['meta']['next'], 'event499')
+
+        request_data = dict(self.request_get_data, limit=5, offset=10)
+        response, size = self._search_pages(request_data, 600)
+        self.assertEqual(size, 15)
+        self.assertEqual(
+            [event['es_id'] for event in response['objects']],
+            ['event%d' % i for i in range(10, 15)])
+        self.assertEqual(response['meta']['next'], 'event14')
+
+    def _add_timeline(self, index):
+        """Add a timeline with the time bounds of the mock datastore."""
+        timeline = Timeline.objects.create(
+            user=self.user, title=index, datastore_index=index)
+        timeline.update_time_bounds(MockDataStore())
+        SketchTimeline.objects.create(
+            user=self.user, sketch=self.sketch, timeline=timeline)
+
+    def test_prune_indexes(self):
+        """Indexes with known bounds outside the time range are removed."""
+        self._add_timeline('test')
+        self._add_timeline('other')
+        Timeline.objects.filter(datastore_index='other').update(
+            min_timestamp=None, max_timestamp=None)
+        query_filter = {'time_start': '2014-09-17T00:00:00',
+                        'time_end': '2014-09-18T00:00:00'}
+        self.assertEqual(
+            prune_indexes(self.sketch.id, ['test', 'other', 'unknown'],
+                          query_filter),
+            (['other', 'unknown'], 1))
+        query_filter['time_start'] = '2014-09-16T00:00:00'
+        self.assertEqual(
+            prune_indexes(self.sketch.id, ['test'], query_filter),
+            (['test'], 0))
+        self.assertEqual(
+            prune_indexes(self.sketch.id, None, query_filter), (None, 0))
+        self.assertEqual(
+            prune_indexes(self.sketch.id, ['test'], {}), (['test'], 0))
+        query_filter['time_start'] = 'invalid'
+        self.assertRaises(
+            ValueError, prune_indexes, self.sketch.id, ['test'], query_filter)
+
+    def test_get_pruned(self):
+        """A search outside the bounds of every index should not search."""
+        self._add_timeline('test')
+        request_data = dict(self.request_get_data)
+        request_data['filter'] = json.dumps({
+            'time_start': '2014-09-17T00:00:00',
+            'time_end': '2014-09-18T00:00:00', 'indexes': ['test']})
+        with mock.patch.object(MockDataStore, 'search') as search:
+            response = self.api_request(data=request_data)
+        self.assertHttpOK(response)
+        self.assertFalse(search.called)
+        response_dict = self.deserialize(response)
+        self.assertEqual(response_dict['objects'], [])
+        self.assertEqual(response_dict['meta']['es_pruned_indexes'], 1)
+        self.assertEqual(response_dict['meta']['es_total_count'], 0)
+
+        request_data['filter'] = json.dumps({
+            'time_start': '2014-09-16T00:00:00',
+            'time_end': '2014-09-17T00:00:00', 'indexes': ['test']})
+        response_dict = self._test_get_resources(
+            request_data=request_data, expected_keys=self.expected_get_keys)
+        self.assertEqual(response_dict['meta']['es_pruned_indexes'], 0)
+
+    @staticmethod
+    def _columns_to_objects(result):
+        """Turn a columnar response back into a list of events."""
+        objects = [{} for _ in range(result['length'])]
+        for name, column in result['columns'].items():
+            values = result['dictionaries'].get(name)
+            for event, value in zip(objects, column):
+                if values is not None and isinstance(value, list):
+                    value = [values[code] for code in value]
+                elif values is not None and value is not None:
+                    value = values[value]
+                event[name] = value
+        return objects
+
+    def test_to_columns(self):
+        """Dictionary encoded fields should hold positions of the values."""
+        columns, dictionaries = to_columns([
+            {'message': 'a', 'timestamp_desc': 'Written', 'tag': ['x']},
+            {'message': 'b', 'timestamp_desc': None, 'tag': ['y', 'x']},
+            {'message': 'c', 'timestamp_desc': 'Written', 'tag': []}],
+            ['timestamp_desc', 'tag', 'label'])
+        self.assertEqual(columns['message'], ['a', 'b', 'c'])
+        self.assertEqual(columns['timestamp_desc'], [0, None, 0])
+        self.assertEqual(columns['tag'], [[0], [1, 0], []])
+        self.assertEqual(
+            dictionaries, {'timestamp_desc': ['Written'], 'tag': ['x', 'y']})
+
+    def test_get_columnar(self):
+        """The columnar layout should have the same events as JSON."""
+        EventLabel.objects.create(
+            user=self.user, sketch=self.sketch, datastore_index='abc123',
+            datastore_id='def345', name=EventLabel.STAR)
+        expected = self._test_get_resources(
+            request_data=self.request_get_data,
+            expected_keys=self.expected_get_keys)
+        request_data = dict(self.request_get_data)
+        request_data['format'] = 'columnar'
+        response = self.api_request(method='get', data=request_data)
+        self.assertHttpOK(response)
+        self.assertTrue(response['Content-Type'].startswith(
+            'application/vnd.timesketch.columnar+json'))
+        result = json.loads(response.content)
+        self.assertNotIn('objects', result)
+        self.assertEqual(result['meta'], expected['meta'])
+        self.assertEqual(
+            result['dictionaries']['label'], [EventLabel.STAR])
+        self.assertEqual(
+            self._columns_to_objects(result), expected['objects'])
+
+    @unittest.skipUnless(msgpack, 'msgpack is not installed')
+    def test_get_msgpack(self):
+        """MessagePack should have the same data as the columnar layout."""
+        request_data = dict(self.request_get_data)
+        request_data['format'] = 'columnar'
+        expected = json.loads(
+            self.api_request(method='get', data=request_data).content)
+        request_data['format'] = 'msgpack'
+        response = self.api_request(method='get', data=request_data)
+        self.assertHttpOK(response)
+        self.assertTrue(
+            response['Content-Type'].startswith('application/x-msgpack'))
+        self.assertEqual(
+            msgpack.unpackb(response.content, encoding='utf-8'), expected)
+
+    @mock.patch('timesketch.apps.api.v1_resources.DATASTORE', MockDataStore)
+    @mock.patch('timesketch.apps.api.v1_resources.SEARCH_GZIP_MIN_SIZE', 100)
+    def test_get_gzip(self):
+        """Large responses should be gzipped if the client accepts it."""
+        self.api_client.client.login(
+            username=self.user.username, password=self.password)
+        response = self.api_client.get(
+            '/api/v1/search/', format='json', data=self.request_get_data)
+        self.assertHttpOK(response)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        expected = json.loads(response.content)
+        response = self.api_client.get(
+            '/api/v1/search/', format='json', data=self.request_get_data,
+            HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertHttpOK(response)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        content = gzip.GzipFile(
+            fileobj=StringIO.StringIO(response.content)).read()
+        self.assertEqual(json.loads(content), expected)
+
+
+class ExportViewTest(BaseResourceTest):
+    """Test the streaming export view."""
+
+    resource_name = 'export'
+    request_get_data = {
+        'q': 'test',
+        'filter': json.dumps({'indexes': ['test']}),
+        'sketch': 1
+    }
+
+    def setUp(self):
+        super(ExportViewTest, self).setUp()
+        timeline = Timeline.objects.create(
+            user=self.user, title='test', datastore_index='test')
+        SketchTimeline.objects.create(
+            user=self.user, sketch=self.sketch, timeline=timeline)
+
+    def _export(self, export_format):
+        """Export the test search result.
+
+        Returns:
+            The content of the response as a string.
+        """
+        request_data = dict(self.request_get_data)
+        request_data['format'] = export_format
+        response = self.api_request(data=request_data)
+        self.assertHttpOK(response)
+        return ''.join(response.streaming_content)
+
+    def test_export_ndjson(self):
+        lines = self._export('ndjson').splitlines()
+        self.assertEqual(len(lines), 1)
+        event = json.loads(lines[0])
+        self.assertEqual(event['es_id'], 'def345')
+        self.assertNotIn('timesketch_label', event)
+
+    def test_export_csv(self):
+        lines = self._export('csv').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('datetime,timestamp'))
+        self.assertIn('Test event', lines[1])
+
+    def test_export_starred(self):
+        """Only the starred events should be exported."""
+        EventLabel.objects.create(
+            user=self.user, sketch=self.sketch, datastore_index='test',
+            datastore_id='starred', name=EventLabel.STAR)
+        request_data = dict(self.request_get_data, format='ndjson')
+        request_data['filter'] = json.dumps(
+            {'star': True, 'indexes': ['test']})
+        with mock.patch.object(MockDataStore, 'scroll') as scroll:
+            response = self.api_request(data=request_data)
+            lines = ''.join(response.streaming_content).splitlines()
+        self.assertFalse(scroll.called)
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['es_id'], 'starred')
+
+    def test_export_foreign_index(self):
+        """Indexes that are not in the sketch should not be exported."""
+        request_data = dict(self.request_get_data, format='ndjson')
+        request_data['filter'] = json.dumps({'indexes': ['other']})
+        self.assertHttpForbidden(self.api_request(data=request_data))
+        request_data['filter'] = json.dumps({'indexes': ['other', 'test']})
+        with mock.patch.object(
+                MockDataStore, 'scroll', autospec=True,
+                side_effect=MockDataStore.scroll) as scroll:
+            response = self.api_request(data=request_data)
+            ''.join(response.streaming_content)
+        self.assertEqual(scroll.call_args[0][4], ['test'])
+
+    def test_export_all_sketch_indexes(self):
+        """Without indexes in the filter the sketch timelines are used."""
+        request_data = dict(self.request_get_data, format='ndjson')
+        request_data['filter'] = json.dumps({})
+        with mock.patch.object(
+                MockDataStore, 'scroll', autospec=True,
+                side_effect=MockDataStore.scroll) as scroll:
+            response = self.api_request(data=request_data)
+            ''.join(response.streaming_content)
+        self.assertEqual(scroll.call_args[0][4], ['test'])
+
+    def test_export_invalid_format(self):
+        request_data = dict(self.request_get_data)
+        request_data['format'] = 'xml'
+        self.assertHttpBadRequest(self.api_request(data=request_data))
+
+
+class HistogramResourceTest(BaseResourceTest):
+    """Test the histogram API resource."""
+
+    resource_name = 'histogram'
+    request_get_data = {
+        'q': 'test',
+        'filter': json.dumps({'indexes': ['test']}),
+        'sketch': 1
+    }
+    expected_get_keys = frozenset([
+        u'time',
+        u'datetime',
+        u'count'])
+
+    def test_get_resources(self):
+        response = self._test_get_resources(
+            request_data=self.request_get_data,
+            expected_keys=self.expected_get_keys)
+        self.assertEqual(response['meta']['interval'], 'hour')
+
+    def test_get_starred(self):
+        EventLabel.objects.create(
+            user=self.user, sketch=self.sketch, datastore_index='test',
+            datastore_id='test', name=EventLabel.STAR)
+        request_data = dict(self.request_get_data)
+        request_data['filter'] = json.dumps({'star': True})
+        response = self._test_get_resources(
+            request_data=request_data, expected_keys=self.expected_get_keys)
+        self.assertEqual(response['meta']['interval'], 'second')
+        self.assertEqual(response['objects'][0]['count'], 1)
+
 
 class UserProfileResourceTest(BaseResourceTest):
     """Test the user profile API resource."""
@@ -405,3 +963,40 @@ class LabelResourceTest(BaseResourceTest):
         self._test_post_resources(
             request_data=self.request_post_data,
             expected_keys=self.expected_post_keys)
+        self.assertEqual(EventLabel.objects.filter(name='test').count(), 1)
+
+    def test_post_star_toggles(self):
+        request_post_data = dict(self.request_post_data)
+        request_post_data['data'] = dict(
+            self.request_post_data['data'], label=EventLabel.STAR)
+        self._test_post_resources(request_data=request_post_data)
+        self.assertEqual(
+            EventLabel.objects.filter(name=EventLabel.STAR).count(), 1)
+        self._test_post_resources(request_data=request_post_data)
+        self.assertEqual(
+            EventLabel.objects.filter(name=EventLabel.STAR).count(), 0)
+
+    def test_post_batch_resources(self):
+        request_post_data = {
+            'data': {
+                'sketch': 1,
+                'label': 'test',
+                'events': [
+                    {'index': 'test', 'id': 'test1'},
+                    {'index': 'missing', 'id': 'test2'}
+                ]
+            }
+        }
+        with mock.patch.object(
+                MockDataStore, 'get_events', autospec=True,
+                side_effect=MockDataStore.get_events) as get_events:
+            response = self.api_request(
+                method='post', data=request_post_data)
+        self.assertFalse(get_events.call_args[1]['source'])
+        self.assertHttpCreated(response)
+        failed = self.deserialize(response)['failed']
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0]['id'], 'test2')
+        self.assertEqual(
+            list(EventLabel.objects.values_list('datastore_id', flat=True)),
+            ['test1'])
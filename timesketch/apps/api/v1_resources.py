@@ -14,28 +14,257 @@
 """This module implements timesketch API."""
 # ToDo: Refactor and clean up. This is tracked in issue #9
 
+import collections
 import json
+import time
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
 from tastypie import fields
 from tastypie import utils
 from tastypie.authorization import Authorization
 from tastypie.authentication import SessionAuthentication
+from tastypie.exceptions import ApiFieldError
+from tastypie.exceptions import BadRequest
 from tastypie.resources import Resource
 from tastypie.resources import ModelResource
 from tastypie.serializers import Serializer
+from tastypie.utils.mime import build_content_type
 from pyelasticsearch.exceptions import ElasticHttpNotFoundError
 
-from timesketch.lib.datastores import elasticsearch_datastore
 from timesketch.apps.sketch.models import Sketch
 from timesketch.apps.sketch.models import EventComment
+from timesketch.apps.sketch.models import EventLabel
 from timesketch.apps.sketch.models import SavedView
 from timesketch.apps.sketch.models import Timeline
 from timesketch.apps.sketch.models import SketchTimeline
+from timesketch.apps.sketch.searchhistory import search_history
 from timesketch.apps.userprofile.models import UserProfile
+from timesketch.lib.datastore import HISTOGRAM_INTERVALS
+from timesketch.lib.datastore import datetime_to_millis
+from timesketch.lib.datastore import decode_cursor
+from timesketch.lib.datastore import encode_cursor
+from timesketch.lib.datastore import fill_buckets
+from timesketch.lib.datastore import select_interval
+from timesketch.lib.datastores import DATASTORE
+from timesketch.lib.searchcache import search_cache
 
-# Set the type of datastore.
-DATASTORE = elasticsearch_datastore.ElasticSearchDataStore
+# Number of events on a page of search results if no limit is asked for.
+SEARCH_PAGE_SIZE = 500
+
+# Search responses of at least this many bytes are gzipped.
+SEARCH_GZIP_MIN_SIZE = getattr(settings, 'SEARCH_GZIP_MIN_SIZE', 16384)
+
+# Fields that are dictionary encoded in the columnar search response.
+COLUMNAR_DICTIONARY_FIELDS = ['es_index', 'timestamp_desc', 'tag', 'label']
+
+
+def _event_sort_key(event):
+    """Sort key for event documents, the same order as search results."""
+    return [event['_source'].get('timestamp', 0), event['_index'],
+            event['_id']]
+
+
+def get_starred_events(sketch, indexes=None, datastore=None):
+    """Get the starred events in a sketch.
+
+    The starred events are looked up in the label table and fetched from the
+    datastore in one request, so this scales with the number of stars and not
+    with the number of events.
+
+    Args:
+        sketch -- Sketch, the sketch to get starred events for
+        indexes -- list, only get events in these indexes if set
+        datastore -- DataStore, defaults to a new instance of the configured
+                     datastore
+
+    Returns:
+        List of event documents sorted on time
+    """
+    labels = EventLabel.objects.filter(sketch=sketch, name=EventLabel.STAR)
+    if indexes is not None:
+        labels = labels.filter(datastore_index__in=indexes)
+    events = list(
+        labels.values_list('datastore_index', 'datastore_id').distinct())
+    if datastore is None:
+        datastore = DATASTORE()
+    docs = [doc for doc in datastore.get_events(events) if doc.get('found')]
+    docs.sort(key=_event_sort_key)
+    return docs
+
+
+def is_starred_view(query_filter):
+    """Check if a filter asks for the starred events."""
+    return (query_filter.get('star', False) and
+            not query_filter.get('time_start', None))
+
+
+def prune_indexes(sketch_id, indexes, query_filter):
+    """Remove indexes without events in the time range of a filter.
+
+    The time of the first and last event of every timeline is kept in the
+    timeline metadata, so no datastore request is needed. Indexes with
+    unknown bounds are always kept.
+
+    Args:
+        sketch_id -- integer, sketch ID
+        indexes -- list, indexes to search in, or None for all
+        query_filter -- dict, the filter of the search
+
+    Returns:
+        Tuple of the indexes to search and the number of removed indexes
+
+    Raises:
+        ValueError if the time range in the filter is invalid.
+    """
+    if indexes is None or not query_filter.get('time_start', None):
+        return indexes, 0
+    start = datetime_to_millis(query_filter['time_start'])
+    end = datetime_to_millis(query_filter['time_end'])
+    metadata = Sketch.get_timeline_metadata(sketch_id)
+    kept = []
+    for index in indexes:
+        timeline = metadata.get(index, {})
+        min_timestamp = timeline.get('min_timestamp')
+        max_timestamp = timeline.get('max_timestamp')
+        if min_timestamp is not None and max_timestamp is not None and (
+                min_timestamp > end or max_timestamp < start):
+            continue
+        kept.append(index)
+    return kept, len(indexes) - len(kept)
+
+
+def visible_labels(labels, user_id, sketch_id):
+    """Get the names of the labels on an event that a user can see.
+
+    Stars and comments are shown to everyone in the sketch, other labels only
+    to the user that added them.
+
+    Args:
+        labels -- list, labels as dictionaries with name, user and sketch
+        user_id -- integer, ID of the user
+        sketch_id -- string, sketch ID
+
+    Returns:
+        List of label names
+    """
+    label_set = set()
+    try:
+        for label in labels or []:
+            if label["sketch"] != sketch_id:
+                continue
+            if label["name"] in (EventLabel.STAR, EventLabel.COMMENT) or \
+                    label["user"] == user_id:
+                label_set.add(label["name"])
+    except KeyError:
+        return []
+    return list(label_set)
+
+
+def to_columns(objects, dictionary_fields=None):
+    """Turn a list of events into one list of values per field.
+
+    Values of the dictionary fields are replaced with their position in a
+    list of the distinct values of the field. For fields that hold lists,
+    like tags and labels, every item is replaced.
+
+    Args:
+        objects -- list, events as dictionaries
+        dictionary_fields -- list, names of the fields to dictionary encode
+
+    Returns:
+        Tuple of a dictionary with the values of each field and a dictionary
+        with the distinct values of each dictionary encoded field
+    """
+    names = set()
+    for event in objects:
+        names.update(event)
+    columns = dict((name, []) for name in names)
+    dictionaries = {}
+    codes = {}
+    for name in dictionary_fields or []:
+        if name in columns:
+            dictionaries[name] = []
+            codes[name] = {}
+    for name, column in columns.items():
+        field_codes = codes.get(name)
+        if field_codes is None:
+            column.extend(event.get(name) for event in objects)
+            continue
+        values = dictionaries[name]
+        for event in objects:
+            value = event.get(name)
+            if isinstance(value, list):
+                value = [_dictionary_code(item, field_codes, values)
+                         for item in value]
+            elif value is not None:
+                value = _dictionary_code(value, field_codes, values)
+            column.append(value)
+    return columns, dictionaries
+
+
+def _dictionary_code(value, codes, values):
+    """Get the position of a value in the distinct values, adding it if new."""
+    try:
+        return codes[value]
+    except KeyError:
+        code = codes[value] = len(values)
+        values.append(value)
+        return code
+
+
+def compress_response(request, response, min_size):
+    """Gzip the content of a response if it is large enough.
+
+    Args:
+        request -- HttpRequest, the request the response is for
+        response -- HttpResponse, the response to compress
+        min_size -- integer, only compress content of at least this many bytes
+
+    Returns:
+        The response, compressed if the client accepts gzip
+    """
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if len(response.content) < min_size or response.has_header(
+            'Content-Encoding'):
+        return response
+    accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if not re_accepts_gzip.search(accept_encoding):
+        return response
+    compressed = compress_string(response.content)
+    if len(compressed) >= len(response.content):
+        return response
+    response.content = compressed
+    response['Content-Length'] = str(len(compressed))
+    response['Content-Encoding'] = 'gzip'
+    return response
+
+
+def parse_events(request):
+    """Get the events from the events parameter of a request.
+
+    The events are given as a JSON list of objects with index and id.
+
+    Returns:
+        List of (index, event ID) tuples
+
+    Raises:
+        BadRequest if the list is invalid.
+    """
+    try:
+        return [(e['index'], e['id'])
+                for e in json.loads(request.GET['events'])]
+    except (KeyError, TypeError, ValueError):
+        raise BadRequest('Invalid list of events')
 
 
 class DatastoreObject(object):
@@ -50,23 +279,10 @@ class DatastoreObject(object):
             self.__dict__['_data'] = initial["_source"]
             self.__dict__['_data']['es_index'] = initial['_index']
             self.__dict__['_data']['es_id'] = initial['_id']
-            self.__dict__['_data']['label'] = []
-
-            label_set = set()
-            try:
-                for label in initial["_source"]["timesketch_label"]:
-                    if label["name"] == "__ts_star" and \
-                            label["sketch"] == initial["_source"]["sketch"]:
-                        label_set.add(label["name"])
-                    elif label["name"] == "__ts_comment" and \
-                            label["sketch"] == initial["_source"]["sketch"]:
-                        label_set.add(label["name"])
-                    elif label["user"] == initial["_source"]["req_user"] and \
-                            label["sketch"] == initial["_source"]["sketch"]:
-                        label_set.add(label["name"])
-                self.__dict__['_data']['label'] = list(label_set)
-            except KeyError:
-                pass
+            self.__dict__['_data']['label'] = visible_labels(
+                initial["_source"].get("timesketch_label"),
+                initial["_source"].get("req_user"),
+                initial["_source"].get("sketch"))
 
     def __getattr__(self, name):
         return self._data.get(name, None)
@@ -87,6 +303,51 @@ class DateTimeSerializer(Serializer):
         return date.strftime("%Y-%m-%dT%H:%M:%S%z")
 
 
+class SearchSerializer(Serializer):
+    """
+    Serializer for search results.
+
+    Adds a columnar JSON layout, with one list per field instead of one
+    dictionary per event and dictionary encoded values for the fields that
+    repeat a lot. It is also available as MessagePack if msgpack is
+    installed.
+    """
+    formats = Serializer.formats + ['columnar'] + (
+        ['msgpack'] if msgpack else [])
+    content_types = dict(
+        Serializer.content_types,
+        columnar='application/vnd.timesketch.columnar+json',
+        msgpack='application/x-msgpack')
+
+    def columnar(self, data, options=None):
+        """Get the columnar layout of a list of events.
+
+        Args:
+            data -- dictionary with meta and objects, like for a list view
+            options -- dictionary, serializer options
+
+        Returns:
+            Dictionary with meta, length, columns and dictionaries
+        """
+        data = self.to_simple(data, options)
+        objects = data.pop('objects', [])
+        columns, dictionaries = to_columns(
+            objects, COLUMNAR_DICTIONARY_FIELDS)
+        data['length'] = len(objects)
+        data['columns'] = columns
+        data['dictionaries'] = dictionaries
+        return data
+
+    def to_columnar(self, data, options=None):
+        return json.dumps(
+            self.columnar(data, options), cls=DjangoJSONEncoder,
+            ensure_ascii=False)
+
+    def to_msgpack(self, data, options=None):
+        return msgpack.packb(
+            self.columnar(data, options), use_bin_type=False)
+
+
 class UserProfileResource(ModelResource):
     """Model resource for UserProfile."""
     class Meta:
@@ -115,7 +376,20 @@ class UserResource(ModelResource):
 
 
 class SearchResource(Resource):
-    """Resource for handling search requests."""
+    """Resource for handling search requests.
+
+    Only the fields used by this resource are fetched from the datastore.
+    Clients can ask for more with a comma separated list in the fields
+    parameter.
+
+    Lists are not built with a bundle per event, get_list() turns the hits
+    into the response directly. The output is the same as full_dehydrate()
+    gives for the fields below.
+    """
+    # Event fields needed to build the response.
+    SEARCH_FIELDS = [
+        'datetime', 'timestamp', 'timestamp_desc', 'message', 'tag']
+
     es_index = fields.CharField(attribute='es_index')
     es_id = fields.CharField(attribute='es_id')
     datetime = fields.CharField(attribute='datetime')
@@ -126,52 +400,331 @@ class SearchResource(Resource):
     label = fields.ListField(attribute='label', null=True)
 
     def __init__(self):
-        self.query_result = {}
         super(SearchResource, self).__init__()
+        # Everything needed to dehydrate a field, looked up once instead of
+        # for every event.
+        self._extractors = [
+            (name, field.attribute, field.convert, field.has_default(),
+             field)
+            for name, field in self.fields.items()
+            if name != 'resource_uri']
 
     class Meta:
         resource_name = 'search'
         object_class = DatastoreObject
+        limit = SEARCH_PAGE_SIZE
+        serializer = SearchSerializer()
         authorization = Authorization()
         authentication = SessionAuthentication()
 
+    def get_list(self, request, **kwargs):
+        base_bundle = self.build_bundle(request=request)
+        sketch, hits = self._search(base_bundle)
+        collection_name = self._meta.collection_name
+        paginator = self._meta.paginator_class(
+            request.GET, hits, resource_uri=self.get_resource_uri(),
+            limit=self._meta.limit, max_limit=self._meta.max_limit,
+            collection_name=collection_name)
+        to_be_serialized = paginator.page()
+        to_be_serialized[collection_name] = self.serialize_hits(
+            to_be_serialized[collection_name], request.user.id,
+            str(sketch.id), self.dehydrate_resource_uri(base_bundle),
+            request.search_extra_fields)
+        to_be_serialized = self.alter_list_data_to_serialize(
+            request, to_be_serialized)
+        desired_format = self.determine_format(request)
+        if desired_format != 'application/json':
+            response = self.create_response(request, to_be_serialized)
+        else:
+            # Same data as the tastypie serializer gives. It is already made
+            # of simple types so it can be dumped as is, and without sorting
+            # the keys json uses its much faster C encoder.
+            response = HttpResponse(
+                content=json.dumps(
+                    to_be_serialized, cls=DjangoJSONEncoder,
+                    ensure_ascii=False),
+                content_type=build_content_type(desired_format))
+        return compress_response(request, response, SEARCH_GZIP_MIN_SIZE)
+
+    def serialize_hits(self, hits, user_id, sketch_id, resource_uri='',
+                       extra_fields=()):
+        """Turn search hits into dictionaries for the response.
+
+        Args:
+            hits -- list, hits from the datastore search
+            user_id -- integer, ID of the user that searched
+            sketch_id -- string, sketch ID
+            resource_uri -- string, value for the resource_uri field
+            extra_fields -- list, names of other event fields to add
+
+        Returns:
+            List of dictionaries, one per event
+
+        Raises:
+            ApiFieldError if an event lacks a field that is not nullable.
+        """
+        extractors = self._extractors
+        objects = []
+        for hit in hits:
+            source = hit['_source']
+            record = {
+                'es_index': hit['_index'],
+                'es_id': hit['_id'],
+                'label': visible_labels(
+                    source.get('timesketch_label'), user_id, sketch_id)
+            }
+            data = {'resource_uri': resource_uri}
+            for name, attribute, convert, has_default, field in extractors:
+                if attribute in record:
+                    value = record[attribute]
+                else:
+                    value = source.get(attribute)
+                if value is None:
+                    if has_default:
+                        value = field.default
+                    elif not field.null:
+                        raise ApiFieldError(
+                            "The event '%s' has an empty attribute '%s' and "
+                            "doesn't allow a default or null value." %
+                            (hit['_id'], attribute))
+                data[name] = convert(value)
+            for field in extra_fields:
+                data[field] = record.get(field, source.get(field))
+            objects.append(data)
+        return objects
+
     def obj_get_list(self, bundle, **kwargs):
+        sketch, hits = self._search(bundle)
+        result = []
+        for event in hits:
+            event["_source"]["req_user"] = bundle.request.user.id
+            event["_source"]["sketch"] = str(sketch.id)
+            result.append(DatastoreObject(initial=event))
+        return result
+
+    def _search(self, bundle):
+        """Search the datastore for the request in the bundle.
+
+        The resource is shared by all requests, so the search result, the
+        extra fields and the number of pruned indexes are kept on the
+        request as search_result, search_extra_fields and
+        search_pruned_indexes.
+
+        Returns:
+            Tuple of the sketch and the list of hits, with the labels from
+            the sketch in timesketch_label.
+        """
         query = bundle.request.GET['q']
         query_filter = json.loads(bundle.request.GET['filter'])
         indexes_to_search = query_filter.get("indexes")
         sketch = Sketch.objects.get(id=bundle.request.GET['sketch'])
-        datastore = DATASTORE(indexes_to_search)
-        result = []
+        cursor = bundle.request.GET.get('next')
+        # Get the page the same way as the paginator in get_list() does, and
+        # fetch everything up to its end so that the cursor for the next page
+        # points after the last event in the response.
+        paginator = self._meta.paginator_class(
+            bundle.request.GET, [], limit=self._meta.limit,
+            max_limit=self._meta.max_limit)
+        size = paginator.get_offset() + paginator.get_limit()
+        extra_fields = [
+            f for f in bundle.request.GET.get('fields', '').split(',')
+            if f and f not in self.fields]
         try:
-            self.query_result = datastore.search(sketch.id, query, query_filter)
+            indexes_to_search, pruned_indexes = prune_indexes(
+                sketch.id, indexes_to_search, query_filter)
+        except ValueError:
+            raise BadRequest('Invalid time range')
+        datastore = DATASTORE()
+        try:
+            if is_starred_view(query_filter):
+                query_result = self._search_starred(
+                    sketch, indexes_to_search, size, cursor)
+            elif pruned_indexes and not indexes_to_search:
+                # No timeline has events in the time range.
+                query_result = {'took': 0, 'hits': {'hits': [], 'total': 0}}
+            else:
+                query_result = datastore.search(
+                    sketch.id, query, query_filter, indexes_to_search,
+                    size=size, cursor=cursor,
+                    fields=self.SEARCH_FIELDS + extra_fields)
         except ElasticHttpNotFoundError:
-            self.query_result = {'hits': {'hits': []}}
+            query_result = {'hits': {'hits': []}}
+        except ValueError:
+            raise BadRequest('Invalid cursor')
+        bundle.request.search_result = query_result
+        bundle.request.search_extra_fields = extra_fields
+        bundle.request.search_pruned_indexes = pruned_indexes
 
-        for event in self.query_result['hits']['hits']:
-            event["_source"]["req_user"] = bundle.request.user.id
-            event["_source"]["sketch"] = str(sketch.id)
-            result.append(DatastoreObject(initial=event))
-        # Save state to an unnamed view
-        SavedView.objects.create(user=bundle.request.user, sketch=sketch,
-                                 query=query, filter=json.dumps(query_filter),
-                                 name="")
-        return result
+        hits = query_result['hits']['hits']
+        labels = EventLabel.get_for_events(
+            sketch, [(event['_index'], event['_id']) for event in hits])
+        for event in hits:
+            event["_source"]["timesketch_label"] = labels.get(
+                (event['_index'], event['_id']), [])
+        # Save state to the search history, but only once per search and not
+        # for every page that is fetched.
+        if not cursor:
+            search_history.record(
+                bundle.request.user, sketch, query, json.dumps(query_filter))
+        return sketch, hits
+
+    @staticmethod
+    def _search_starred(sketch, indexes, size, cursor):
+        """Get a page of the starred events in a sketch.
+
+        Args:
+            sketch -- Sketch, the sketch to get starred events for
+            indexes -- list, only get events in these indexes if set
+            size -- integer, maximum number of events to return
+            cursor -- string, opaque cursor from a previous result
+
+        Returns:
+            Search result in the same format as the datastore search
+
+        Raises:
+            ValueError if the cursor is invalid.
+        """
+        start_time = time.time()
+        docs = get_starred_events(sketch, indexes)
+        total = len(docs)
+        if cursor:
+            last = decode_cursor(cursor)
+            docs = [doc for doc in docs if _event_sort_key(doc) > last]
+        next_cursor = None
+        if len(docs) > size:
+            docs = docs[:size]
+            next_cursor = encode_cursor(_event_sort_key(docs[-1]))
+        return {
+            'took': int((time.time() - start_time) * 1000),
+            'hits': {'hits': docs, 'total': total},
+            'next_cursor': next_cursor
+        }
+
+    def dehydrate(self, bundle):
+        for field in getattr(bundle.request, 'search_extra_fields', []):
+            bundle.data[field] = getattr(bundle.obj, field)
+        return bundle
 
     def alter_list_data_to_serialize(self, request, data):
         timeline_colors = {}
         timeline_names = {}
-        sketch = Sketch.objects.get(id=request.GET['sketch'])
-        for t in sketch.timelines.all():
-            timeline_colors[t.timeline.datastore_index] = t.color
-            timeline_names[t.timeline.datastore_index] = t.timeline.title
+        metadata = Sketch.get_timeline_metadata(int(request.GET['sketch']))
+        for index, timeline in metadata.items():
+            timeline_colors[index] = timeline['color']
+            timeline_names[index] = timeline['title']
+        query_result = getattr(request, 'search_result', {})
         try:
-            data['meta']['es_time'] = self.query_result['took']
-            data['meta']['es_total_count'] = self.query_result['hits']['total']
+            data['meta']['es_time'] = query_result['took']
+            data['meta']['es_total_count'] = query_result['hits']['total']
+            data['meta']['es_cached'] = query_result.get('cached', False)
+            # Time for each index, only set when indexes are searched on
+            # their own.
+            data['meta']['es_index_took'] = query_result.get(
+                'index_took', {})
         except KeyError:
             data['meta']['es_time'] = 0
             data['meta']['es_total_count'] = 0
+            data['meta']['es_cached'] = False
+            data['meta']['es_index_took'] = {}
+        # Number of indexes that were not searched because their timeline
+        # has no events in the time range.
+        data['meta']['es_pruned_indexes'] = getattr(
+            request, 'search_pruned_indexes', 0)
+        # Hits and misses of the search result cache in this process.
+        data['meta']['search_cache'] = search_cache.stats()
         data['meta']['timeline_colors'] = timeline_colors
         data['meta']['timeline_names'] = timeline_names
+        # Opaque cursor for the next page, pass it back as the "next"
+        # parameter.
+        data['meta']['next'] = query_result.get('next_cursor')
+        return data
+
+
+class HistogramResource(Resource):
+    """Number of events over time for a search."""
+    time = fields.IntegerField(attribute='time')
+    datetime = fields.CharField(attribute='datetime', null=True)
+    count = fields.IntegerField(attribute='count')
+
+    class Meta:
+        resource_name = 'histogram'
+        object_class = DatastoreObject
+        include_resource_uri = False
+        limit = 1000
+        authorization = Authorization()
+        authentication = SessionAuthentication()
+
+    def obj_get_list(self, bundle, **kwargs):
+        query = bundle.request.GET.get('q', '')
+        query_filter = json.loads(bundle.request.GET['filter'])
+        indexes_to_search = query_filter.get("indexes")
+        sketch = Sketch.objects.get(id=bundle.request.GET['sketch'])
+        interval = bundle.request.GET.get('interval')
+        datastore = DATASTORE()
+        try:
+            indexes_to_search, pruned = prune_indexes(
+                sketch.id, indexes_to_search, query_filter)
+            if is_starred_view(query_filter):
+                histogram = self._histogram_starred(
+                    sketch, indexes_to_search, interval)
+            elif pruned and not indexes_to_search:
+                histogram = {'interval': None, 'buckets': [], 'took': 0}
+            else:
+                histogram = datastore.histogram(
+                    sketch.id, query, query_filter, indexes_to_search,
+                    interval=interval)
+        except ElasticHttpNotFoundError:
+            histogram = {'interval': None, 'buckets': [], 'took': 0}
+        except ValueError:
+            raise BadRequest('Invalid time range')
+        # The resource is shared by all requests, so keep the histogram for
+        # alter_list_data_to_serialize() on the request.
+        bundle.request.histogram = histogram
+        result = []
+        for bucket in histogram['buckets']:
+            obj = DatastoreObject()
+            obj.time = bucket['time']
+            obj.datetime = bucket['datetime']
+            obj.count = bucket['count']
+            result.append(obj)
+        return result
+
+    @staticmethod
+    def _histogram_starred(sketch, indexes, interval=None):
+        """Count the starred events in a sketch over time.
+
+        Args:
+            sketch -- Sketch, the sketch to get starred events for
+            indexes -- list, only count events in these indexes if set
+            interval -- string, interval name from HISTOGRAM_INTERVALS
+
+        Returns:
+            Histogram in the same format as the datastore histogram
+
+        Raises:
+            ValueError if the interval is invalid.
+        """
+        start_time = time.time()
+        times = [doc['_source'].get('timestamp', 0) // 1000
+                 for doc in get_starred_events(sketch, indexes)]
+        if not times:
+            return {'interval': None, 'buckets': [], 'took': 0}
+        if not interval:
+            interval = select_interval(min(times), max(times))
+        lengths = dict(HISTOGRAM_INTERVALS)
+        if interval not in lengths:
+            raise ValueError('Invalid interval: %s' % interval)
+        counts = collections.Counter(t // lengths[interval] for t in times)
+        return {
+            'interval': interval,
+            'buckets': fill_buckets(counts, interval),
+            'took': int((time.time() - start_time) * 1000)
+        }
+
+    def alter_list_data_to_serialize(self, request, data):
+        histogram = getattr(request, 'histogram', {})
+        data['meta']['interval'] = histogram.get('interval')
+        data['meta']['es_time'] = histogram.get('took', 0)
         return data
 
 
@@ -213,17 +766,62 @@ class EventResource(Resource):
     def obj_get_list(self, bundle, **kwargs):
         event = bundle.request.GET['id']
         index = bundle.request.GET['index']
-        datastore = DATASTORE([index])
+        datastore = DATASTORE()
         result = []
-        r = datastore.get_single_event(event)
+        r = datastore.get_single_event(index, event)
         r["_source"]["req_user"] = bundle.request.user.id
         new_obj = DatastoreObject(initial=r)
         result.append(new_obj)
         return result
 
 
+class MultiEventResource(EventResource):
+    """Get all details for many events in one request.
+
+    The events are given as a JSON list of objects with index and id in the
+    events parameter, and returned in the same order. Events that don't
+    exist are returned with only es_index and es_id, and found set to False.
+    """
+    found = fields.BooleanField(attribute='found', default=True)
+    timestamp = fields.IntegerField(attribute='timestamp', null=True)
+    timestamp_desc = fields.CharField(attribute='timestamp_desc', null=True)
+    datetime = fields.CharField(attribute='datetime', null=True)
+    source_short = fields.CharField(attribute='source_short', null=True)
+    source_long = fields.CharField(attribute='source_long', null=True)
+    message = fields.CharField(attribute='message', null=True)
+
+    class Meta:
+        resource_name = 'multi_event'
+        object_class = DatastoreObject
+        limit = 0
+        authorization = Authorization()
+        authentication = SessionAuthentication()
+
+    def obj_get_list(self, bundle, **kwargs):
+        events = parse_events(bundle.request)
+        datastore = DATASTORE()
+        result = []
+        for index_and_id, doc in zip(events, datastore.get_events(events)):
+            if not doc.get('found'):
+                new_obj = DatastoreObject()
+                new_obj.es_index, new_obj.es_id = index_and_id
+                new_obj.found = False
+                result.append(new_obj)
+                continue
+            doc["_source"]["req_user"] = bundle.request.user.id
+            new_obj = DatastoreObject(initial=doc)
+            new_obj.found = True
+            result.append(new_obj)
+        return result
+
+
 class CommentResource(ModelResource):
-    """Resource for add comment to event."""
+    """Resource for add comment to event.
+
+    Comments for many events can be fetched in one request by giving a JSON
+    list of objects with index and id in the events parameter, instead of
+    index and id.
+    """
     user = fields.ForeignKey(UserResource, attribute='user', full=True)
     body = fields.CharField(attribute='body', null=True)
     datastore_index = fields.CharField(attribute='datastore_index', null=True)
@@ -239,12 +837,16 @@ class CommentResource(ModelResource):
         serializer = DateTimeSerializer()
 
     def obj_get_list(self, bundle, **kwargs):
-        datastore_index = bundle.request.GET['index']
-        datastore_id = bundle.request.GET['id']
         sketch_id = bundle.request.GET['sketch']
         sketch = Sketch.objects.get(id=sketch_id)
+        if 'events' in bundle.request.GET:
+            return EventComment.get_for_events(
+                sketch, parse_events(bundle.request))
+        datastore_index = bundle.request.GET['index']
+        datastore_id = bundle.request.GET['id']
         result = EventComment.objects.filter(datastore_index=datastore_index,
-            datastore_id=datastore_id, sketch=sketch)
+            datastore_id=datastore_id, sketch=sketch).select_related(
+                'user__userprofile')
         return result
 
     def obj_create(self, bundle, **kwargs):
@@ -263,12 +865,43 @@ class CommentResource(ModelResource):
         bundle.data['data']['user']['last_name'] = result.user.last_name
         bundle.data['data']['user']['profile'] = {}
         bundle.data['data']['user']['profile']['avatar'] = result.user.userprofile.get_avatar_url()
-        datastore = DATASTORE(datastore_index)
-        datastore.add_label_to_event(datastore_id, sketch_id,
-            bundle.request.user.id, "__ts_comment")
+        EventLabel.add_to_events(
+            sketch, bundle.request.user, [(datastore_index, datastore_id)],
+            EventLabel.COMMENT)
         return bundle
 
 
+class CommentCountResource(Resource):
+    """Count the comments on many events in one request.
+
+    The events are given as a JSON list of objects with index and id in the
+    events parameter, and returned in the same order with the number of
+    comments on each.
+    """
+    es_index = fields.CharField(attribute='es_index')
+    es_id = fields.CharField(attribute='es_id')
+    count = fields.IntegerField(attribute='count')
+
+    class Meta:
+        resource_name = 'comment_count'
+        object_class = DatastoreObject
+        limit = 0
+        authorization = Authorization()
+        authentication = SessionAuthentication()
+
+    def obj_get_list(self, bundle, **kwargs):
+        events = parse_events(bundle.request)
+        sketch = Sketch.objects.get(id=bundle.request.GET['sketch'])
+        counts = EventComment.count_for_events(sketch, events)
+        result = []
+        for index_and_id in events:
+            new_obj = DatastoreObject()
+            new_obj.es_index, new_obj.es_id = index_and_id
+            new_obj.count = counts.get(index_and_id, 0)
+            result.append(new_obj)
+        return result
+
+
 class LabelResource(Resource):
     """Add and remove labels."""
     class Meta:
@@ -284,11 +917,28 @@ class LabelResource(Resource):
     def obj_create(self, bundle, request=None, **kwargs):
         toggle = False
         req_data = json.loads(bundle.request.body)['data']
-        if req_data['label'] == "__ts_star":
+        sketch = Sketch.objects.get(id=req_data['sketch'])
+        # Batch variant, label all events in the list in one go. Events that
+        # don't exist in the datastore are not labeled and returned in the
+        # response.
+        if 'events' in req_data:
+            events = [(e['index'], e['id']) for e in req_data['events']]
+            docs = DATASTORE().get_events(events, source=False)
+            found = [(doc['_index'], doc['_id']) for doc in docs
+                     if doc.get('found')]
+            EventLabel.add_to_events(
+                sketch, bundle.request.user, found, req_data['label'],
+                toggle=req_data.get('toggle', False))
+            bundle.data['failed'] = [
+                {'index': doc['_index'], 'id': doc['_id'],
+                 'error': 'Event not found'}
+                for doc in docs if not doc.get('found')]
+            return bundle
+        if req_data['label'] == EventLabel.STAR:
             toggle = True
-        datastore = DATASTORE(req_data['index'])
-        datastore.add_label_to_event(req_data['id'], req_data['sketch'], 
-            bundle.request.user.id, req_data['label'], toggle=toggle)
+        EventLabel.add_to_events(
+            sketch, bundle.request.user, [(req_data['index'], req_data['id'])],
+            req_data['label'], toggle=toggle)
         return bundle
 
 
@@ -373,6 +1023,8 @@ class ViewResource(ModelResource):
             if view.sketch == sketch:
                 result = [view]
         else:
+            # The latest search may still be waiting to be written.
+            search_history.flush()
             result = SavedView.objects.filter(user=bundle.request.user,
                 sketch=sketch,
                 name__exact="").order_by("-created")
@@ -0,0 +1,133 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""API views that do not fit in a Tastypie resource."""
+
+import csv
+import json
+
+from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import HttpResponseForbidden
+from django.http import StreamingHttpResponse
+from pyelasticsearch.exceptions import ElasticHttpNotFoundError
+
+from timesketch.apps.api import v1_resources
+from timesketch.apps.sketch.models import Sketch
+
+
+# Columns in the CSV export, in order.
+EXPORT_CSV_FIELDS = [
+    'datetime', 'timestamp', 'timestamp_desc', 'source_short', 'source_long',
+    'message', 'hostname', 'username', 'filename', 'tag', 'es_index', 'es_id']
+
+
+class _LineBuffer(object):
+    """File like object that hands back what is written to it.
+
+    This lets the csv module format a single row at a time for streaming.
+    """
+    def write(self, value):
+        return value
+
+
+def _export_events(datastore, sketch, query, query_filter):
+    """Get all events for an export.
+
+    Starred events are looked up in the sketch, like for a search.
+
+    Returns:
+        Generator of event dictionaries with es_index and es_id added.
+    """
+    indexes = query_filter.get('indexes')
+    if v1_resources.is_starred_view(query_filter):
+        events = v1_resources.get_starred_events(sketch, indexes, datastore)
+    else:
+        events = datastore.scroll(sketch.id, query, query_filter, indexes)
+    try:
+        for event in events:
+            source = dict(event['_source'])
+            source.pop('timesketch_label', None)
+            source['es_index'] = event['_index']
+            source['es_id'] = event['_id']
+            yield source
+    except ElasticHttpNotFoundError:
+        return
+
+
+def _ndjson_rows(events):
+    """Format events as newline delimited JSON."""
+    for event in events:
+        yield json.dumps(event) + '\n'
+
+
+def _csv_rows(events):
+    """Format events as CSV, starting with a header row."""
+    writer = csv.writer(_LineBuffer())
+    yield writer.writerow(EXPORT_CSV_FIELDS)
+    for event in events:
+        row = []
+        for field in EXPORT_CSV_FIELDS:
+            value = event.get(field, '')
+            if isinstance(value, list):
+                value = ','.join(unicode(v) for v in value)
+            row.append(unicode(value).encode('utf-8'))
+        yield writer.writerow(row)
+
+
+def export(request):
+    """Stream every event that matches a query in the sketch.
+
+    The events are written to the response as they arrive from the datastore
+    so the memory used does not depend on the number of events.
+    """
+    if not request.user.is_authenticated():
+        return HttpResponse(status=401)
+    try:
+        sketch = Sketch.objects.get(id=request.GET['sketch'])
+        query = request.GET.get('q', '')
+        query_filter = json.loads(request.GET.get('filter', '{}'))
+    except (KeyError, ValueError, Sketch.DoesNotExist):
+        return HttpResponseBadRequest()
+    if not sketch.can_read(request.user):
+        return HttpResponseForbidden()
+    # Only the timelines in the sketch can be exported, and all of them if
+    # the filter doesn't name any.
+    sketch_indexes = Sketch.get_timeline_metadata(sketch.id)
+    indexes = query_filter.get('indexes')
+    if indexes is None:
+        indexes = list(sketch_indexes)
+    elif not isinstance(indexes, list):
+        return HttpResponseBadRequest()
+    indexes = [index for index in indexes if index in sketch_indexes]
+    if not indexes:
+        return HttpResponseForbidden()
+    query_filter['indexes'] = indexes
+
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format == 'csv':
+        formatter = _csv_rows
+        content_type = 'text/csv'
+    elif export_format == 'ndjson':
+        formatter = _ndjson_rows
+        content_type = 'application/x-ndjson'
+    else:
+        return HttpResponseBadRequest()
+
+    datastore = v1_resources.DATASTORE()
+    events = _export_events(datastore, sketch, query, query_filter)
+    response = StreamingHttpResponse(
+        formatter(events), content_type=content_type)
+    response['Content-Disposition'] = (
+        'attachment; filename="sketch_%d.%s"' % (sketch.id, export_format))
+    return response
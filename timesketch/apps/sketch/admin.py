@@ -14,15 +14,19 @@
 
 from django.contrib import admin
 from timesketch.apps.sketch.models import EventComment
+from timesketch.apps.sketch.models import EventLabel
 from timesketch.apps.sketch.models import SavedView
 from timesketch.apps.sketch.models import Sketch
 from timesketch.apps.sketch.models import SketchTimeline
 from timesketch.apps.sketch.models import Timeline
+from timesketch.apps.sketch.models import TimelineStatistics
 
 
 # Register your models here.
 admin.site.register(Sketch)
 admin.site.register(SketchTimeline)
 admin.site.register(Timeline)
+admin.site.register(TimelineStatistics)
 admin.site.register(EventComment)
+admin.site.register(EventLabel)
 admin.site.register(SavedView)
\ No newline at end of file
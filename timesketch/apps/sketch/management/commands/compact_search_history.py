@@ -0,0 +1,37 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compact the search history of all users."""
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from timesketch.apps.sketch.searchhistory import compact_history
+
+
+class Command(BaseCommand):
+    """Remove repeated searches and trim the search history."""
+    help = ('Remove searches that repeat the one before and keep only the '
+            'newest unnamed views for each user in each sketch.')
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--keep', type='int', dest='keep',
+            default=getattr(settings, 'SEARCH_HISTORY_SIZE', 100),
+            help='Number of searches to keep per user and sketch'),
+    )
+
+    def handle(self, *args, **options):
+        deleted = compact_history(options['keep'])
+        self.stdout.write('Deleted %d saved searches' % deleted)
@@ -0,0 +1,104 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Move labels stored in ElasticSearch event documents to the database."""
+
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from timesketch.apps.sketch.models import EventLabel
+from timesketch.apps.sketch.models import Sketch
+from timesketch.apps.sketch.models import Timeline
+from timesketch.lib.datastores import elasticsearch_datastore
+
+# Number of events to read from ElasticSearch before writing their labels.
+CHUNK_SIZE = 1000
+
+
+def import_labels(datastore, indexes, chunk_size=CHUNK_SIZE):
+    """Create EventLabel rows for the labels stored in event documents.
+
+    Labels of sketches or users that no longer exist are skipped. Labels
+    that are already in the database are left as they are, so it is safe to
+    run this more than once.
+
+    Args:
+        datastore -- ElasticSearchDataStore, the datastore to read from
+        indexes -- list, indexes to read the labels from
+        chunk_size -- integer, number of events to handle at a time
+
+    Returns:
+        Tuple of the number of labels imported and skipped
+    """
+    # The IDs are strings or integers depending on the Timesketch version
+    # that stored the label.
+    sketches = dict(
+        (str(sketch.id), sketch) for sketch in Sketch.objects.all())
+    users = dict((str(user.id), user) for user in User.objects.all())
+    imported = skipped = 0
+    groups = {}
+    pending = 0
+    hits = datastore.scroll_stored_labels(indexes, chunk_size=chunk_size)
+    for hit in hits:
+        event = (hit['_index'], hit['_id'])
+        for label in hit['_source'].get('timesketch_label') or []:
+            sketch = sketches.get(str(label.get('sketch')))
+            user = users.get(str(label.get('user')))
+            if sketch is None or user is None or not label.get('name'):
+                skipped += 1
+                continue
+            groups.setdefault(
+                (sketch, user, label['name']), []).append(event)
+            imported += 1
+        pending += 1
+        if pending >= chunk_size:
+            _write_groups(groups)
+            groups = {}
+            pending = 0
+    _write_groups(groups)
+    return imported, skipped
+
+
+def _write_groups(groups):
+    for (sketch, user, name), events in groups.items():
+        EventLabel.add_to_events(sketch, user, events, name)
+
+
+class Command(BaseCommand):
+    """Import the labels that are stored in ElasticSearch."""
+    args = '[index ...]'
+    help = ('Copy the labels and stars stored in the timesketch_label field '
+            'of the events in the given indexes, or of all timelines, to '
+            'the database. Run this once after upgrading.')
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--server', dest='server', default=None,
+            help='IP address or hostname for ElasticSearch server'),
+        make_option(
+            '--port', dest='port', default=None,
+            help='Port number on ElasticSearch server'),
+    )
+
+    def handle(self, *args, **options):
+        indexes = list(args) or sorted(set(
+            Timeline.objects.values_list('datastore_index', flat=True)))
+        if not indexes:
+            self.stdout.write('No timelines to import labels from')
+            return
+        datastore = elasticsearch_datastore.ElasticSearchDataStore(
+            server=options['server'], port=options['port'])
+        imported, skipped = import_labels(datastore, indexes)
+        self.stdout.write(
+            'Imported %d labels, skipped %d' % (imported, skipped))
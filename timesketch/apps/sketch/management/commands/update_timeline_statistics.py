@@ -0,0 +1,36 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Refresh the precomputed statistics of timelines."""
+
+from django.core.management.base import BaseCommand
+
+from timesketch.apps.sketch.models import Timeline
+from timesketch.apps.sketch.timelinestats import update_all
+
+
+class Command(BaseCommand):
+    """Get the statistics of timelines from the datastore."""
+    args = '[index ...]'
+    help = ('Count the events, values and fields of the timelines in the '
+            'given indexes, or of all timelines, and store the result for '
+            'the timeline pages. This also updates the time of the first '
+            'and last event, searches in a time range skip indexes outside '
+            'of it.')
+
+    def handle(self, *args, **options):
+        timelines = Timeline.objects.all()
+        if args:
+            timelines = timelines.filter(datastore_index__in=args)
+        updated = update_all(timelines)
+        self.stdout.write('Updated %d timelines' % updated)
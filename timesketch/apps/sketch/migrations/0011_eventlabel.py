@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Auto generated by Django migrate
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('sketch', '0010_auto_20141110_1129'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventLabel',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('datastore_id', models.CharField(max_length=255)),
+                ('datastore_index', models.CharField(max_length=32)),
+                ('name', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sketch', models.ForeignKey(to='sketch.Sketch')),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventlabel',
+            unique_together=set([('sketch', 'datastore_id', 'datastore_index', 'user', 'name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='eventlabel',
+            index_together=set([('sketch', 'name')]),
+        ),
+    ]
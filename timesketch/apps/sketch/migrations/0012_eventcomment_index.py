@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Auto generated by Django migrate
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sketch', '0011_eventlabel'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='eventcomment',
+            index_together=set([('sketch', 'datastore_index', 'datastore_id')]),
+        ),
+    ]
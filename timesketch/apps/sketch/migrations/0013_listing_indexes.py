@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Auto generated by Django migrate
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sketch', '0012_eventcomment_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='savedview',
+            index_together=set([('sketch', 'created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='sketch',
+            index_together=set([('user', 'created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='sketchtimeline',
+            index_together=set([('sketch', 'created')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from timesketch.apps.sketch import sketchsearch
+
+
+def create_index(apps, schema_editor):
+    sketchsearch.create_index(schema_editor)
+
+
+def drop_index(apps, schema_editor):
+    sketchsearch.drop_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sketch', '0013_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
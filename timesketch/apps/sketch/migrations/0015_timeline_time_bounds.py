@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Auto generated by Django migrate
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sketch', '0014_sketch_fulltext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timeline',
+            name='max_timestamp',
+            field=models.BigIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='timeline',
+            name='min_timestamp',
+            field=models.BigIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Auto generated by Django migrate
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sketch', '0015_timeline_time_bounds'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineStatistics',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('event_count', models.BigIntegerField(default=0)),
+                ('top_values', models.TextField(default='{}')),
+                ('field_names', models.TextField(default='[]')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('timeline', models.OneToOneField(related_name='statistics', to='sketch.Timeline')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -14,25 +14,61 @@
 """This module implements timesketch Django database models."""
 # ToDo: Clean up the models (see github issue #25)
 
+import datetime
+import json
 import random
 
+from django.core.cache import cache
+from django.db import IntegrityError
 from django.db import models
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.contrib.contenttypes.generic import GenericRelation
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from timesketch.apps.acl.models import AccessControlEntry
+from timesketch.apps.acl.models import AccessControlQuerySet
 from timesketch.apps.acl.models import AccessControlMixIn
+from timesketch.apps.sketch import sketchsearch
+
+# Maximum number of event IDs in one IN clause, SQLite allows 999 variables.
+QUERY_CHUNK_SIZE = 500
+
+
+def _chunk_events_by_index(events):
+    """Group events by index and split them into chunks.
+
+    Args:
+        events -- list, (index, event ID) tuples
+
+    Returns:
+        Generator of (index, list of event IDs) tuples
+    """
+    grouped = {}
+    for index, event_id in events:
+        grouped.setdefault(index, []).append(event_id)
+    for index, event_ids in grouped.items():
+        for i in range(0, len(event_ids), QUERY_CHUNK_SIZE):
+            yield index, event_ids[i:i + QUERY_CHUNK_SIZE]
 
 
 class Sketch(AccessControlMixIn, models.Model):
     """Database model for a Sketch entry."""
     user = models.ForeignKey(User)
     acl = GenericRelation(AccessControlEntry)
+    objects = AccessControlQuerySet.as_manager()
     title = models.CharField(max_length=255)
     description = models.TextField(blank=True)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = [('user', 'created')]
+
     @property
     def timelines(self):
         """
@@ -44,6 +80,99 @@ class Sketch(AccessControlMixIn, models.Model):
         """
         return SketchTimeline.objects.filter(sketch=self)
 
+    def get_addable_timelines(self, user):
+        """
+        Get timelines that the user can read and that are not in this sketch
+        yet.
+
+        Args:
+            user -- User, the user that adds timelines
+
+        Returns:
+            A Django QuerySet for Timeline.
+        """
+        return Timeline.objects.readable_by(user).exclude(
+            id__in=self.timelines.values('timeline_id'))
+
+    def add_timelines(self, user, timeline_ids):
+        """
+        Add timelines to this sketch, each with a random color. Timelines
+        that the user can't read or that are already in the sketch are
+        skipped.
+
+        Args:
+            user -- User, the user that adds the timelines
+            timeline_ids -- list, IDs of the timelines to add
+
+        Returns:
+            List of the new SketchTimeline objects
+        """
+        valid_ids = []
+        for timeline_id in timeline_ids:
+            try:
+                valid_ids.append(int(timeline_id))
+            except ValueError:
+                pass
+        timelines = self.get_addable_timelines(user).filter(id__in=valid_ids)
+        sketch_timelines = SketchTimeline.objects.bulk_create([
+            SketchTimeline(
+                sketch=self, timeline=timeline, user=user,
+                color=SketchTimeline.generate_color())
+            for timeline in timelines])
+        # bulk_create() doesn't send post_save.
+        if sketch_timelines:
+            Sketch.invalidate_timeline_metadata([self.id])
+        return sketch_timelines
+
+    @staticmethod
+    def _timeline_metadata_key(sketch_id):
+        return 'timesketch:sketch:timeline_metadata:%s' % sketch_id
+
+    @classmethod
+    def get_timeline_metadata(cls, sketch_id):
+        """
+        Get color, title, visibility and time bounds for the timelines in a
+        sketch, keyed on datastore index. This is used to decorate search
+        results and to skip indexes without events in a time range.
+
+        The result is kept in the Django cache, and removed from it when a
+        timeline in the sketch is changed.
+
+        Args:
+            sketch_id -- integer, sketch ID
+
+        Returns:
+            Dictionary with index as key and a dictionary with color, title,
+            visible, min_timestamp and max_timestamp as value.
+        """
+        key = cls._timeline_metadata_key(sketch_id)
+        metadata = cache.get(key)
+        if metadata is None:
+            metadata = {}
+            for sketch_timeline in SketchTimeline.objects.filter(
+                    sketch_id=sketch_id).select_related('timeline'):
+                timeline = sketch_timeline.timeline
+                metadata[timeline.datastore_index] = {
+                    'color': sketch_timeline.color,
+                    'title': timeline.title,
+                    'visible': sketch_timeline.visible,
+                    'min_timestamp': timeline.min_timestamp,
+                    'max_timestamp': timeline.max_timestamp
+                }
+            cache.set(key, metadata)
+        return metadata
+
+    @classmethod
+    def invalidate_timeline_metadata(cls, sketch_ids):
+        """
+        Remove cached timeline metadata.
+
+        Args:
+            sketch_ids -- list, IDs of the sketches to remove metadata for
+        """
+        cache.delete_many([
+            cls._timeline_metadata_key(sketch_id) for sketch_id in sketch_ids])
+
     # ToDo: Make this a property
     def get_named_views(self):
         """
@@ -62,15 +191,92 @@ class Timeline(AccessControlMixIn, models.Model):
     """Database model for a timeline."""
     user = models.ForeignKey(User)
     acl = GenericRelation(AccessControlEntry)
+    objects = AccessControlQuerySet.as_manager()
     title = models.CharField(max_length=255)
     description = models.TextField(blank=True)
     datastore_index = models.CharField(max_length=32)
+    # Time of the first and last event in milliseconds since epoch, None if
+    # not known.
+    min_timestamp = models.BigIntegerField(null=True, blank=True)
+    max_timestamp = models.BigIntegerField(null=True, blank=True)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
     def __unicode__(self):
         return '%s' % self.title
 
+    @staticmethod
+    def _millis_to_datetime(millis):
+        if millis is None:
+            return None
+        return datetime.datetime.fromtimestamp(millis / 1000.0, timezone.utc)
+
+    def get_first_event_time(self):
+        """
+        Get the time of the first event in the timeline.
+
+        Returns:
+            Timezone aware datetime, or None if it is not known.
+        """
+        return self._millis_to_datetime(self.min_timestamp)
+
+    def get_last_event_time(self):
+        """
+        Get the time of the last event in the timeline.
+
+        Returns:
+            Timezone aware datetime, or None if it is not known.
+        """
+        return self._millis_to_datetime(self.max_timestamp)
+
+    def update_time_bounds(self, datastore):
+        """
+        Get the time of the first and last event in the timeline from the
+        datastore and save it.
+
+        Args:
+            datastore -- DataStore, the datastore the timeline is stored in
+        """
+        self.min_timestamp, self.max_timestamp = datastore.get_time_bounds(
+            self.datastore_index)
+        self.save(update_fields=['min_timestamp', 'max_timestamp'])
+
+
+class TimelineStatistics(models.Model):
+    """Database model for precomputed statistics of a timeline."""
+    timeline = models.OneToOneField(Timeline, related_name='statistics')
+    event_count = models.BigIntegerField(default=0)
+    # Most common values as JSON, field name to list of [value, count].
+    top_values = models.TextField(default='{}')
+    # Names of all fields in the index as a JSON list.
+    field_names = models.TextField(default='[]')
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def get_top_values(self):
+        """
+        Get the most common values of the fields in the timeline.
+
+        Returns:
+            Dictionary with field name as key and a list of (value, number
+            of events) tuples as value.
+        """
+        return dict(
+            (field, [tuple(item) for item in values])
+            for field, values in json.loads(self.top_values).items())
+
+    def get_field_names(self):
+        """
+        Get the names of all fields in the timeline.
+
+        Returns:
+            Sorted list of field names
+        """
+        return json.loads(self.field_names)
+
+    def __unicode__(self):
+        return '%s' % self.timeline.title
+
 
 class SketchTimeline(models.Model):
     """Database model for annotating a timeline."""
@@ -83,6 +289,9 @@ class SketchTimeline(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = [('sketch', 'created')]
+
     @staticmethod
     def generate_color():
         """Picks a random color used when creating a SketchTimeline.
@@ -97,6 +306,30 @@ class SketchTimeline(models.Model):
         return '%s' % self.timeline.title
 
 
+@receiver(post_save, sender=Sketch)
+def _sketch_saved(instance, **unused_kwargs):
+    sketchsearch.index_sketch(instance)
+
+
+@receiver(post_delete, sender=Sketch)
+def _sketch_deleted(instance, **unused_kwargs):
+    sketchsearch.unindex_sketch(instance.id)
+
+
+@receiver(post_save, sender=SketchTimeline)
+@receiver(post_delete, sender=SketchTimeline)
+def _sketch_timeline_changed(instance, **unused_kwargs):
+    Sketch.invalidate_timeline_metadata([instance.sketch_id])
+
+
+@receiver(post_save, sender=Timeline)
+@receiver(post_delete, sender=Timeline)
+def _timeline_changed(instance, **unused_kwargs):
+    Sketch.invalidate_timeline_metadata(
+        SketchTimeline.objects.filter(timeline_id=instance.id).values_list(
+            'sketch_id', flat=True))
+
+
 class EventComment(models.Model):
     """Database model for a event comment."""
     user = models.ForeignKey(User)
@@ -107,10 +340,142 @@ class EventComment(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = [('sketch', 'datastore_index', 'datastore_id')]
+
+    @classmethod
+    def get_for_events(cls, sketch, events):
+        """Get the comments on events in a sketch.
+
+        The users and their profiles are fetched in the same query.
+
+        Args:
+            sketch -- Sketch, the sketch the comments belong to
+            events -- list, (index, event ID) tuples
+
+        Returns:
+            List of comments, oldest first for every event
+        """
+        comments = []
+        for index, event_ids in _chunk_events_by_index(events):
+            comments.extend(cls.objects.filter(
+                sketch=sketch, datastore_index=index,
+                datastore_id__in=event_ids).select_related(
+                    'user__userprofile').order_by('created', 'id'))
+        return comments
+
+    @classmethod
+    def count_for_events(cls, sketch, events):
+        """Count the comments on events in a sketch.
+
+        Args:
+            sketch -- Sketch, the sketch the comments belong to
+            events -- list, (index, event ID) tuples
+
+        Returns:
+            Dictionary with (index, event ID) as key and the number of
+            comments as value, for events that have comments.
+        """
+        counts = {}
+        for index, event_ids in _chunk_events_by_index(events):
+            rows = cls.objects.filter(
+                sketch=sketch, datastore_index=index,
+                datastore_id__in=event_ids).values(
+                    'datastore_id').annotate(count=Count('id')).order_by()
+            for row in rows:
+                counts[(index, row['datastore_id'])] = row['count']
+        return counts
+
     def __unicode__(self):
         return '%s' % self.datastore_id
 
 
+class EventLabel(models.Model):
+    """Database model for a label on an event.
+
+    Labels are kept here and not in the event documents, so that labeling an
+    event never rewrites the document in the datastore.
+    """
+    STAR = '__ts_star'
+    COMMENT = '__ts_comment'
+
+    user = models.ForeignKey(User)
+    sketch = models.ForeignKey(Sketch)
+    datastore_id = models.CharField(max_length=255)
+    datastore_index = models.CharField(max_length=32)
+    name = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (
+            'sketch', 'datastore_id', 'datastore_index', 'user', 'name')
+        index_together = [('sketch', 'name')]
+
+    @classmethod
+    def get_for_events(cls, sketch, events):
+        """Get the labels for events in a sketch.
+
+        Args:
+            sketch -- Sketch, the sketch the labels belong to
+            events -- list, (index, event ID) tuples
+
+        Returns:
+            Dictionary with (index, event ID) as key and a list of labels as
+            dictionaries with name, user and sketch as value.
+        """
+        labels = {}
+        for index, event_ids in _chunk_events_by_index(events):
+            rows = cls.objects.filter(
+                sketch=sketch, datastore_index=index,
+                datastore_id__in=event_ids).values_list(
+                    'datastore_id', 'user_id', 'name')
+            for event_id, user_id, name in rows:
+                labels.setdefault((index, event_id), []).append(
+                    {'name': name, 'user': user_id, 'sketch': str(sketch.id)})
+        return labels
+
+    @classmethod
+    def add_to_events(cls, sketch, user, events, name, toggle=False):
+        """Add a label to events.
+
+        Args:
+            sketch -- Sketch, the sketch to label the events in
+            user -- User, the user that adds the label
+            events -- list, (index, event ID) tuples
+            name -- string, the label to apply
+            toggle -- Bool, remove the label from events that already have
+                      it instead of leaving them as they are
+        """
+        with transaction.atomic():
+            existing = set()
+            for index, event_ids in _chunk_events_by_index(events):
+                labels = cls.objects.filter(
+                    sketch=sketch, user=user, name=name,
+                    datastore_index=index, datastore_id__in=event_ids)
+                existing.update(
+                    (index, event_id) for event_id in
+                    labels.values_list('datastore_id', flat=True))
+                if toggle:
+                    labels.delete()
+            new_events = set(events) - existing
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create([
+                        cls(sketch=sketch, user=user, name=name,
+                            datastore_index=index, datastore_id=event_id)
+                        for index, event_id in new_events])
+            except IntegrityError:
+                # Another request added some of the labels after they were
+                # looked up, add the rest one at a time.
+                for index, event_id in new_events:
+                    cls.objects.get_or_create(
+                        sketch=sketch, user=user, name=name,
+                        datastore_index=index, datastore_id=event_id)
+
+    def __unicode__(self):
+        return '%s %s' % (self.datastore_id, self.name)
+
+
 class SavedView(models.Model):
     """Database model for a saved view."""
     user = models.ForeignKey(User)
@@ -121,6 +486,9 @@ class SavedView(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = [('sketch', 'created')]
+
     def __unicode__(self):
         return '%s %s %s %s' % (self.created, self.user, self.sketch,
                                 self.name)
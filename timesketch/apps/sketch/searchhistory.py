@@ -0,0 +1,209 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Search history, stored as unnamed saved views."""
+
+import atexit
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+
+from timesketch.apps.sketch.models import SavedView
+
+# Number of (user, sketch) pairs to remember the last search for.
+LAST_SEARCHES_SIZE = 10000
+
+# Maximum number of rows to delete in one query.
+DELETE_CHUNK_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+def trim_history(user_id, sketch_id, max_views):
+    """Delete all but the newest unnamed views of a user in a sketch.
+
+    Args:
+        user_id -- integer, user ID
+        sketch_id -- integer, sketch ID
+        max_views -- integer, number of views to keep
+
+    Returns:
+        Number of deleted views
+    """
+    old_ids = list(SavedView.objects.filter(
+        user_id=user_id, sketch_id=sketch_id, name='').order_by(
+            '-created', '-id').values_list('id', flat=True)[max_views:])
+    for i in range(0, len(old_ids), DELETE_CHUNK_SIZE):
+        SavedView.objects.filter(
+            id__in=old_ids[i:i + DELETE_CHUNK_SIZE]).delete()
+    return len(old_ids)
+
+
+def compact_history(max_views):
+    """Compact the search history of all users.
+
+    Removes searches that are the same as the one before and keeps only the
+    newest max_views unnamed views for every user in every sketch.
+
+    Args:
+        max_views -- integer, number of views to keep per user and sketch
+
+    Returns:
+        Number of deleted views
+    """
+    deleted = 0
+    pairs = SavedView.objects.filter(name='').values_list(
+        'user_id', 'sketch_id').distinct()
+    for user_id, sketch_id in list(pairs):
+        views = SavedView.objects.filter(
+            user_id=user_id, sketch_id=sketch_id, name='').order_by(
+                'created', 'id').values_list('id', 'query', 'filter')
+        duplicate_ids = []
+        previous = None
+        for view_id, query, query_filter in views.iterator():
+            if (query, query_filter) == previous:
+                duplicate_ids.append(view_id)
+            previous = (query, query_filter)
+        for i in range(0, len(duplicate_ids), DELETE_CHUNK_SIZE):
+            SavedView.objects.filter(
+                id__in=duplicate_ids[i:i + DELETE_CHUNK_SIZE]).delete()
+        deleted += len(duplicate_ids)
+        deleted += trim_history(user_id, sketch_id, max_views)
+    return deleted
+
+
+class SearchHistoryWriter(object):
+    """Buffered writer for the search history.
+
+    Searches are kept in memory and written in batches after a request has
+    been handled, when enough of them are pending or the oldest has waited
+    long enough. A search that is the same as the previous one by the same
+    user in the same sketch is not recorded again. Every flush trims the
+    history of the users and sketches it wrote to.
+
+    The buffer is per process, so the history is eventually consistent:
+    with several worker processes a search shows up in the history of other
+    workers only once the worker that handled it has flushed, and searches
+    still pending when a worker is killed are lost. Pending searches are
+    flushed when the process exits normally. A batch_size of 1 writes every
+    search to the database before the next request is handled.
+    """
+    def __init__(self, max_views=100, batch_size=50, flush_interval=5):
+        """Initialize the writer.
+
+        Args:
+            max_views -- integer, number of unnamed views to keep per user
+                         and sketch
+            batch_size -- integer, flush when this many searches are pending
+            flush_interval -- integer, flush when the oldest pending search
+                              is this many seconds old
+        """
+        self.max_views = max_views
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._oldest = None
+        self._last_searches = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, user, sketch, query, query_filter):
+        """Record a search.
+
+        Args:
+            user -- User, the user that searched
+            sketch -- Sketch, the sketch that was searched
+            query -- string, query string
+            query_filter -- string, the filter as JSON
+
+        Returns:
+            False if the search was the same as the previous one, else True
+        """
+        key = (user.id, sketch.id)
+        with self._lock:
+            if self._last_searches.get(key) == (query, query_filter):
+                return False
+            self._last_searches.pop(key, None)
+            self._last_searches[key] = (query, query_filter)
+            if len(self._last_searches) > LAST_SEARCHES_SIZE:
+                self._last_searches.popitem(last=False)
+            if not self._pending:
+                self._oldest = time.time()
+            self._pending.append(SavedView(
+                user=user, sketch=sketch, query=query, filter=query_filter,
+                name=''))
+        return True
+
+    def clear(self):
+        """Drop all pending searches without writing them."""
+        with self._lock:
+            self._pending = []
+            self._oldest = None
+            self._last_searches.clear()
+
+    def flush_if_due(self):
+        """Flush if enough searches are pending or have waited too long.
+
+        Returns:
+            Number of searches written
+        """
+        with self._lock:
+            due = self._pending and (
+                len(self._pending) >= self.batch_size or
+                time.time() - self._oldest >= self.flush_interval)
+        if not due:
+            return 0
+        return self.flush()
+
+    def flush(self):
+        """Write all pending searches to the database.
+
+        Returns:
+            Number of searches written
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._oldest = None
+        if not pending:
+            return 0
+        SavedView.objects.bulk_create(pending)
+        for user_id, sketch_id in set(
+                (view.user_id, view.sketch_id) for view in pending):
+            trim_history(user_id, sketch_id, self.max_views)
+        return len(pending)
+
+
+search_history = SearchHistoryWriter(
+    max_views=getattr(settings, 'SEARCH_HISTORY_SIZE', 100),
+    batch_size=getattr(settings, 'SEARCH_HISTORY_BATCH_SIZE', 50),
+    flush_interval=getattr(settings, 'SEARCH_HISTORY_FLUSH_INTERVAL', 5))
+
+
+def _flush_after_request(**unused_kwargs):
+    search_history.flush_if_due()
+
+
+request_finished.connect(_flush_after_request)
+
+
+def _flush_at_exit():
+    try:
+        search_history.flush()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Unable to write the pending search history')
+
+
+atexit.register(_flush_at_exit)
@@ -0,0 +1,148 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Full-text search over sketch titles and descriptions.
+
+On SQLite the text is kept in an FTS5 table that is updated when a sketch is
+saved or deleted. On PostgreSQL an expression index on the tsvector of the
+text is used, which the database keeps up to date itself. Other databases
+fall back to substring matching.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.utils import DatabaseError
+
+FTS_TABLE = 'sketch_sketch_fts'
+
+# Text search configuration for PostgreSQL.
+TSVECTOR = "to_tsvector('english', title || ' ' || description)"
+
+_fts_available = None
+
+
+def create_index(schema_editor):
+    """Create the full-text index for the database and fill it.
+
+    Args:
+        schema_editor -- schema editor of the migration
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            schema_editor.execute(
+                'CREATE VIRTUAL TABLE %s USING fts5(title, description)' %
+                FTS_TABLE)
+        except DatabaseError:
+            # SQLite is built without FTS5, search falls back to LIKE.
+            return
+        schema_editor.execute(
+            'INSERT INTO %s (rowid, title, description) '
+            'SELECT id, title, description FROM sketch_sketch' % FTS_TABLE)
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX %s ON sketch_sketch USING gin(%s)' %
+            (FTS_TABLE, TSVECTOR))
+
+
+def drop_index(schema_editor):
+    """Remove the full-text index.
+
+    Args:
+        schema_editor -- schema editor of the migration
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS %s' % FTS_TABLE)
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % FTS_TABLE)
+
+
+def _use_fts_table():
+    """Check if the database has an FTS5 table to keep up to date."""
+    global _fts_available  # pylint: disable=global-statement
+    if connection.vendor != 'sqlite':
+        return False
+    if _fts_available is None:
+        _fts_available = FTS_TABLE in connection.introspection.table_names()
+    return _fts_available
+
+
+def index_sketch(sketch):
+    """Add or update a sketch in the FTS5 table.
+
+    Args:
+        sketch -- Sketch, the sketch to index
+    """
+    if not _use_fts_table():
+        return
+    cursor = connection.cursor()
+    cursor.execute(
+        'DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [sketch.id])
+    cursor.execute(
+        'INSERT INTO %s (rowid, title, description) VALUES (%%s, %%s, %%s)' %
+        FTS_TABLE, [sketch.id, sketch.title, sketch.description])
+
+
+def unindex_sketch(sketch_id):
+    """Remove a sketch from the FTS5 table.
+
+    Args:
+        sketch_id -- integer, ID of the sketch
+    """
+    if not _use_fts_table():
+        return
+    connection.cursor().execute(
+        'DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [sketch_id])
+
+
+def search(queryset, query):
+    """Search sketches for words in their title or description.
+
+    Every word has to match, as a prefix of a word in the sketch on SQLite.
+    The search is added to the queryset, so other filters like the ACL run
+    in the same query.
+
+    Args:
+        queryset -- QuerySet, the sketches to search
+        query -- string, words to search for
+
+    Returns:
+        QuerySet with the matching sketches, best match first
+    """
+    terms = re.findall(r'\w+', query, re.UNICODE)
+    if not terms:
+        return queryset.none()
+    if _use_fts_table():
+        match = u' '.join(u'"%s"*' % term for term in terms)
+        return queryset.extra(
+            tables=[FTS_TABLE],
+            where=['%s.rowid = sketch_sketch.id' % FTS_TABLE,
+                   '%s MATCH %%s' % FTS_TABLE],
+            params=[match],
+            select={'rank': 'bm25(%s)' % FTS_TABLE},
+            order_by=['rank', '-created'])
+    if connection.vendor == 'postgresql':
+        tsquery = "plainto_tsquery('english', %s)"
+        return queryset.extra(
+            where=['%s @@ %s' % (TSVECTOR, tsquery)],
+            params=[u' '.join(terms)],
+            select={'rank': 'ts_rank(%s, %s)' % (TSVECTOR, tsquery)},
+            select_params=[u' '.join(terms)],
+            order_by=['-rank', '-created'])
+    for term in terms:
+        queryset = queryset.filter(
+            Q(title__icontains=term) | Q(description__icontains=term))
+    return queryset.order_by('-created')
@@ -13,13 +13,25 @@
 # limitations under the License.
 """Unit tests for timesketch models"""
 
+from StringIO import StringIO
+
+import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.contrib.auth.models import User
 from django.db.models.query import QuerySet
+from timesketch.apps.sketch.models import EventComment
+from timesketch.apps.sketch.models import EventLabel
 from timesketch.apps.sketch.models import Sketch
 from timesketch.apps.sketch.models import SavedView
 from timesketch.apps.sketch.models import Timeline
 from timesketch.apps.sketch.models import SketchTimeline
+from timesketch.apps.sketch.models import TimelineStatistics
+from timesketch.apps.sketch import sketchsearch
+from timesketch.apps.sketch import timelinestats
+from timesketch.apps.sketch.searchhistory import SearchHistoryWriter
 
 
 class ModelSketchTest(TestCase):
@@ -58,6 +70,15 @@ class ModelTimelineTest(TestCase):
         self.assertIsInstance(self.timeline, Timeline)
         self.assertEqual(self.timeline.__unicode__(), self.timeline.title)
 
+    def test_update_time_bounds(self):
+        datastore = mock.Mock()
+        datastore.get_time_bounds.return_value = (1000, 2000)
+        self.timeline.update_time_bounds(datastore)
+        datastore.get_time_bounds.assert_called_once_with("1")
+        timeline = Timeline.objects.get(id=self.timeline.id)
+        self.assertEqual(timeline.min_timestamp, 1000)
+        self.assertEqual(timeline.max_timestamp, 2000)
+
 
 class ModelSketchTimelineTest(TestCase):
     """Test creating SketchTimeline model."""
@@ -73,3 +94,357 @@ class ModelSketchTimelineTest(TestCase):
     def test_generate_color(self):
         self.assertIsInstance(self.sketch_timeline.generate_color(), str)
         self.assertEqual(len(self.sketch_timeline.generate_color()), 6)
+
+    def test_add_timelines(self):
+        other_user = User.objects.create(username="otheruser")
+        readable = Timeline.objects.create(
+            user=self.user, title="readable", datastore_index="abc")
+        unreadable = Timeline.objects.create(
+            user=other_user, title="unreadable", datastore_index="def")
+        self.assertEqual(
+            list(self.sketch.get_addable_timelines(self.user)), [readable])
+        Sketch.get_timeline_metadata(self.sketch.id)
+        with self.assertNumQueries(2):
+            added = self.sketch.add_timelines(self.user, [
+                self.timeline.id, readable.id, unreadable.id, "invalid"])
+        self.assertEqual(len(added), 1)
+        self.assertEqual(
+            sorted(Sketch.get_timeline_metadata(self.sketch.id)),
+            ["123456", "abc"])
+        self.assertEqual(
+            list(self.sketch.get_addable_timelines(self.user)), [])
+
+
+class SketchTimelineMetadataTest(TestCase):
+    """Test the cached timeline metadata of a sketch."""
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="testuser")
+        self.sketch = Sketch.objects.create(
+            user=self.user, title="testsketch1")
+        self.timeline = Timeline.objects.create(
+            user=self.user, title="test", datastore_index="123456")
+        self.sketch_timeline = SketchTimeline.objects.create(
+            timeline=self.timeline, user=self.user, sketch=self.sketch,
+            color="ECEEE1")
+
+    def test_metadata_is_cached(self):
+        expected = {
+            "123456": {"color": "ECEEE1", "title": "test", "visible": True,
+                       "min_timestamp": None, "max_timestamp": None}}
+        self.assertEqual(
+            Sketch.get_timeline_metadata(self.sketch.id), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                Sketch.get_timeline_metadata(self.sketch.id), expected)
+
+    def test_metadata_is_invalidated(self):
+        Sketch.get_timeline_metadata(self.sketch.id)
+        self.sketch_timeline.color = "A8DACF"
+        self.sketch_timeline.save()
+        self.assertEqual(
+            Sketch.get_timeline_metadata(self.sketch.id)["123456"]["color"],
+            "A8DACF")
+        self.timeline.title = "renamed"
+        self.timeline.save()
+        self.assertEqual(
+            Sketch.get_timeline_metadata(self.sketch.id)["123456"]["title"],
+            "renamed")
+        self.sketch_timeline.delete()
+        self.assertEqual(Sketch.get_timeline_metadata(self.sketch.id), {})
+
+
+class ModelEventLabelTest(TestCase):
+    """Test adding and getting labels with the EventLabel model."""
+    def setUp(self):
+        self.user1 = User.objects.create(username="testuser1")
+        self.user2 = User.objects.create(username="testuser2")
+        self.sketch = Sketch.objects.create(
+            user=self.user1, title="testsketch1")
+
+    def test_add_to_events(self):
+        events = [("index1", "event1"), ("index2", "event2")]
+        EventLabel.add_to_events(self.sketch, self.user1, events, "test")
+        EventLabel.add_to_events(self.sketch, self.user1, events, "test")
+        self.assertEqual(EventLabel.objects.count(), 2)
+        labels = EventLabel.get_for_events(
+            self.sketch, events + [("index1", "event2")])
+        self.assertEqual(
+            labels[("index1", "event1")],
+            [{"name": "test", "user": self.user1.id,
+              "sketch": str(self.sketch.id)}])
+        self.assertNotIn(("index1", "event2"), labels)
+
+    def test_add_to_events_concurrently(self):
+        """A label added by another request in the meantime is kept."""
+        events = [("index1", "event1"), ("index1", "event2")]
+        bulk_create = EventLabel.objects.bulk_create
+
+        def add_first_then_bulk_create(objs):
+            EventLabel.objects.create(
+                sketch=self.sketch, user=self.user1, name="test",
+                datastore_index="index1", datastore_id="event1")
+            return bulk_create(objs)
+
+        with mock.patch.object(
+                EventLabel.objects, "bulk_create",
+                side_effect=add_first_then_bulk_create):
+            EventLabel.add_to_events(
+                self.sketch, self.user1, events, "test")
+        self.assertEqual(
+            sorted(EventLabel.objects.values_list(
+                "datastore_id", flat=True)), ["event1", "event2"])
+
+    def test_add_to_events_toggle(self):
+        events = [("index1", "event1")]
+        EventLabel.add_to_events(
+            self.sketch, self.user1, events, EventLabel.STAR, toggle=True)
+        EventLabel.add_to_events(
+            self.sketch, self.user2, events, EventLabel.STAR, toggle=True)
+        self.assertEqual(EventLabel.objects.count(), 2)
+        EventLabel.add_to_events(
+            self.sketch, self.user1, events, EventLabel.STAR, toggle=True)
+        self.assertEqual(
+            list(EventLabel.objects.values_list("user", flat=True)),
+            [self.user2.id])
+
+
+class ModelEventCommentTest(TestCase):
+    """Test getting comments for many events with the EventComment model."""
+    def setUp(self):
+        self.user1 = User.objects.create(username="testuser1")
+        self.user2 = User.objects.create(username="testuser2")
+        self.sketch = Sketch.objects.create(
+            user=self.user1, title="testsketch1")
+        for user, index, event_id in [
+                (self.user1, "index1", "event1"),
+                (self.user2, "index1", "event1"),
+                (self.user2, "index2", "event2")]:
+            EventComment.objects.create(
+                user=user, sketch=self.sketch, body="test",
+                datastore_index=index, datastore_id=event_id)
+
+    def test_get_for_events(self):
+        events = [("index1", "event1"), ("index2", "event2")]
+        with self.assertNumQueries(2):
+            comments = EventComment.get_for_events(self.sketch, events)
+            avatars = [c.user.userprofile.get_avatar_url() for c in comments]
+        self.assertEqual(len(avatars), 3)
+
+    def test_count_for_events(self):
+        counts = EventComment.count_for_events(
+            self.sketch, [("index1", "event1"), ("index1", "event2"),
+                          ("index2", "event2")])
+        self.assertEqual(
+            counts, {("index1", "event1"): 2, ("index2", "event2"): 1})
+
+
+class SearchHistoryTest(TestCase):
+    """Test the buffered search history writer."""
+    def setUp(self):
+        self.user = User.objects.create(username="testuser")
+        self.sketch = Sketch.objects.create(
+            user=self.user, title="testsketch1")
+        self.writer = SearchHistoryWriter(
+            max_views=2, batch_size=3, flush_interval=60)
+
+    def _history(self):
+        return list(SavedView.objects.filter(name="").order_by(
+            "id").values_list("query", flat=True))
+
+    def test_record_and_flush(self):
+        self.assertTrue(self.writer.record(self.user, self.sketch, "a", "{}"))
+        self.assertFalse(
+            self.writer.record(self.user, self.sketch, "a", "{}"))
+        self.writer.record(self.user, self.sketch, "b", "{}")
+        self.assertEqual(self.writer.flush_if_due(), 0)
+        self.assertEqual(self._history(), [])
+        self.writer.record(self.user, self.sketch, "c", "{}")
+        self.assertEqual(self.writer.flush_if_due(), 3)
+        # Only the newest two searches are kept.
+        self.assertEqual(self._history(), ["b", "c"])
+
+    def test_write_through(self):
+        writer = SearchHistoryWriter(batch_size=1, flush_interval=60)
+        writer.record(self.user, self.sketch, "a", "{}")
+        self.assertEqual(writer.flush_if_due(), 1)
+        self.assertEqual(self._history(), ["a"])
+
+    def test_compact_command(self):
+        for query in ["a", "a", "b", "c", "c"]:
+            SavedView.objects.create(
+                user=self.user, sketch=self.sketch, query=query, filter="{}",
+                name="")
+        SavedView.objects.create(
+            user=self.user, sketch=self.sketch, query="a", filter="{}",
+            name="named")
+        output = StringIO()
+        call_command("compact_search_history", keep=2, stdout=output)
+        self.assertIn("Deleted 3", output.getvalue())
+        self.assertEqual(self._history(), ["b", "c"])
+        self.assertEqual(SavedView.objects.exclude(name="").count(), 1)
+
+
+class SketchSearchTest(TestCase):
+    """Test full-text search of sketches."""
+    def setUp(self):
+        self.user1 = User.objects.create(username="testuser1")
+        self.user2 = User.objects.create(username="testuser2")
+        self.phishing = Sketch.objects.create(
+            user=self.user1, title="Phishing campaign",
+            description="Phishing mails with a malware attachment")
+        self.malware = Sketch.objects.create(
+            user=self.user1, title="Malware", description="Dropper")
+        self.private = Sketch.objects.create(
+            user=self.user2, title="Private malware", description="")
+
+    def test_search(self):
+        result = sketchsearch.search(Sketch.objects.all(), "phish")
+        self.assertEqual(list(result), [self.phishing])
+        result = sketchsearch.search(Sketch.objects.all(), "mails attach")
+        self.assertEqual(list(result), [self.phishing])
+        self.assertEqual(
+            list(sketchsearch.search(Sketch.objects.all(), "  ")), [])
+
+    def test_search_is_ranked(self):
+        """Better matches should come first and ACLs should apply."""
+        result = sketchsearch.search(
+            Sketch.objects.readable_by(self.user1), "malware")
+        self.assertEqual(list(result), [self.malware, self.phishing])
+
+    def test_index_follows_changes(self):
+        self.malware.title = "Ransomware"
+        self.malware.save()
+        result = sketchsearch.search(Sketch.objects.all(), "ransom")
+        self.assertEqual(list(result), [self.malware])
+        self.malware.delete()
+        result = sketchsearch.search(Sketch.objects.all(), "ransom")
+        self.assertEqual(list(result), [])
+
+
+class ImportEventLabelsTest(TestCase):
+    """Test moving labels from the event documents to the database."""
+    def setUp(self):
+        self.user = User.objects.create(username="testuser")
+        self.sketch = Sketch.objects.create(user=self.user, title="test")
+        Timeline.objects.create(
+            user=self.user, title="test", datastore_index="123456")
+        self.hits = [
+            {"_index": "123456", "_id": "1", "_source": {
+                "timesketch_label": [
+                    {"name": EventLabel.STAR, "user": self.user.id,
+                     "sketch": str(self.sketch.id)},
+                    {"name": "test", "user": self.user.id,
+                     "sketch": "999"}]}},
+            {"_index": "123456", "_id": "2", "_source": {
+                "timesketch_label": [
+                    {"name": EventLabel.STAR, "user": str(self.user.id),
+                     "sketch": self.sketch.id}]}},
+        ]
+
+    def test_import_command(self):
+        datastore = mock.Mock()
+        datastore.scroll_stored_labels.return_value = iter(self.hits)
+        output = StringIO()
+        with mock.patch(
+                "timesketch.lib.datastores.elasticsearch_datastore."
+                "ElasticSearchDataStore", return_value=datastore):
+            call_command("import_event_labels", stdout=output)
+        self.assertIn("Imported 2 labels, skipped 1", output.getvalue())
+        self.assertEqual(
+            datastore.scroll_stored_labels.call_args[0][0], ["123456"])
+        self.assertEqual(
+            sorted(EventLabel.objects.filter(
+                sketch=self.sketch, name=EventLabel.STAR).values_list(
+                    "datastore_id", flat=True)), ["1", "2"])
+        # Running it again doesn't add the labels twice.
+        datastore.scroll_stored_labels.return_value = iter(self.hits)
+        with mock.patch(
+                "timesketch.lib.datastores.elasticsearch_datastore."
+                "ElasticSearchDataStore", return_value=datastore):
+            call_command("import_event_labels", stdout=output)
+        self.assertEqual(EventLabel.objects.count(), 2)
+
+
+class TimelineStatisticsTest(TestCase):
+    """Test the precomputed timeline statistics."""
+    def setUp(self):
+        self.user = User.objects.create(username="testuser")
+        self.timeline = Timeline.objects.create(
+            user=self.user, title="test", datastore_index="123456")
+        self.datastore = mock.Mock()
+        self.datastore.get_statistics.return_value = {
+            "count": 3,
+            "min_timestamp": 1410897600000,
+            "max_timestamp": 1410984000000,
+            "top_values": {"source_short": [["REG", 2], ["FILE", 1]]},
+            "fields": ["datetime", "message", "source_short"]
+        }
+
+    def test_update_statistics(self):
+        timelinestats.update_statistics(self.timeline, self.datastore)
+        self.datastore.get_statistics.assert_called_once_with(
+            "123456", timelinestats.STATISTICS_FIELDS,
+            timelinestats.TOP_VALUES_SIZE)
+        statistics = Timeline.objects.get(id=self.timeline.id).statistics
+        self.assertEqual(statistics.event_count, 3)
+        self.assertEqual(
+            statistics.get_top_values(),
+            {"source_short": [("REG", 2), ("FILE", 1)]})
+        self.assertEqual(
+            statistics.get_field_names(),
+            ["datetime", "message", "source_short"])
+        timeline = Timeline.objects.get(id=self.timeline.id)
+        self.assertEqual(timeline.max_timestamp, 1410984000000)
+        self.assertEqual(
+            timeline.get_first_event_time().isoformat(),
+            "2014-09-16T20:00:00+00:00")
+
+        # Updating again replaces the statistics.
+        self.datastore.get_statistics.return_value["count"] = 4
+        timelinestats.update_statistics(self.timeline, self.datastore)
+        self.assertEqual(TimelineStatistics.objects.count(), 1)
+        self.assertEqual(
+            TimelineStatistics.objects.get().event_count, 4)
+
+    def test_update_all_skips_failures(self):
+        other = Timeline.objects.create(
+            user=self.user, title="other", datastore_index="other")
+        self.datastore.get_statistics.side_effect = [
+            IOError("unavailable"), self.datastore.get_statistics.return_value]
+        with mock.patch.object(timelinestats.logger, "exception") as log:
+            self.assertEqual(
+                timelinestats.update_all(
+                    Timeline.objects.order_by("id"), self.datastore), 1)
+        self.assertEqual(log.call_count, 1)
+        self.assertFalse(TimelineStatistics.objects.filter(
+            timeline=self.timeline).exists())
+        self.assertTrue(TimelineStatistics.objects.filter(
+            timeline=other).exists())
+
+    def test_update_command(self):
+        output = StringIO()
+        with mock.patch.object(
+                timelinestats, "DATASTORE",
+                mock.Mock(return_value=self.datastore)):
+            call_command(
+                "update_timeline_statistics", "123456", stdout=output)
+        self.assertIn("Updated 1", output.getvalue())
+        self.assertEqual(self.timeline.statistics.event_count, 3)
+
+    def test_refresh_in_background(self):
+        with mock.patch.object(
+                timelinestats, "update_all", return_value=1) as update_all:
+            result = timelinestats.refresh_in_background([self.timeline.id])
+            self.assertEqual(result.get(timeout=10), 1)
+        self.assertEqual(update_all.call_count, 1)
+
+    def test_refresh_in_background_logs_failure(self):
+        with mock.patch.object(
+                timelinestats, "update_all", side_effect=ValueError):
+            with mock.patch.object(
+                    timelinestats.logger, "exception") as log:
+                result = timelinestats.refresh_in_background(
+                    [self.timeline.id])
+                self.assertRaises(ValueError, result.get, 10)
+        self.assertEqual(log.call_count, 1)
@@ -0,0 +1,140 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Precomputed statistics for timelines.
+
+Counting the events and values in a large index takes a while, so it is done
+when a timeline is registered or by a background job when it is refreshed,
+and the timeline pages read the result from the database.
+
+Background jobs run in a thread of the web server process. They are not
+persisted, so jobs that are queued or running when the process exits are
+lost, and failures are only logged. Run the update_timeline_statistics
+command, e.g. from cron, to make sure all timelines are up to date.
+"""
+
+import json
+import logging
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+
+from timesketch.apps.sketch.models import Timeline
+from timesketch.apps.sketch.models import TimelineStatistics
+from timesketch.lib.datastores import DATASTORE
+
+# Fields to keep the most common values for.
+STATISTICS_FIELDS = ['source_short', 'parser', 'hostname']
+
+# Number of values to keep for each field.
+TOP_VALUES_SIZE = getattr(settings, 'TIMELINE_STATISTICS_TOP_VALUES', 10)
+
+logger = logging.getLogger(__name__)
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def update_statistics(timeline, datastore):
+    """Get the statistics of a timeline from the datastore and save them.
+
+    The time of the first and last event is saved on the timeline, where
+    searches use it to skip the index.
+
+    Args:
+        timeline -- Timeline, the timeline to update
+        datastore -- DataStore, the datastore the timeline is stored in
+
+    Returns:
+        The TimelineStatistics object
+    """
+    stats = datastore.get_statistics(
+        timeline.datastore_index, STATISTICS_FIELDS, TOP_VALUES_SIZE)
+    statistics, _ = TimelineStatistics.objects.update_or_create(
+        timeline=timeline, defaults={
+            'event_count': stats['count'],
+            'top_values': json.dumps(stats['top_values']),
+            'field_names': json.dumps(stats['fields'])})
+    timeline.min_timestamp = stats['min_timestamp']
+    timeline.max_timestamp = stats['max_timestamp']
+    timeline.save(update_fields=['min_timestamp', 'max_timestamp'])
+    return statistics
+
+
+def update_all(timelines, datastore=None):
+    """Update the statistics of many timelines.
+
+    A timeline that fails is logged and skipped.
+
+    Args:
+        timelines -- iterable, the Timeline objects to update
+        datastore -- DataStore, defaults to a new instance of the configured
+                     datastore
+
+    Returns:
+        Number of updated timelines
+    """
+    if datastore is None:
+        datastore = DATASTORE()
+    updated = 0
+    for timeline in timelines:
+        try:
+            update_statistics(timeline, datastore)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception(
+                'Statistics not updated for %s', timeline.datastore_index)
+            continue
+        updated += 1
+    return updated
+
+
+def _get_pool():
+    """Get the thread that runs the background jobs of this process."""
+    global _POOL, _POOL_PID
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_PID != os.getpid():
+            _POOL = ThreadPool(1)
+            _POOL_PID = os.getpid()
+        return _POOL
+
+
+def _update_job(timeline_ids):
+    try:
+        return update_all(Timeline.objects.filter(id__in=timeline_ids))
+    except Exception:
+        # Nobody waits for the result, so this is the only report.
+        logger.exception('Statistics job failed for timelines %s',
+                         timeline_ids)
+        raise
+    finally:
+        # The thread has a database connection of its own.
+        connection.close()
+
+
+def refresh_in_background(timeline_ids):
+    """Update the statistics of timelines without waiting for it.
+
+    Jobs run one at a time in a thread of the current process and are lost
+    if the process exits before they are done.
+
+    Args:
+        timeline_ids -- list, IDs of the timelines to update
+
+    Returns:
+        multiprocessing.pool.AsyncResult for the number of updated timelines
+    """
+    return _get_pool().apply_async(_update_job, (list(timeline_ids),))
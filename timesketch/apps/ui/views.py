@@ -16,26 +16,28 @@
 
 import re
 
+from django.shortcuts import get_object_or_404
 from django.shortcuts import render
 from django.shortcuts import redirect
 from django.http import HttpResponseForbidden
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
 
 from timesketch.apps.sketch.models import Sketch
 from timesketch.apps.sketch.models import SketchTimeline
-from timesketch.apps.sketch.models import Timeline
 from timesketch.apps.sketch.models import SavedView
+from timesketch.apps.sketch import sketchsearch
+from timesketch.apps.sketch import timelinestats
+from timesketch.lib.pagination import paginate
 
 
 @login_required
 def home(request):
     """Renders the available sketches for the user."""
-    my_sketches = Sketch.objects.filter(user=request.user).order_by("-created")
-    public_sketches = set()
-    for sketch in Sketch.objects.all().exclude(user=request.user):
-        if sketch.is_public():
-            public_sketches.add(sketch)
+    my_sketches = paginate(
+        request, Sketch.objects.filter(user=request.user), prefix="mine_")
+    public_sketches = paginate(
+        request, Sketch.objects.public().exclude(
+            user=request.user).select_related("user"), prefix="shared_")
     context = {"my_sketches": my_sketches, "public_sketches": public_sketches}
     return render(request, 'home.html', context)
 
@@ -48,7 +50,8 @@ def sketch(request, sketch_id):
         return HttpResponseForbidden()
     saved_views = SavedView.objects.filter(sketch=sketch).exclude(
         name="").order_by("created")
-    context = {"sketch": sketch, "views": saved_views}
+    timelines = sketch.timelines.select_related("timeline__statistics")
+    context = {"sketch": sketch, "views": saved_views, "timelines": timelines}
     return render(request, 'sketch.html', context)
 
 
@@ -70,20 +73,9 @@ def add_timeline(request, sketch_id):
     """Add timeline to sketch."""
     sketch = Sketch.objects.get(id=sketch_id)
     if request.method == 'POST':
-        form_timelines = request.POST.getlist('timelines')
-        if form_timelines:
-            for timeline_id in form_timelines:
-                timeline = Timeline.objects.get(id=timeline_id)
-                sketch_timeline = SketchTimeline.objects.create(
-                    timeline=timeline, sketch=sketch, user=request.user)
-                sketch_timeline.color = sketch_timeline.generate_color()
-                sketch_timeline.save()
+        sketch.add_timelines(request.user, request.POST.getlist('timelines'))
         return redirect("/sketch/%s/timelines/" % sketch.id)
-    timelines = set()
-    for timeline in Timeline.objects.all():
-        if not timeline in [x.timeline for x in sketch.timelines.all()]:
-            if timeline.can_read(request.user):
-                timelines.add(timeline)
+    timelines = sketch.get_addable_timelines(request.user).order_by("title")
     return render(request, 'add_timeline.html', {'sketch': sketch,
                                                  'timelines': timelines})
 
@@ -92,8 +84,9 @@ def add_timeline(request, sketch_id):
 def views(request, sketch_id):
     """List of all saved views in a specific sketch."""
     sketch = Sketch.objects.get(id=sketch_id)
-    views = SavedView.objects.filter(sketch=sketch).exclude(
-        name="").order_by("created")
+    views = paginate(
+        request, SavedView.objects.filter(sketch=sketch).exclude(
+            name="").select_related("user__userprofile"), descending=False)
     context = {"sketch": sketch, "views": views}
     return render(request, 'views.html', context)
 
@@ -101,8 +94,19 @@ def views(request, sketch_id):
 @login_required
 def timelines(request, sketch_id):
     """List of all timelines in a specific sketch."""
-    sketch = Sketch.objects.get(id=sketch_id)
-    timelines = Timeline.objects.all()
+    sketch = get_object_or_404(Sketch, id=sketch_id)
+    if not sketch.can_read(request.user):
+        return HttpResponseForbidden()
+    if request.method == 'POST':
+        if not sketch.can_write(request.user):
+            return HttpResponseForbidden()
+        # Statistics are shown as they were until the job has finished.
+        timelinestats.refresh_in_background(
+            sketch.timelines.values_list("timeline_id", flat=True))
+        return redirect("/sketch/%s/timelines/" % sketch.id)
+    timelines = paginate(
+        request, sketch.timelines.select_related("timeline__statistics"),
+        descending=False)
     context = {"sketch": sketch, "timelines": timelines}
     return render(request, 'timelines.html', context)
 
@@ -112,8 +116,7 @@ def explore(request, sketch_id):
     """Renders the search interface."""
     sketch = Sketch.objects.get(id=sketch_id)
     view = request.GET.get('view', 0)
-    timelines = [t.timeline.datastore_index for t in sketch.timelines.all()]
-    timelines = ",".join(timelines)
+    timelines = ",".join(Sketch.get_timeline_metadata(sketch.id))
     context = {"timelines": timelines, "sketch": sketch, "view": view}
     return render(request, 'explore.html', context)
 
@@ -148,14 +151,12 @@ def edit_timeline(request, sketch_id, timeline_id):
 @login_required
 def search_sketches(request):
     """Search sketches."""
-    result = set()
+    result = Sketch.objects.none()
     if request.method == 'POST':
         q = request.POST['search']
         if q:
-            for sketch in Sketch.objects.filter(Q(title__icontains=q) |
-                                                Q(description__icontains=q)):
-                if sketch.can_read(request.user):
-                    result.add(sketch)
+            result = sketchsearch.search(
+                Sketch.objects.readable_by(request.user), q)
     return render(request, 'search.html', {'result': result})
 
 @login_required
@@ -14,6 +14,131 @@
 """This is the main datastore abstraction."""
 
 import abc
+import base64
+import calendar
+import datetime
+import json
+
+from dateutil import parser as date_parser
+
+
+# Bucket widths to choose from for time histograms, as interval name (in the
+# format ElasticSearch uses) and the approximate length of a bucket in
+# milliseconds.
+HISTOGRAM_INTERVALS = [
+    ('second', 1000),
+    ('minute', 60 * 1000),
+    ('10m', 10 * 60 * 1000),
+    ('hour', 60 * 60 * 1000),
+    ('6h', 6 * 60 * 60 * 1000),
+    ('day', 24 * 60 * 60 * 1000),
+    ('week', 7 * 24 * 60 * 60 * 1000),
+    ('month', 30 * 24 * 60 * 60 * 1000),
+    ('year', 365 * 24 * 60 * 60 * 1000)
+]
+
+# Upper limit for the number of buckets in a time histogram.
+HISTOGRAM_MAX_BUCKETS = 200
+
+
+def encode_cursor(sort_values):
+    """Create an opaque cursor from the sort values of an event.
+
+    Args:
+        sort_values -- list, sort values of the event as returned in the hit
+
+    Returns:
+        Cursor as a URL safe string
+    """
+    return base64.urlsafe_b64encode(json.dumps(sort_values))
+
+
+def decode_cursor(cursor):
+    """Get the sort values back from a cursor.
+
+    Args:
+        cursor -- string, cursor created by encode_cursor()
+
+    Returns:
+        List of sort values
+
+    Raises:
+        ValueError if the cursor is malformed.
+    """
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if not isinstance(sort_values, list):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return sort_values
+
+
+def datetime_to_millis(value):
+    """Convert a date and time string to milliseconds since epoch.
+
+    Args:
+        value -- string, date and time, e.g. 2014-01-01T23:00:00. UTC is
+                 assumed if there is no timezone.
+
+    Returns:
+        Milliseconds since epoch as integer
+
+    Raises:
+        ValueError if the string can not be parsed.
+    """
+    try:
+        parsed = date_parser.parse(value)
+    except (TypeError, OverflowError):
+        raise ValueError('Invalid date: %s' % value)
+    return calendar.timegm(parsed.utctimetuple()) * 1000
+
+
+def select_interval(start, end, max_buckets=HISTOGRAM_MAX_BUCKETS):
+    """Select the smallest histogram interval that gives at most max_buckets.
+
+    Args:
+        start -- integer, start of the time range in milliseconds since epoch
+        end -- integer, end of the time range in milliseconds since epoch
+        max_buckets -- integer, maximum number of buckets
+
+    Returns:
+        Interval name as a string
+    """
+    for interval, length in HISTOGRAM_INTERVALS:
+        if (end - start) / length < max_buckets:
+            return interval
+    return HISTOGRAM_INTERVALS[-1][0]
+
+
+def fill_buckets(counts, interval):
+    """Make histogram buckets from event counts, with empty buckets added.
+
+    Buckets have a fixed length, i.e. a month is always 30 days.
+
+    Args:
+        counts -- dict, number of events with the bucket number (time in
+                  milliseconds since epoch divided by the bucket length) as
+                  key
+        interval -- string, interval name from HISTOGRAM_INTERVALS
+
+    Returns:
+        List of dictionaries with time (milliseconds since epoch), datetime
+        and count, sorted on time.
+    """
+    length = dict(HISTOGRAM_INTERVALS)[interval]
+    buckets = []
+    if counts:
+        for bucket in range(min(counts), max(counts) + 1):
+            bucket_time = bucket * length
+            buckets.append({
+                'time': bucket_time,
+                'datetime': datetime.datetime.utcfromtimestamp(
+                    bucket_time / 1000).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'count': counts.get(bucket, 0)
+            })
+    return buckets
+
 
 class DataStore(object):
     """Abstract datastore access."""
@@ -21,13 +146,31 @@ class DataStore(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod 
-    def search(self, sketch, query, filters):
+    def search(self, sketch, query, filters, indexes, size=500, cursor=None,
+               fields=None):
         """Return search results"""
 
+    @abc.abstractmethod
+    def scroll(self, sketch, query, filters, indexes, chunk_size=1000):
+        """Iterate over all events that matches a search"""
+
+    @abc.abstractmethod
+    def histogram(self, sketch, query, filters, indexes, interval=None):
+        """Count events that matches a search over time"""
+
     @abc.abstractmethod 
-    def get_single_event(self, event_id):
+    def get_single_event(self, index, event_id):
         """Get singel document from the datastore"""
 
-    @abc.abstractmethod 
-    def add_label_to_event(self, event, sketch, user, label, toggle=False):
-        """Add label to an event."""
+    @abc.abstractmethod
+    def get_events(self, events, source=True):
+        """Get many documents from the datastore"""
+
+    @abc.abstractmethod
+    def get_time_bounds(self, index):
+        """Get the time of the first and last event in an index"""
+
+    @abc.abstractmethod
+    def get_statistics(self, index, fields, size=10):
+        """Get the size, time bounds, top values and fields of an index"""
+
@@ -11,3 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+"""Datastore backends."""
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# The configured type of datastore.
+DATASTORE = import_string(getattr(
+    settings, 'DATASTORE', 'timesketch.lib.datastores.'
+    'elasticsearch_datastore.ElasticSearchDataStore'))
@@ -13,160 +13,658 @@
 # limitations under the License.
 """This implements timesketch ElasticSearch API."""
 
+import atexit
+import collections
+import heapq
+import itertools
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
 from pyelasticsearch import ElasticSearch
-from timesketch.settings import ELASTICSEARCH_SERVER_IP
-from timesketch.settings import ELASTICSEARCH_PORT
+from pyelasticsearch.exceptions import ElasticHttpError
+from requests.adapters import HTTPAdapter
 
 from timesketch.lib import datastore
+from timesketch.lib.searchcache import search_cache
+
+
+# Number of events returned per page if nothing else is asked for.
+DEFAULT_PAGE_SIZE = 500
+
+# How long ElasticSearch keeps a scroll context alive between two chunks.
+SCROLL_TIMEOUT = '1m'
+
+# Process wide registry of ElasticSearch clients, keyed on server URL. The
+# clients are bound to the process that created them, see get_client().
+_CLIENTS = {}
+_CLIENTS_PID = None
+_CLIENTS_LOCK = threading.Lock()
+
+# Threads used to search the indexes of a sketch in parallel, see
+# get_fan_out_pool().
+_FAN_OUT_POOL = None
+_FAN_OUT_POOL_PID = None
+
+
+def _create_client(url):
+    """Create a new ElasticSearch client with a bounded connection pool.
+
+    Args:
+        url -- string, URL to the ElasticSearch server
+
+    Returns:
+        Instance of pyelasticsearch.ElasticSearch
+    """
+    client = ElasticSearch(
+        url, timeout=getattr(settings, 'ELASTICSEARCH_TIMEOUT', 60),
+        max_retries=getattr(settings, 'ELASTICSEARCH_MAX_RETRIES', 0))
+    # Block when all connections are busy instead of opening new ones, this
+    # puts an upper limit on the number of sockets each process keeps open.
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=getattr(settings, 'ELASTICSEARCH_POOL_SIZE', 10),
+        pool_block=True)
+    client.session.mount('http://', adapter)
+    client.session.mount('https://', adapter)
+    return client
+
+
+def get_client(server=None, port=None):
+    """Get the shared ElasticSearch client for this process.
+
+    Clients are created on first use and then reused for every request handled
+    by the process so that keep-alive connections are reused. A process forked
+    from the one that created the clients (e.g. a worker in a prefork WSGI
+    server) gets clients of its own, the parents sockets are never shared.
+
+    Args:
+        server -- string, IP address or hostname for the ElasticSearch server
+        port -- string, port number on the ElasticSearch server
+
+    Returns:
+        Instance of pyelasticsearch.ElasticSearch
+    """
+    global _CLIENTS_PID
+    if not server:
+        server = settings.ELASTICSEARCH_SERVER_IP
+    if not port:
+        port = settings.ELASTICSEARCH_PORT
+    url = 'http://%s:%s/' % (server, port)
+    with _CLIENTS_LOCK:
+        if _CLIENTS_PID != os.getpid():
+            # Inherited from the parent process, drop them without closing so
+            # the parents connections are left untouched.
+            _CLIENTS.clear()
+            _CLIENTS_PID = os.getpid()
+        client = _CLIENTS.get(url)
+        if client is None:
+            client = _create_client(url)
+            _CLIENTS[url] = client
+    return client
+
+
+def get_fan_out_pool():
+    """Get the thread pool for searching indexes in parallel.
+
+    Like the clients, the pool is created on first use and belongs to the
+    process that created it.
+
+    Returns:
+        Instance of multiprocessing.pool.ThreadPool
+    """
+    global _FAN_OUT_POOL, _FAN_OUT_POOL_PID
+    with _CLIENTS_LOCK:
+        if _FAN_OUT_POOL is None or _FAN_OUT_POOL_PID != os.getpid():
+            _FAN_OUT_POOL = ThreadPool(
+                getattr(settings, 'ELASTICSEARCH_FAN_OUT_THREADS', 4))
+            _FAN_OUT_POOL_PID = os.getpid()
+        return _FAN_OUT_POOL
+
+
+def close_clients():
+    """Close all connections held by the clients in this process."""
+    with _CLIENTS_LOCK:
+        if _CLIENTS_PID == os.getpid():
+            for client in _CLIENTS.values():
+                client.session.close()
+        _CLIENTS.clear()
+
+
+# Close the connections cleanly when a worker process exits.
+atexit.register(close_clients)
 
 
 class ElasticSearchDataStore(datastore.DataStore):
     """Implements the API.""" 
-    def __init__(self, index_list):
+    def __init__(self, fan_out=None, server=None, port=None):
+        """Initialize the datastore.
+
+        Args:
+            fan_out -- Bool, search every index with a request of its own
+                       and merge the results, defaults to the
+                       ELASTICSEARCH_FAN_OUT setting
+            server -- string, IP address or hostname for the ElasticSearch
+                      server, defaults to ELASTICSEARCH_SERVER_IP
+            port -- string, port number on the ElasticSearch server,
+                    defaults to ELASTICSEARCH_PORT
+        """
         # Connect to the Elasticsearch server.
-        self.client = ElasticSearch('http://%s:%s/' % (ELASTICSEARCH_SERVER_IP,
-                                                       ELASTICSEARCH_PORT))
-        # TODO Refactor this to not need the index list at this stage.
-        self.index_list = index_list
+        self.client = get_client(server=server, port=port)
+        if fan_out is None:
+            fan_out = getattr(settings, 'ELASTICSEARCH_FAN_OUT', False)
+        self.fan_out = fan_out
 
-    def search(self, sketch, query, filters):
+    def search(self, sketch, query, filters, indexes, size=DEFAULT_PAGE_SIZE,
+               cursor=None, fields=None):
         """Search ElasticSearch. This will take a query string from the UI
         together with a filter definition. Based on this it will send the
         search request to elasticsearch and get result back.
 
+        Results are always sorted on the datetime of the event, with the
+        document ID as tie-breaker. To get the next page, pass the cursor
+        from the previous result back in. Because the cursor is turned into a
+        filter on the sort key the cost of a page does not depend on how deep
+        into the result it is.
+
         Args:
             sketch -- string, sketch ID
             query -- string, query string
             filters -- dict, Dictionary containing filters to apply 
+            indexes -- list, indexes to search in
+            size -- integer, maximum number of events to return
+            cursor -- string, opaque cursor from a previous result
+            fields -- list, fields of the event documents to return, all
+                      fields are returned if not set
+
+        Recent results are served from the search cache, a result is marked
+        with "cached" set to True in that case.
+
+        With fan out enabled and more than one index, every index is searched
+        with a request of its own, see _search_fan_out().
 
         Returns:
-            Set of event documents in JSON format
+            Set of event documents in JSON format. The cursor to use for
+            the next page is available as "next_cursor", or None if this is
+            the last page.
+
+        Raises:
+            ValueError if the cursor is invalid.
         """
+        cache_key = search_cache.make_key(
+            sketch, query, filters, indexes, size, cursor, fields)
+        result = search_cache.get(cache_key)
+        if result is not None:
+            result['cached'] = True
+            return result
 
-        if filters.get("time_start", None):
-            query = {
-                "query": {
-                    "query_string": {
-                        "query": query
-                    }
-                },
-                "filter": {
-                    "range": {
-                        "datetime": {
-                            "gte": filters['time_start'],
-                            "lte": filters['time_end']
+        if self.fan_out and indexes and len(indexes) > 1:
+            result = self._search_fan_out(
+                query, filters, indexes, size, cursor, fields)
+            search_cache.set(cache_key, result)
+            result['cached'] = False
+            return result
+
+        query = self._build_query(query, filters, cursor=cursor)
+        if fields:
+            query["_source"] = fields
+        result = self.client.search(query, index=indexes,
+                                    doc_type="plaso_event", size=size)
+        hits = result['hits']['hits']
+        if hits and len(hits) == size:
+            result['next_cursor'] = datastore.encode_cursor(
+                hits[-1]['sort'])
+        else:
+            result['next_cursor'] = None
+        search_cache.set(cache_key, result)
+        result['cached'] = False
+        return result
+
+    def _search_fan_out(self, query, filters, indexes, size, cursor, fields):
+        """Search every index on its own and merge the results.
+
+        The indexes are searched in parallel from a thread pool, so one slow
+        index does not hold up the requests to the others, and the sorted
+        hits are merged with a k-way merge. Each index has its own position
+        in the cursor, the sort values of the last event from that index.
+
+        Args:
+            query -- string, query string
+            filters -- dict, Dictionary containing filters to apply
+            indexes -- list, indexes to search in
+            size -- integer, maximum number of events to return
+            cursor -- string, opaque cursor from a previous result
+            fields -- list, fields of the event documents to return
+
+        Returns:
+            Search result in the same format as search(), with the time
+            ElasticSearch took and the wall clock time for each index in
+            milliseconds as "index_took".
+
+        Raises:
+            ValueError if the cursor is invalid.
+        """
+        positions = self._decode_fan_out_cursor(cursor, indexes)
+
+        def search_index(index):
+            index_query = self._build_query(query, filters)
+            if positions[index]:
+                cursor_filter = self._cursor_filter(positions[index])
+                if "filter" in index_query:
+                    cursor_filter = {
+                        "and": [index_query["filter"], cursor_filter]}
+                index_query["filter"] = cursor_filter
+            if fields:
+                index_query["_source"] = fields
+            start_time = time.time()
+            result = self.client.search(index_query, index=[index],
+                                        doc_type="plaso_event", size=size)
+            return result, int((time.time() - start_time) * 1000)
+
+        results = get_fan_out_pool().map(search_index, indexes)
+        streams = [
+            ((tuple(hit['sort']), i, hit) for hit in result['hits']['hits'])
+            for i, (result, _) in enumerate(results)]
+        hits = [hit for _, _, hit in itertools.islice(
+            heapq.merge(*streams), size)]
+
+        for hit in hits:
+            positions[hit['_index']] = hit['sort']
+        returned = collections.Counter(hit['_index'] for hit in hits)
+        # An index may have more events if it filled its page or if some of
+        # its events didn't make it into the merged page.
+        more = any(
+            len(result['hits']['hits']) > returned[index] or
+            len(result['hits']['hits']) == size
+            for index, (result, _) in zip(indexes, results))
+        next_cursor = None
+        if hits and more:
+            next_cursor = datastore.encode_cursor(
+                [[index, positions[index]] for index in indexes])
+        return {
+            'took': max(result['took'] for result, _ in results),
+            'index_took': dict(
+                (index, {'took': result['took'], 'elapsed': elapsed})
+                for index, (result, elapsed) in zip(indexes, results)),
+            'hits': {
+                'hits': hits,
+                'total': sum(result['hits']['total'] for result, _ in results)
+            },
+            'next_cursor': next_cursor
+        }
+
+    @staticmethod
+    def _decode_fan_out_cursor(cursor, indexes):
+        """Get the position in each index from a cursor.
+
+        Args:
+            cursor -- string, cursor from a fan out search, or from a normal
+                      search which is then the position in every index
+            indexes -- list, indexes to search in
+
+        Returns:
+            Dictionary with index as key and the sort values of the last
+            event from that index, or None to start from the beginning.
+
+        Raises:
+            ValueError if the cursor is invalid.
+        """
+        positions = dict((index, None) for index in indexes)
+        if not cursor:
+            return positions
+        sort_values = datastore.decode_cursor(cursor)
+        if sort_values and all(
+                isinstance(position, list) for position in sort_values):
+            try:
+                for index, position in sort_values:
+                    if index in positions:
+                        positions[index] = position
+            except (TypeError, ValueError):
+                raise ValueError('Invalid cursor: %s' % cursor)
+        else:
+            for index in indexes:
+                positions[index] = sort_values
+        return positions
+
+    def scroll(self, sketch, query, filters, indexes, chunk_size=1000):
+        """Iterate over every event that matches a search.
+
+        The events are fetched from ElasticSearch in chunks using the scroll
+        API, so only one chunk is held in memory at any time regardless of
+        the size of the result. The query and filters are the same as for
+        search().
+
+        Args:
+            sketch -- string, sketch ID
+            query -- string, query string
+            filters -- dict, Dictionary containing filters to apply
+            indexes -- list, indexes to search in
+            chunk_size -- integer, number of events to fetch per request
+
+        Returns:
+            Generator of event documents in JSON format
+        """
+        return self._scroll(
+            self._build_query(query, filters), indexes, chunk_size)
+
+    def scroll_stored_labels(self, indexes, chunk_size=1000):
+        """Iterate over the events that have labels stored in the document.
+
+        Labels used to be stored in the events in a nested timesketch_label
+        field, this is used to move them to the database.
+
+        Args:
+            indexes -- list, indexes to search in
+            chunk_size -- integer, number of events to fetch per request
+
+        Returns:
+            Generator of event documents with only timesketch_label in the
+            source
+        """
+        query = {
+            "query": {
+                "filtered": {
+                    "filter": {
+                        "nested": {
+                            "path": "timesketch_label",
+                            "filter": {"match_all": {}}
                         }
                     }
-                },
-                "sort": {
-                    "datetime": "asc"
+                }
+            },
+            "_source": ["timesketch_label"]
+        }
+        return self._scroll(query, indexes, chunk_size)
+
+    def _scroll(self, query, indexes, chunk_size):
+        """Iterate over every event that matches a query DSL."""
+        result = self.client.search(query, index=indexes,
+                                    doc_type="plaso_event", size=chunk_size,
+                                    es_scroll=SCROLL_TIMEOUT)
+        scroll_id = result.get('_scroll_id')
+        try:
+            while result['hits']['hits']:
+                for hit in result['hits']['hits']:
+                    yield hit
+                scroll_id = result.get('_scroll_id', scroll_id)
+                result = self.client.send_request(
+                    'GET', ['_search', 'scroll'], scroll_id,
+                    query_params={'scroll': SCROLL_TIMEOUT},
+                    encode_body=False)
+        finally:
+            # Free the search context on the server right away instead of
+            # waiting for the scroll to time out.
+            if scroll_id:
+                try:
+                    self.client.send_request(
+                        'DELETE', ['_search', 'scroll'], scroll_id,
+                        encode_body=False)
+                except ElasticHttpError:
+                    pass
+
+    def histogram(self, sketch, query, filters, indexes, interval=None):
+        """Count the events that matches a search over time.
+
+        Only the aggregation is fetched from ElasticSearch, no events. If no
+        interval is given it is selected from the time range in the filter,
+        or from the first and last event if there is no time range.
+
+        Args:
+            sketch -- string, sketch ID
+            query -- string, query string
+            filters -- dict, Dictionary containing filters to apply
+            indexes -- list, indexes to search in
+            interval -- string, ElasticSearch interval for the buckets
+
+        Returns:
+            Dictionary with the interval, the buckets as a list of
+            dictionaries with time (milliseconds since epoch), datetime and
+            count, and the time ElasticSearch took in milliseconds.
+
+        Raises:
+            ValueError if the time range in the filter is invalid.
+        """
+        query = self._build_query(query, filters)
+        del query["sort"]
+        # A top level filter is not applied to aggregations, so move it into
+        # the query.
+        if "filter" in query:
+            query["query"] = {
+                "filtered": {
+                    "query": query["query"],
+                    "filter": query.pop("filter")
                 }
             }
-        elif filters.get("star", None):
-            query = {
-                "query": {
-                    "match_all": {}
-                },
-                "filter": {
-                    "nested": {
-                        "path": "timesketch_label", "filter": {
-                        "bool": {
-                            "must": [
-                                {
-                                    "term": {
-                                        "timesketch_label.name": "__ts_star"
-                                    }
-                                },
-                                {
-                                    "term": {
-                                        "timesketch_label.sketch": str(sketch)
-                                    }
-                                }
-                            ]
-                        }
-                        }
-                    }
-                },
-                "sort": {
-                    "datetime": "asc"
+
+        took = 0
+        if not interval and filters.get("time_start", None):
+            interval = datastore.select_interval(
+                datastore.datetime_to_millis(filters["time_start"]),
+                datastore.datetime_to_millis(filters["time_end"]))
+        elif not interval:
+            query["aggs"] = {
+                "min_time": {"min": {"field": "datetime"}},
+                "max_time": {"max": {"field": "datetime"}}
+            }
+            result = self.client.search(query, index=indexes,
+                                        doc_type="plaso_event", size=0)
+            took += result["took"]
+            start = result["aggregations"]["min_time"]["value"]
+            end = result["aggregations"]["max_time"]["value"]
+            if start is None:
+                return {"interval": None, "buckets": [], "took": took}
+            interval = datastore.select_interval(start, end)
+
+        query["aggs"] = {
+            "histogram": {
+                "date_histogram": {
+                    "field": "datetime",
+                    "interval": interval,
+                    "min_doc_count": 0
                 }
             }
-        else:
-            query = {
-                "query": {
-                    "query_string": {
-                        "query": query
+        }
+        result = self.client.search(query, index=indexes,
+                                    doc_type="plaso_event", size=0)
+        buckets = []
+        for bucket in result["aggregations"]["histogram"]["buckets"]:
+            buckets.append({
+                "time": bucket["key"],
+                "datetime": bucket.get("key_as_string"),
+                "count": bucket["doc_count"]
+            })
+        return {
+            "interval": interval,
+            "buckets": buckets,
+            "took": took + result["took"]
+        }
+
+    def _build_query(self, query, filters, cursor=None):
+        """Build the query DSL for a search.
+
+        Args:
+            query -- string, query string
+            filters -- dict, Dictionary containing filters to apply
+            cursor -- string, opaque cursor from a previous result
+
+        Returns:
+            Query definition as a dictionary
+
+        Raises:
+            ValueError if the cursor is invalid.
+        """
+        query_filters = []
+        query_dsl = {
+            "query_string": {
+                "query": query
+            }
+        }
+        if filters.get("time_start", None):
+            query_filters.append({
+                "range": {
+                    "datetime": {
+                        "gte": filters['time_start'],
+                        "lte": filters['time_end']
                     }
-                },
-                "sort": {
-                    "datetime": "asc"
                 }
-            }
+            })
+
+        if cursor:
+            query_filters.append(
+                self._cursor_filter(datastore.decode_cursor(cursor)))
+
+        query = {
+            "query": query_dsl,
+            "sort": [
+                {"datetime": "asc"},
+                {"_uid": "asc"}
+            ]
+        }
+        if len(query_filters) == 1:
+            query["filter"] = query_filters[0]
+        elif query_filters:
+            query["filter"] = {"and": query_filters}
+        return query
 
-        return self.client.search(query, index=self.index_list,
-                                  doc_type="plaso_event", size=500)
+    @staticmethod
+    def _cursor_filter(sort_values):
+        """Filter that matches all events sorted after a cursor position.
 
+        Args:
+            sort_values -- list, the sort values (datetime, _uid) of the last
+                           event on the previous page
+
+        Returns:
+            Filter definition as a dictionary
+        """
+        last_datetime, last_uid = sort_values
+        return {
+            "or": [
+                {
+                    "range": {
+                        "datetime": {"gt": last_datetime}
+                    }
+                },
+                {
+                    "and": [
+                        {
+                            "term": {"datetime": last_datetime}
+                        },
+                        {
+                            "range": {
+                                "_uid": {"gt": last_uid}
+                            }
+                        }
+                    ]
+                }
+            ]
+        }
 
-    def get_single_event(self, event_id):
+    def get_single_event(self, index, event_id):
         """Get singel event document form elasticsearch
 
         Args:
+            index -- string, index the event is stored in
             event_id -- string, event ID
 
         Returns:
             Event document as JSON
         """
-        return self.client.get(index=self.index_list[0],
+        return self.client.get(index=index,
             doc_type="plaso_event",id=event_id)
 
-    def add_label_to_event(self, event, sketch, user, label, toggle=False):
-        """Add label to a event document in ElasticSearch.
+    def get_events(self, events, source=True):
+        """Get many event documents from elasticsearch in one request.
 
         Args:
-            event -- string, event ID
-            sketch -- string, sketch ID
-            user -- string, user ID
-            label -- string, the label to apply
-            toggle -- Bool, Toggle label or create a new one
+            events -- list, (index, event ID) tuples for the events to get
+            source -- boolean, False to only check that the events exist
 
         Returns:
-            HTTP status code
-
-        In order for this to work, we need to add a mapping for this nested
-        document. This needs to be done when the index is forst created.
-        mapping = {
-            "plaso_event": {
-                "properties": {
-                    "timesketch_label": {
-                        "type": "nested"
-                    }
-                }
+            List of event documents as JSON, in the same order as requested.
+            Events that don't exist have "found" set to False.
+        """
+        if not events:
+            return []
+        docs = [{"_index": index, "_id": event} for index, event in events]
+        if not source:
+            for doc in docs:
+                doc["_source"] = False
+        return self.client.multi_get(docs, doc_type="plaso_event")["docs"]
+
+    def get_time_bounds(self, index):
+        """Get the time of the first and last event in an index.
+
+        Args:
+            index -- string, the index
+
+        Returns:
+            Tuple of the first and last event time in milliseconds since
+            epoch, or (None, None) if the index has no events.
+        """
+        query = {
+            "query": {"match_all": {}},
+            "aggs": {
+                "min_time": {"min": {"field": "datetime"}},
+                "max_time": {"max": {"field": "datetime"}}
             }
         }
+        result = self.client.search(query, index=[index],
+                                    doc_type="plaso_event", size=0)
+        start = result["aggregations"]["min_time"]["value"]
+        end = result["aggregations"]["max_time"]["value"]
+        if start is None:
+            return None, None
+        return int(start), int(end)
+
+    def get_statistics(self, index, fields, size=10):
+        """Get statistics for an index.
+
+        Everything but the field list is fetched with aggregations in one
+        search request, the field list comes from the mapping.
+
+        Args:
+            index -- string, the index
+            fields -- list, fields to get the most common values for
+            size -- integer, number of values to get for each field
+
+        Returns:
+            Dictionary with the number of events (count), the first and last
+            event time in milliseconds since epoch (min_timestamp and
+            max_timestamp), the most common values of each field with their
+            number of events (top_values) and the sorted names of all fields
+            in the index (fields).
         """
+        aggs = {
+            "min_time": {"min": {"field": "datetime"}},
+            "max_time": {"max": {"field": "datetime"}}
+        }
+        for field in fields:
+            aggs["top_" + field] = {"terms": {"field": field, "size": size}}
+        query = {"query": {"match_all": {}}, "aggs": aggs}
+        result = self.client.search(query, index=[index],
+                                    doc_type="plaso_event", size=0)
+        aggregations = result["aggregations"]
+        min_time = aggregations["min_time"]["value"]
+        max_time = aggregations["max_time"]["value"]
+        top_values = {}
+        for field in fields:
+            top_values[field] = [
+                [bucket["key"], bucket["doc_count"]]
+                for bucket in aggregations["top_" + field]["buckets"]]
 
-        doc = self.client.get(self.index_list, "plaso_event", event)
-        try:
-            doc['_source']['timesketch_label']
-        except KeyError:
-            doc = {"timesketch_label": []}
-            self.client.update(self.index_list, "plaso_event", event, doc=doc)
-
-        if toggle:
-            script_string = "if(ctx._source.timesketch_label.contains"\
-                            "(timesketch_label)) {ctx._source.timesketch_label"\
-                            ".remove(timesketch_label)} else {ctx._source."\
-                            "timesketch_label += timesketch_label}"
-        else:
-            script_string = "if( ! ctx._source.timesketch_label.contains"\
-                            "(timesketch_label)) {ctx._source.timesketch_label"\
-                            "+= timesketch_label}"
-        script = {
-            "script": script_string,
-            "params": {
-                "timesketch_label": {
-                    "name": label, "user": user, "sketch": sketch
-                }
-            }
+        mapping = self.client.get_mapping(index=index, doc_type="plaso_event")
+        field_names = set()
+        for index_mapping in mapping.values():
+            properties = index_mapping.get("mappings", {}).get(
+                "plaso_event", {}).get("properties", {})
+            field_names.update(properties)
+        return {
+            "count": result["hits"]["total"],
+            "min_timestamp": None if min_time is None else int(min_time),
+            "max_timestamp": None if max_time is None else int(max_time),
+            "top_values": top_values,
+            "fields": sorted(field_names)
         }
-        self.client.update(self.index_list, "plaso_event", event, script)
@@ -0,0 +1,492 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This implements the timesketch datastore API on SQLite full-text search.
+
+All events are stored in one SQLite database file, with the index name as a
+column. The full-text index is an FTS5 table over all text fields of the
+events. Results are returned in the same format as ElasticSearch.
+"""
+
+import base64
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from timesketch.lib import datastore
+
+
+# Number of events returned per page if nothing else is asked for.
+DEFAULT_PAGE_SIZE = 500
+
+# Number of events to insert in each transaction when importing.
+IMPORT_BATCH_SIZE = 10000
+
+# Maximum number of event IDs in one IN clause, SQLite allows 999 variables.
+QUERY_CHUNK_SIZE = 500
+
+# Beginnings of the errors FTS5 gives for a query string it can't parse. Any
+# other error is a real failure, e.g. a locked database.
+FTS_QUERY_ERRORS = (
+    'fts5: syntax error', 'malformed MATCH', 'no such column',
+    'unterminated string', 'unknown special query')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS event (
+    id INTEGER PRIMARY KEY,
+    search_index TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS event_event_id
+    ON event (search_index, event_id);
+CREATE INDEX IF NOT EXISTS event_timestamp
+    ON event (search_index, timestamp, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS event_fts USING fts5(body, content='');
+"""
+
+# Connections can't be shared between threads, so every thread in every
+# process gets its own, keyed on database path.
+_LOCAL = threading.local()
+
+
+def get_connection(path=None):
+    """Get the SQLite connection for this thread.
+
+    The tables are created the first time a database is opened.
+
+    Args:
+        path -- string, path to the database file
+
+    Returns:
+        Instance of sqlite3.Connection
+    """
+    if not path:
+        path = settings.SQLITE_DATASTORE_PATH
+    if getattr(_LOCAL, 'pid', None) != os.getpid():
+        _LOCAL.connections = {}
+        _LOCAL.pid = os.getpid()
+    connection = _LOCAL.connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+        _LOCAL.connections[path] = connection
+    return connection
+
+
+def _fts_body(event):
+    """Get the text to add to the full-text index for an event.
+
+    Args:
+        event -- dict, the event document
+
+    Returns:
+        All text values of the event as one string
+    """
+    values = []
+    for value in event.values():
+        if isinstance(value, list):
+            values.extend(v for v in value if isinstance(v, basestring))
+        elif isinstance(value, basestring):
+            values.append(value)
+    return u' '.join(values)
+
+
+def _quote_query(query):
+    """Quote every term of a query so FTS5 takes them literally.
+
+    Args:
+        query -- string, query string
+
+    Returns:
+        FTS5 query string
+    """
+    return u' '.join(
+        u'"%s"' % term.replace(u'"', u'""') for term in query.split())
+
+
+class SQLiteDataStore(datastore.DataStore):
+    """Implements the API on top of SQLite."""
+    def __init__(self, path=None):
+        self.connection = get_connection(path)
+
+    def search(self, sketch, query, filters, indexes, size=DEFAULT_PAGE_SIZE,
+               cursor=None, fields=None):
+        """Search the full-text index.
+
+        The query string is used as an FTS5 query. If it is not valid FTS5
+        syntax every term is searched for literally instead. Results are
+        sorted on the event timestamp.
+
+        Args:
+            sketch -- string, sketch ID
+            query -- string, query string
+            filters -- dict, Dictionary containing filters to apply
+            indexes -- list, indexes to search in
+            size -- integer, maximum number of events to return
+            cursor -- string, opaque cursor from a previous result
+            fields -- list, fields of the event documents to return, all
+                      fields are returned if not set
+
+        Returns:
+            Search result in the same format as ElasticSearch, with the cursor
+            for the next page in "next_cursor".
+
+        Raises:
+            ValueError if the cursor or time range is invalid.
+        """
+        start_time = time.time()
+        where, params = self._build_where(query, filters, indexes)
+        count_where, count_params = list(where), list(params)
+        if cursor:
+            last_timestamp, last_id = datastore.decode_cursor(cursor)
+            where.append(
+                'e.timestamp > ? OR (e.timestamp = ? AND e.id > ?)')
+            params.extend([last_timestamp, last_timestamp, last_id])
+
+        rows = self._execute(
+            'SELECT e.id, e.search_index, e.event_id, e.timestamp, e.source '
+            'FROM event e WHERE %s ORDER BY e.timestamp, e.id LIMIT ?' %
+            ' AND '.join('(%s)' % w for w in where), params + [size], query)
+        total = self._execute(
+            'SELECT COUNT(*) FROM event e WHERE %s' %
+            ' AND '.join('(%s)' % w for w in count_where), count_params,
+            query)[0][0]
+
+        hits = []
+        for rowid, index, event_id, timestamp, source in rows:
+            source = json.loads(source)
+            if fields:
+                source = dict(
+                    (k, v) for k, v in source.items() if k in fields)
+            hits.append({
+                '_index': index,
+                '_id': event_id,
+                '_source': source,
+                'sort': [timestamp, rowid]
+            })
+
+        next_cursor = None
+        if hits and len(hits) == size:
+            next_cursor = datastore.encode_cursor(hits[-1]['sort'])
+        return {
+            'took': int((time.time() - start_time) * 1000),
+            'hits': {'hits': hits, 'total': total},
+            'next_cursor': next_cursor
+        }
+
+    def scroll(self, sketch, query, filters, indexes, chunk_size=1000):
+        """Iterate over every event that matches a search.
+
+        Args:
+            sketch -- string, sketch ID
+            query -- string, query string
+            filters -- dict, Dictionary containing filters to apply
+            indexes -- list, indexes to search in
+            chunk_size -- integer, number of events to fetch per query
+
+        Returns:
+            Generator of event documents
+        """
+        cursor = None
+        while True:
+            result = self.search(
+                sketch, query, filters, indexes, size=chunk_size,
+                cursor=cursor)
+            for hit in result['hits']['hits']:
+                yield hit
+            cursor = result['next_cursor']
+            if not cursor:
+                break
+
+    def histogram(self, sketch, query, filters, indexes, interval=None):
+        """Count the events that matches a search over time.
+
+        Buckets have a fixed length, i.e. a month is always 30 days.
+
+        Args:
+            sketch -- string, sketch ID
+            query -- string, query string
+            filters -- dict, Dictionary containing filters to apply
+            indexes -- list, indexes to search in
+            interval -- string, interval name from HISTOGRAM_INTERVALS
+
+        Returns:
+            Dictionary with the interval, the buckets as a list of
+            dictionaries with time (milliseconds since epoch), datetime and
+            count, and the time it took in milliseconds.
+
+        Raises:
+            ValueError if the interval or time range is invalid.
+        """
+        start_time = time.time()
+        where, params = self._build_where(query, filters, indexes)
+        where_sql = ' AND '.join('(%s)' % w for w in where)
+        if not interval:
+            if filters.get('time_start', None):
+                start = datastore.datetime_to_millis(filters['time_start'])
+                end = datastore.datetime_to_millis(filters['time_end'])
+            else:
+                start, end = self._execute(
+                    'SELECT MIN(e.timestamp) / 1000, MAX(e.timestamp) / 1000 '
+                    'FROM event e WHERE %s' % where_sql, params, query)[0]
+                if start is None:
+                    return {'interval': None, 'buckets': [], 'took': 0}
+            interval = datastore.select_interval(start, end)
+        lengths = dict(datastore.HISTOGRAM_INTERVALS)
+        if interval not in lengths:
+            raise ValueError('Invalid interval: %s' % interval)
+
+        rows = self._execute(
+            'SELECT e.timestamp / 1000 / ? AS bucket, COUNT(*) FROM event e '
+            'WHERE %s GROUP BY bucket' % where_sql,
+            [lengths[interval]] + params, query)
+        return {
+            'interval': interval,
+            'buckets': datastore.fill_buckets(dict(rows), interval),
+            'took': int((time.time() - start_time) * 1000)
+        }
+
+    def get_single_event(self, index, event_id):
+        """Get a single event document.
+
+        Args:
+            index -- string, index the event is stored in
+            event_id -- string, event ID
+
+        Returns:
+            Event document in the same format as ElasticSearch
+
+        Raises:
+            KeyError if the event does not exist.
+        """
+        event = self.get_events([(index, event_id)])[0]
+        if not event['found']:
+            raise KeyError('Event not found: %s/%s' % (index, event_id))
+        return event
+
+    def get_time_bounds(self, index):
+        """Get the time of the first and last event in an index.
+
+        Args:
+            index -- string, the index
+
+        Returns:
+            Tuple of the first and last event time in milliseconds since
+            epoch, or (None, None) if the index has no events.
+        """
+        return tuple(self.connection.execute(
+            'SELECT MIN(timestamp) / 1000, MAX(timestamp) / 1000 FROM event '
+            'WHERE search_index = ?', [index]).fetchone())
+
+    def get_statistics(self, index, fields, size=10):
+        """Get statistics for an index.
+
+        The events are read once to count values and collect field names.
+
+        Args:
+            index -- string, the index
+            fields -- list, fields to get the most common values for
+            size -- integer, number of values to get for each field
+
+        Returns:
+            Dictionary with the number of events (count), the first and last
+            event time in milliseconds since epoch (min_timestamp and
+            max_timestamp), the most common values of each field with their
+            number of events (top_values) and the sorted names of all fields
+            in the index (fields).
+        """
+        count, min_time, max_time = self.connection.execute(
+            'SELECT COUNT(*), MIN(timestamp) / 1000, MAX(timestamp) / 1000 '
+            'FROM event WHERE search_index = ?', [index]).fetchone()
+        counters = dict((field, collections.Counter()) for field in fields)
+        field_names = set()
+        rows = self.connection.execute(
+            'SELECT source FROM event WHERE search_index = ?', [index])
+        for source, in rows:
+            event = json.loads(source)
+            field_names.update(event)
+            for field in fields:
+                value = event.get(field)
+                if value is not None and not isinstance(value, (list, dict)):
+                    counters[field][value] += 1
+        return {
+            'count': count,
+            'min_timestamp': min_time,
+            'max_timestamp': max_time,
+            'top_values': dict(
+                (field, [list(item) for item in counter.most_common(size)])
+                for field, counter in counters.items()),
+            'fields': sorted(field_names)
+        }
+
+    def get_events(self, events, source=True):
+        """Get many event documents.
+
+        Args:
+            events -- list, (index, event ID) tuples for the events to get
+            source -- boolean, False to only check that the events exist
+
+        Returns:
+            List of event documents, in the same order as requested. Events
+            that don't exist have "found" set to False.
+        """
+        column = 'source' if source else 'NULL'
+        sources = {}
+        for index, event_ids in self._chunk_by_index(events):
+            rows = self.connection.execute(
+                'SELECT event_id, %s FROM event WHERE search_index = ? '
+                'AND event_id IN (%s)' % (
+                    column, ','.join('?' * len(event_ids))),
+                [index] + event_ids)
+            for event_id, event_source in rows:
+                sources[(index, event_id)] = event_source
+
+        result = []
+        for index, event_id in events:
+            doc = {'_index': index, '_id': event_id, 'found': False}
+            if (index, event_id) in sources:
+                doc['found'] = True
+                if source:
+                    doc['_source'] = json.loads(sources[(index, event_id)])
+            result.append(doc)
+        return result
+
+    def import_events(self, index, events, batch_size=IMPORT_BATCH_SIZE):
+        """Add events to an index.
+
+        The events are inserted in batches, one transaction per batch. Events
+        without an _id get a random one.
+
+        Args:
+            index -- string, index to add the events to
+            events -- iterable, event dictionaries, e.g. from plaso JSON lines
+            batch_size -- integer, number of events per transaction
+
+        Returns:
+            Number of events added
+        """
+        count = 0
+        batch = []
+        for event in events:
+            batch.append(event)
+            if len(batch) >= batch_size:
+                count += self._import_batch(index, batch)
+                batch = []
+        if batch:
+            count += self._import_batch(index, batch)
+        return count
+
+    def _import_batch(self, index, events):
+        """Insert a batch of events in one transaction.
+
+        Returns:
+            Number of events added
+        """
+        fts_rows = []
+        with self.connection:
+            for event in events:
+                # Copy the event, the caller's dictionary is left as it is.
+                event = dict(event)
+                event_id = event.pop('_id', None)
+                if not event_id:
+                    # Same format as the IDs generated by ElasticSearch.
+                    event_id = base64.urlsafe_b64encode(
+                        uuid.uuid4().bytes).rstrip('=')
+                rowid = self.connection.execute(
+                    'INSERT INTO event (search_index, event_id, timestamp, '
+                    'source) VALUES (?, ?, ?, ?)',
+                    (index, event_id, int(event.get('timestamp', 0)),
+                     json.dumps(event))).lastrowid
+                fts_rows.append((rowid, _fts_body(event)))
+            self.connection.executemany(
+                'INSERT INTO event_fts (rowid, body) VALUES (?, ?)', fts_rows)
+        return len(events)
+
+    def _build_where(self, query, filters, indexes):
+        """Build the WHERE clause for a search.
+
+        Returns:
+            Tuple of list of conditions and list of parameters
+
+        Raises:
+            ValueError if the time range is invalid.
+        """
+        # Like ElasticSearch, search all indexes if none are given.
+        where = ['1']
+        params = list(indexes or [])
+        if params:
+            where = ['e.search_index IN (%s)' % ','.join('?' * len(params))]
+        if filters.get('time_start', None):
+            where.append('e.timestamp BETWEEN ? AND ?')
+            params.append(
+                datastore.datetime_to_millis(filters['time_start']) * 1000)
+            params.append(
+                datastore.datetime_to_millis(filters['time_end']) * 1000)
+        if query and query.strip() not in ('', '*'):
+            where.append(
+                'e.id IN (SELECT rowid FROM event_fts WHERE event_fts '
+                'MATCH :query)')
+        return where, params
+
+    def _execute(self, sql, params, query):
+        """Run a search query.
+
+        If FTS5 can't parse the query string the query is run again with all
+        terms quoted. Other errors are raised.
+
+        Args:
+            sql -- string, SQL statement, with :query for the query string
+            params -- list, parameters for the statement
+            query -- string, query string
+
+        Returns:
+            List of rows
+        """
+        # Positional and named parameters can't be mixed, so fill in the
+        # query string as the last positional parameter.
+        if ':query' in sql:
+            sql = sql.replace(':query', '?')
+            position = sql[:sql.index('MATCH ?')].count('?')
+            params = list(params)
+            params.insert(position, query)
+            try:
+                return self.connection.execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                if not str(e).startswith(FTS_QUERY_ERRORS):
+                    raise
+                params[position] = _quote_query(query)
+        return self.connection.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _chunk_by_index(events):
+        """Group event IDs by index and split them into chunks.
+
+        Returns:
+            Generator of (index, list of at most QUERY_CHUNK_SIZE event IDs)
+            tuples
+        """
+        grouped = {}
+        for index, event_id in events:
+            grouped.setdefault(index, []).append(event_id)
+        for index, event_ids in grouped.items():
+            for i in range(0, len(event_ids), QUERY_CHUNK_SIZE):
+                yield index, event_ids[i:i + QUERY_CHUNK_SIZE]
@@ -0,0 +1,512 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the datastore implementations."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import mock
+
+from django.test import TestCase
+
+from timesketch.lib import datastore
+from timesketch.lib.datastores import elasticsearch_datastore
+from timesketch.lib.datastores import sqlite_datastore
+from timesketch.lib.searchcache import search_cache
+
+
+class ElasticSearchClientTest(TestCase):
+    """Test the shared ElasticSearch client registry."""
+    def tearDown(self):
+        elasticsearch_datastore.close_clients()
+
+    def test_client_is_shared(self):
+        """The same client should be returned for every datastore."""
+        datastore1 = elasticsearch_datastore.ElasticSearchDataStore()
+        datastore2 = elasticsearch_datastore.ElasticSearchDataStore()
+        self.assertIs(datastore1.client, datastore2.client)
+        self.assertIsNot(
+            datastore1.client,
+            elasticsearch_datastore.get_client(server='10.0.0.1'))
+
+    def test_client_after_fork(self):
+        """A forked process should not reuse the clients of its parent."""
+        client = elasticsearch_datastore.get_client()
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(client, elasticsearch_datastore.get_client())
+
+    def test_connection_pool_is_bounded(self):
+        """The HTTP adapter should block when the pool is exhausted."""
+        client = elasticsearch_datastore.get_client()
+        adapter = client.session.get_adapter('http://127.0.0.1:9200/')
+        self.assertTrue(adapter._pool_block)
+        self.assertEqual(adapter._pool_maxsize, 10)
+
+
+class ElasticSearchCursorTest(TestCase):
+    """Test cursor based pagination."""
+    def setUp(self):
+        search_cache.clear()
+        self.datastore = elasticsearch_datastore.ElasticSearchDataStore()
+        self.hits = [
+            {'_index': 'test', '_id': str(i), '_source': {},
+             'sort': [1410900180000 + i, 'plaso_event#%d' % i]}
+            for i in range(3)]
+
+    def _search(self, **kwargs):
+        """Run a search against a mocked client.
+
+        Returns:
+            Tuple of the search result and the query sent to the client
+        """
+        result = {'hits': {'hits': self.hits, 'total': 10}, 'took': 1}
+        with mock.patch.object(
+                self.datastore.client, 'search',
+                return_value=result) as search:
+            result = self.datastore.search(
+                '1', 'test', {}, ['test'], **kwargs)
+        return result, search.call_args[0][0]
+
+    def test_cursor_roundtrip(self):
+        """A cursor should decode to the sort values it was created from."""
+        cursor = datastore.encode_cursor(self.hits[0]['sort'])
+        self.assertEqual(
+            datastore.decode_cursor(cursor),
+            self.hits[0]['sort'])
+        self.assertRaises(
+            ValueError, datastore.decode_cursor, 'invalid')
+
+    def test_next_cursor(self):
+        """A full page should have a cursor pointing to the last event."""
+        result, query = self._search(size=3)
+        self.assertNotIn('filter', query)
+        self.assertEqual(
+            datastore.decode_cursor(result['next_cursor']),
+            self.hits[-1]['sort'])
+        result, _ = self._search(size=4)
+        self.assertIsNone(result['next_cursor'])
+
+    def test_search_with_cursor(self):
+        """The cursor should be turned into a filter on the sort key."""
+        cursor = datastore.encode_cursor(self.hits[-1]['sort'])
+        _, query = self._search(cursor=cursor)
+        range_filter = query['filter']['or'][0]['range']['datetime']
+        self.assertEqual(range_filter['gt'], self.hits[-1]['sort'][0])
+
+    def test_search_fields(self):
+        """Only the fields asked for should be fetched."""
+        _, query = self._search()
+        self.assertNotIn('_source', query)
+        _, query = self._search(fields=['message'])
+        self.assertEqual(query['_source'], ['message'])
+
+    def test_search_is_cached(self):
+        """The same search should only be sent to ElasticSearch once."""
+        result, _ = self._search(size=3)
+        self.assertFalse(result['cached'])
+        with mock.patch.object(self.datastore.client, 'search') as search:
+            result = self.datastore.search('1', ' test ', {}, ['test'], size=3)
+            self.assertFalse(search.called)
+        self.assertTrue(result['cached'])
+        self.assertEqual(len(result['hits']['hits']), 3)
+        # Another index gives another result.
+        with mock.patch.object(
+                self.datastore.client, 'search', return_value={
+                    'hits': {'hits': [], 'total': 0},
+                    'took': 1}) as search:
+            self.datastore.search('1', 'test', {}, ['test', 'other'], size=3)
+            self.assertTrue(search.called)
+
+    def test_scroll(self):
+        """Scrolling should fetch chunks until empty and clear the scroll."""
+        first = {'_scroll_id': 'abc', 'hits': {'hits': self.hits}}
+        last = {'_scroll_id': 'abc', 'hits': {'hits': []}}
+        with mock.patch.object(
+                self.datastore.client, 'search', return_value=first):
+            with mock.patch.object(
+                    self.datastore.client, 'send_request',
+                    return_value=last) as send_request:
+                events = list(self.datastore.scroll(
+                    '1', 'test', {}, ['test'], chunk_size=3))
+        self.assertEqual(events, self.hits)
+        self.assertEqual(send_request.call_count, 2)
+        self.assertEqual(send_request.call_args[0][0], 'DELETE')
+
+    def test_scroll_stored_labels(self):
+        """Only events with labels and only their labels should be read."""
+        last = {'_scroll_id': 'abc', 'hits': {'hits': []}}
+        with mock.patch.object(
+                self.datastore.client, 'search',
+                return_value=last) as search:
+            with mock.patch.object(
+                    self.datastore.client, 'send_request',
+                    return_value=last):
+                events = list(self.datastore.scroll_stored_labels(['test']))
+        self.assertEqual(events, [])
+        query = search.call_args[0][0]
+        self.assertEqual(query['_source'], ['timesketch_label'])
+        self.assertEqual(
+            query['query']['filtered']['filter']['nested']['path'],
+            'timesketch_label')
+
+
+class ElasticSearchFanOutTest(TestCase):
+    """Test searching every index on its own and merging the results."""
+    def setUp(self):
+        search_cache.clear()
+        self.datastore = elasticsearch_datastore.ElasticSearchDataStore(
+            fan_out=True)
+        self.hits = {}
+        for index, times in [('a', [1, 4, 5]), ('b', [2, 3, 6])]:
+            self.hits[index] = [
+                {'_index': index, '_id': '%s%d' % (index, t), '_source': {},
+                 'sort': [t, 'plaso_event#%s%d' % (index, t)]}
+                for t in times]
+
+    def _search(self, size, cursor=None):
+        """Run a fan out search against a mocked client.
+
+        Returns:
+            Tuple of the search result and the queries sent per index
+        """
+        queries = {}
+
+        def search(query, index, size, **unused_kwargs):
+            queries[index[0]] = query
+            hits = self.hits[index[0]]
+            if 'filter' in query:
+                cursor_filter = query['filter']['or']
+                position = [
+                    cursor_filter[0]['range']['datetime']['gt'],
+                    cursor_filter[1]['and'][1]['range']['_uid']['gt']]
+                hits = [hit for hit in hits if hit['sort'] > position]
+            return {'hits': {'hits': hits[:size], 'total': 3}, 'took': 1}
+
+        with mock.patch.object(
+                self.datastore.client, 'search', side_effect=search):
+            result = self.datastore.search(
+                '1', 'test', {}, ['a', 'b'], size=size, cursor=cursor)
+        return result, queries
+
+    def test_merge(self):
+        """Hits from all indexes should be merged in sort order."""
+        result, queries = self._search(size=4)
+        self.assertEqual(
+            [hit['_id'] for hit in result['hits']['hits']],
+            ['a1', 'b2', 'b3', 'a4'])
+        self.assertEqual(result['hits']['total'], 6)
+        self.assertEqual(sorted(result['index_took']), ['a', 'b'])
+        self.assertNotIn('filter', queries['a'])
+        self.assertEqual(
+            datastore.decode_cursor(result['next_cursor']),
+            [['a', self.hits['a'][1]['sort']],
+             ['b', self.hits['b'][1]['sort']]])
+
+    def test_cursor_per_index(self):
+        """Every index should continue from its own position."""
+        result, _ = self._search(size=4)
+        result, queries = self._search(size=4, cursor=result['next_cursor'])
+        for index, position in [('a', 4), ('b', 3)]:
+            range_filter = queries[index]['filter']['or'][0]['range']
+            self.assertEqual(range_filter['datetime']['gt'], position)
+        self.assertEqual(
+            [hit['_id'] for hit in result['hits']['hits']], ['a5', 'b6'])
+        self.assertIsNone(result['next_cursor'])
+        self.assertRaises(
+            ValueError, self._search, 4, datastore.encode_cursor([[1]]))
+
+
+class ElasticSearchGetEventsTest(TestCase):
+    """Test getting many events at once."""
+    def setUp(self):
+        self.datastore = elasticsearch_datastore.ElasticSearchDataStore()
+
+    def test_get_events(self):
+        """Events should be fetched with one multi get request."""
+        result = {'docs': [{'_index': 'a', '_id': '1', 'found': False}]}
+        with mock.patch.object(
+                self.datastore.client, 'send_request',
+                return_value=result) as send_request:
+            docs = self.datastore.get_events([('a', '1')])
+        self.assertEqual(docs, result['docs'])
+        self.assertEqual(send_request.call_args[0][1], ['_mget'])
+        self.assertEqual(
+            send_request.call_args[0][2]['docs'],
+            [{'_index': 'a', '_id': '1', '_type': 'plaso_event'}])
+        self.assertEqual(self.datastore.get_events([]), [])
+
+    def test_get_events_without_source(self):
+        """Only the existence of the events should be fetched."""
+        with mock.patch.object(
+                self.datastore.client, 'send_request',
+                return_value={'docs': []}) as send_request:
+            self.datastore.get_events([('a', '1')], source=False)
+        self.assertEqual(
+            send_request.call_args[0][2]['docs'],
+            [{'_index': 'a', '_id': '1', '_type': 'plaso_event',
+              '_source': False}])
+
+
+class ElasticSearchHistogramTest(TestCase):
+    """Test the time histogram."""
+    def setUp(self):
+        self.datastore = elasticsearch_datastore.ElasticSearchDataStore()
+        self.result = {
+            'took': 1,
+            'hits': {'hits': [], 'total': 2},
+            'aggregations': {
+                'min_time': {'value': 1410897600000.0},
+                'max_time': {'value': 1410984000000.0},
+                'histogram': {'buckets': [
+                    {'key': 1410897600000, 'doc_count': 2,
+                     'key_as_string': '2014-09-16T20:00:00.000Z'}]}
+            }
+        }
+
+    def test_select_interval(self):
+        """The interval should give at most HISTOGRAM_MAX_BUCKETS buckets."""
+        day = 24 * 60 * 60 * 1000
+        self.assertEqual(datastore.select_interval(0, 60000),
+                         'second')
+        self.assertEqual(datastore.select_interval(0, day),
+                         '10m')
+        self.assertEqual(
+            datastore.select_interval(0, 365 * day), 'week')
+        self.assertEqual(
+            datastore.datetime_to_millis('1970-01-02T00:00:00'),
+            day)
+
+    def test_histogram_with_time_range(self):
+        """The interval should be selected from the filter time range."""
+        filters = {'time_start': '2014-09-16T00:00:00',
+                   'time_end': '2014-09-17T00:00:00', 'star': False}
+        with mock.patch.object(
+                self.datastore.client, 'search',
+                return_value=self.result) as search:
+            histogram = self.datastore.histogram('1', 'test', filters, ['t'])
+        self.assertEqual(search.call_count, 1)
+        query = search.call_args[0][0]
+        self.assertIn('filtered', query['query'])
+        self.assertNotIn('sort', query)
+        self.assertEqual(search.call_args[1]['size'], 0)
+        self.assertEqual(histogram['interval'], '10m')
+        self.assertEqual(histogram['buckets'][0]['count'], 2)
+
+    def test_histogram_without_time_range(self):
+        """The interval should be selected from the first and last event."""
+        with mock.patch.object(
+                self.datastore.client, 'search',
+                return_value=self.result) as search:
+            histogram = self.datastore.histogram('1', 'test', {}, ['t'])
+        self.assertEqual(search.call_count, 2)
+        self.assertEqual(histogram['interval'], '10m')
+        self.assertEqual(histogram['took'], 2)
+
+
+    def test_get_time_bounds(self):
+        """The bounds should come from a min and max aggregation."""
+        with mock.patch.object(
+                self.datastore.client, 'search',
+                return_value=self.result) as search:
+            bounds = self.datastore.get_time_bounds('t')
+        self.assertEqual(bounds, (1410897600000, 1410984000000))
+        self.assertEqual(search.call_args[1]['index'], ['t'])
+        self.assertEqual(search.call_args[1]['size'], 0)
+        self.result['aggregations']['min_time']['value'] = None
+        self.result['aggregations']['max_time']['value'] = None
+        with mock.patch.object(
+                self.datastore.client, 'search', return_value=self.result):
+            self.assertEqual(
+                self.datastore.get_time_bounds('t'), (None, None))
+
+
+    def test_get_statistics(self):
+        """Statistics should come from one search and the mapping."""
+        self.result['aggregations']['top_source_short'] = {'buckets': [
+            {'key': 'REG', 'doc_count': 2}]}
+        mapping = {'t': {'mappings': {'plaso_event': {'properties': {
+            'message': {'type': 'string'},
+            'datetime': {'type': 'date'}}}}}}
+        with mock.patch.object(
+                self.datastore.client, 'search',
+                return_value=self.result) as search, mock.patch.object(
+                    self.datastore.client, 'get_mapping',
+                    return_value=mapping):
+            stats = self.datastore.get_statistics('t', ['source_short'], 5)
+        self.assertEqual(search.call_count, 1)
+        query = search.call_args[0][0]
+        self.assertEqual(
+            query['aggs']['top_source_short']['terms']['size'], 5)
+        self.assertEqual(stats, {
+            'count': 2,
+            'min_timestamp': 1410897600000,
+            'max_timestamp': 1410984000000,
+            'top_values': {'source_short': [['REG', 2]]},
+            'fields': ['datetime', 'message']})
+
+
+class SQLiteDataStoreTest(TestCase):
+    """Test the SQLite datastore."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.datastore = sqlite_datastore.SQLiteDataStore(
+            path=os.path.join(self.directory, 'events.db'))
+        # 2014-09-16T20:00:00 and onwards, one event every ten minutes.
+        start = 1410897600000000
+        events = [
+            {'_id': 'event%d' % i, 'timestamp': start + i * 600000000,
+             'datetime': 'unused', 'message': 'message %d' % i,
+             'timestamp_desc': 'Last Written'}
+            for i in range(5)]
+        events[2]['message'] = 'evil.exe started'
+        self.datastore.import_events('test', events, batch_size=2)
+        self.datastore.import_events('other', [{'message': 'evil'}])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_search(self):
+        """Full-text queries should match the text fields of events."""
+        result = self.datastore.search('1', 'evil', {}, ['test'])
+        self.assertEqual(result['hits']['total'], 1)
+        hit = result['hits']['hits'][0]
+        self.assertEqual(hit['_id'], 'event2')
+        self.assertEqual(hit['_source']['message'], 'evil.exe started')
+        result = self.datastore.search('1', '*', {}, ['test', 'other'])
+        self.assertEqual(result['hits']['total'], 6)
+
+    def test_search_all_indexes(self):
+        """Without indexes every index should be searched."""
+        for indexes in [None, []]:
+            result = self.datastore.search('1', 'evil', {}, indexes)
+            self.assertEqual(result['hits']['total'], 2)
+            histogram = self.datastore.histogram(
+                '1', '', {}, indexes, interval='day')
+            self.assertEqual(
+                sum(b['count'] for b in histogram['buckets']), 6)
+
+    def test_search_invalid_fts_syntax(self):
+        """Queries that are not valid FTS5 should be searched literally."""
+        result = self.datastore.search('1', 'evil.exe', {}, ['test'])
+        self.assertEqual(result['hits']['total'], 1)
+        result = self.datastore.search('1', 'evil-exe', {}, ['test'])
+        self.assertEqual(result['hits']['total'], 1)
+
+    def test_search_error_is_raised(self):
+        """Errors other than invalid FTS5 syntax should not be retried."""
+        connection = mock.Mock()
+        connection.execute.side_effect = sqlite3.OperationalError(
+            'database is locked')
+        with mock.patch.object(self.datastore, 'connection', connection):
+            self.assertRaises(
+                sqlite3.OperationalError, self.datastore.search,
+                '1', 'evil', {}, ['test'])
+        self.assertEqual(connection.execute.call_count, 1)
+
+    def test_import_keeps_events(self):
+        """Importing should not change the events passed in."""
+        event = {'_id': 'kept', 'message': 'kept'}
+        self.datastore.import_events('kept', [event])
+        self.assertEqual(event, {'_id': 'kept', 'message': 'kept'})
+
+    def test_search_time_range_and_fields(self):
+        """The time filter and field list should be applied."""
+        filters = {'time_start': '2014-09-16T20:05:00',
+                   'time_end': '2014-09-16T20:25:00'}
+        result = self.datastore.search(
+            '1', '', filters, ['test'], fields=['message'])
+        self.assertEqual(
+            [h['_id'] for h in result['hits']['hits']], ['event1', 'event2'])
+        self.assertEqual(
+            result['hits']['hits'][0]['_source'], {'message': 'message 1'})
+
+    def test_search_cursor(self):
+        """The cursor should continue after the last event of a page."""
+        result = self.datastore.search('1', '*', {}, ['test'], size=3)
+        self.assertEqual(len(result['hits']['hits']), 3)
+        result = self.datastore.search(
+            '1', '*', {}, ['test'], size=3, cursor=result['next_cursor'])
+        self.assertEqual(
+            [h['_id'] for h in result['hits']['hits']], ['event3', 'event4'])
+        self.assertIsNone(result['next_cursor'])
+        self.assertEqual(result['hits']['total'], 5)
+        self.assertEqual(
+            len(list(self.datastore.scroll(
+                '1', '*', {}, ['test'], chunk_size=2))), 5)
+
+    def test_get_events(self):
+        """Events should be returned in the requested order."""
+        events = self.datastore.get_events(
+            [('test', 'event4'), ('test', 'missing'), ('test', 'event0')])
+        self.assertEqual(
+            [e['found'] for e in events], [True, False, True])
+        self.assertEqual(events[0]['_source']['message'], 'message 4')
+        self.assertRaises(
+            KeyError, self.datastore.get_single_event, 'test', 'missing')
+
+    def test_get_events_without_source(self):
+        """Existing events should be found without their source."""
+        events = self.datastore.get_events(
+            [('test', 'event4'), ('test', 'missing')], source=False)
+        self.assertEqual([e['found'] for e in events], [True, False])
+        self.assertNotIn('_source', events[0])
+
+    def test_get_many_events(self):
+        """More events than SQLite allows variables should be found."""
+        self.datastore.import_events('many', [
+            {'_id': 'many%d' % i, 'message': 'many'} for i in range(1200)])
+        events = self.datastore.get_events(
+            [('many', 'many%d' % i) for i in range(1200)])
+        self.assertEqual(len(events), 1200)
+        self.assertTrue(all(event['found'] for event in events))
+        self.assertEqual(events[-1]['_id'], 'many1199')
+
+    def test_histogram(self):
+        """Events should be counted in buckets of the selected interval."""
+        histogram = self.datastore.histogram('1', '', {}, ['test'])
+        self.assertEqual(histogram['interval'], 'minute')
+        histogram = self.datastore.histogram(
+            '1', '', {}, ['test'], interval='hour')
+        self.assertEqual(
+            histogram['buckets'],
+            [{'time': 1410897600000, 'datetime': '2014-09-16T20:00:00.000Z',
+              'count': 5}])
+        histogram = self.datastore.histogram(
+            '1', 'evil', {}, ['test'], interval='10m')
+        self.assertEqual([b['count'] for b in histogram['buckets']], [1])
+
+    def test_get_time_bounds(self):
+        """The bounds should be the first and last event in milliseconds."""
+        self.assertEqual(
+            self.datastore.get_time_bounds('test'),
+            (1410897600000, 1410897600000 + 4 * 600000))
+        self.assertEqual(
+            self.datastore.get_time_bounds('missing'), (None, None))
+
+    def test_get_statistics(self):
+        """Values should be counted and fields collected."""
+        stats = self.datastore.get_statistics(
+            'test', ['timestamp_desc', 'missing'], size=1)
+        self.assertEqual(stats['count'], 5)
+        self.assertEqual(stats['min_timestamp'], 1410897600000)
+        self.assertEqual(
+            stats['top_values'],
+            {'timestamp_desc': [['Last Written', 5]], 'missing': []})
+        self.assertEqual(
+            stats['fields'],
+            ['datetime', 'message', 'timestamp', 'timestamp_desc'])
+        self.assertEqual(
+            self.datastore.get_statistics('missing', [])['count'], 0)
@@ -0,0 +1,167 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keyset pagination for Django querysets.
+
+Pages are ordered on (created, id) and start after or end before the row in
+an opaque cursor, so the database never has to skip rows with OFFSET and a
+link to a page keeps showing the same rows when new ones are added.
+"""
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from timesketch.lib.datastore import decode_cursor
+from timesketch.lib.datastore import encode_cursor
+
+# Number of rows on a page in the listings.
+PAGE_SIZE = getattr(settings, 'LISTING_PAGE_SIZE', 50)
+
+
+class Page(object):
+    """A page of rows with links to the pages next to it."""
+    def __init__(self, objects, next_query=None, previous_query=None):
+        """Initialize the page.
+
+        Args:
+            objects -- list, the rows on the page
+            next_query -- string, query string for the next page, or None
+            previous_query -- string, query string for the previous page, or
+                              None
+        """
+        self.objects = objects
+        self.next_query = next_query
+        self.previous_query = previous_query
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+
+def _row_cursor(row):
+    return encode_cursor([row.created.isoformat(), row.id])
+
+
+def _decode_row_cursor(cursor):
+    """Get the created time and ID back from a cursor.
+
+    Raises:
+        ValueError if the cursor is malformed.
+    """
+    values = decode_cursor(cursor)
+    try:
+        created, row_id = values
+        created = parse_datetime(created)
+        row_id = int(row_id)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if created is None:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return created, row_id
+
+
+def keyset_page(queryset, after=None, before=None, page_size=PAGE_SIZE,
+                descending=True):
+    """Get a page of rows ordered on (created, id).
+
+    Args:
+        queryset -- QuerySet, the rows to page through
+        after -- string, cursor of the row before the page
+        before -- string, cursor of the row after the page
+        page_size -- integer, maximum number of rows on the page
+        descending -- Bool, newest rows first
+
+    Returns:
+        Tuple of the rows on the page and the cursors to get the next and
+        previous page with, or None where there is no such page.
+
+    Raises:
+        ValueError if a cursor is malformed.
+    """
+    backwards = before is not None
+    cursor = before if backwards else after
+    # Walk in the listing order, or against it for the page before a row.
+    newest_first = descending != backwards
+    if newest_first:
+        queryset = queryset.order_by('-created', '-id')
+    else:
+        queryset = queryset.order_by('created', 'id')
+    if cursor is not None:
+        created, row_id = _decode_row_cursor(cursor)
+        if newest_first:
+            queryset = queryset.filter(
+                Q(created__lt=created) | Q(created=created, id__lt=row_id))
+        else:
+            queryset = queryset.filter(
+                Q(created__gt=created) | Q(created=created, id__gt=row_id))
+    rows = list(queryset[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return rows, None, None
+    if backwards:
+        next_cursor = _row_cursor(rows[-1])
+        previous_cursor = _row_cursor(rows[0]) if has_more else None
+    else:
+        next_cursor = _row_cursor(rows[-1]) if has_more else None
+        previous_cursor = _row_cursor(rows[0]) if cursor is not None else None
+    return rows, next_cursor, previous_cursor
+
+
+def paginate(request, queryset, prefix='', page_size=PAGE_SIZE,
+             descending=True):
+    """Get the page of a listing asked for in a request.
+
+    The cursors are taken from the <prefix>after and <prefix>before GET
+    parameters. Links to the next and previous page keep the other
+    parameters, so several listings on one page can be paged on their own.
+
+    Args:
+        request -- HttpRequest, the request for the listing
+        queryset -- QuerySet, the rows to page through
+        prefix -- string, prefix for the parameter names
+        page_size -- integer, maximum number of rows on the page
+        descending -- Bool, newest rows first
+
+    Returns:
+        Page object
+    """
+    after_param = prefix + 'after'
+    before_param = prefix + 'before'
+    try:
+        rows, next_cursor, previous_cursor = keyset_page(
+            queryset, after=request.GET.get(after_param),
+            before=request.GET.get(before_param), page_size=page_size,
+            descending=descending)
+    except ValueError:
+        # Start from the beginning on a malformed link.
+        rows, next_cursor, previous_cursor = keyset_page(
+            queryset, page_size=page_size, descending=descending)
+
+    def page_query(param, cursor):
+        if cursor is None:
+            return None
+        params = request.GET.copy()
+        params.pop(after_param, None)
+        params.pop(before_param, None)
+        params[param] = cursor
+        return params.urlencode()
+
+    return Page(
+        rows, page_query(after_param, next_cursor),
+        page_query(before_param, previous_cursor))
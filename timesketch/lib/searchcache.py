@@ -0,0 +1,130 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache for search results."""
+
+import collections
+import json
+import threading
+import time
+
+from django.conf import settings
+
+
+class SearchCache(object):
+    """LRU cache with expiry for search results.
+
+    The results are kept in memory in each process. A result only depends
+    on the query, the filters and the indexes, which are all part of the key,
+    so adding or removing a timeline gives new keys. Events added to an
+    index that is already searched show up when the cached results expire.
+    """
+    def __init__(self, max_size=100, ttl=60):
+        """Initialize the cache.
+
+        Args:
+            max_size -- integer, maximum number of results to keep, 0
+                        disables the cache
+            ttl -- integer, number of seconds a result is valid
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def make_key(self, sketch, query, filters, indexes, *args):
+        """Create the cache key for a search.
+
+        The query is normalized so that whitespace differences give the same
+        key, and the order of the indexes does not matter.
+
+        Args:
+            sketch -- string, sketch ID
+            query -- string, query string
+            filters -- dict, Dictionary containing filters to apply
+            indexes -- list, indexes to search in
+            *args -- anything else that changes the result, e.g. the cursor
+
+        Returns:
+            Cache key as a string
+        """
+        filters = dict((k, v) for k, v in filters.items() if k != 'indexes')
+        return json.dumps([
+            str(sketch), u' '.join((query or u'').split()),
+            filters, sorted(indexes or [])] + list(args), sort_keys=True)
+
+    def get(self, key):
+        """Get a result from the cache.
+
+        Args:
+            key -- string, cache key from make_key()
+
+        Returns:
+            A copy of the cached result or None if not in the cache
+        """
+        if not self.max_size:
+            return None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # Move it to the end, i.e. mark it as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+        return json.loads(entry[1])
+
+    def set(self, key, result):
+        """Add a result to the cache.
+
+        The result is stored serialized so callers can modify what they get
+        back from get() without changing the cached copy.
+
+        Args:
+            key -- string, cache key from make_key()
+            result -- dict, search result to cache
+        """
+        if not self.max_size:
+            return
+        entry = (time.time() + self.ttl, json.dumps(result))
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all results and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Get cache statistics.
+
+        The counters are for the current process only.
+
+        Returns:
+            Dictionary with number of hits, misses and cached results
+        """
+        return {
+            'hits': self.hits, 'misses': self.misses,
+            'size': len(self._entries)}
+
+
+search_cache = SearchCache(
+    max_size=getattr(settings, 'SEARCH_CACHE_SIZE', 100),
+    ttl=getattr(settings, 'SEARCH_CACHE_TTL', 60))
@@ -0,0 +1,122 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the timesketch library modules."""
+
+import mock
+
+from django.contrib.auth.models import User
+from django.test import RequestFactory
+from django.test import TestCase
+
+from timesketch.apps.sketch.models import Sketch
+from timesketch.lib.pagination import keyset_page
+from timesketch.lib.pagination import paginate
+from timesketch.lib.searchcache import SearchCache
+
+
+class SearchCacheTest(TestCase):
+    """Test the search result cache."""
+    def setUp(self):
+        self.cache = SearchCache(max_size=2, ttl=60)
+        self.key = self.cache.make_key('1', 'foo  bar', {}, ['b', 'a'])
+
+    def test_key_is_normalized(self):
+        """Whitespace and index order should not change the key."""
+        self.assertEqual(
+            self.key,
+            self.cache.make_key('1', ' foo bar ', {'indexes': []}, ['a', 'b']))
+        self.assertNotEqual(
+            self.key, self.cache.make_key('2', 'foo bar', {}, ['a', 'b']))
+
+    def test_get_and_set(self):
+        """A cached result should be returned as a copy."""
+        self.assertIsNone(self.cache.get(self.key))
+        self.cache.set(self.key, {'hits': []})
+        result = self.cache.get(self.key)
+        self.assertEqual(result, {'hits': []})
+        result['hits'].append(1)
+        self.assertEqual(self.cache.get(self.key), {'hits': []})
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        """The least recently used result should be evicted when full."""
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_expiry(self):
+        """Results older than the TTL should not be returned."""
+        self.cache.set(self.key, 1)
+        with mock.patch('time.time', return_value=2 ** 32):
+            self.assertIsNone(self.cache.get(self.key))
+
+
+class KeysetPaginationTest(TestCase):
+    """Test keyset pagination of querysets."""
+    def setUp(self):
+        user = User.objects.create(username='user')
+        self.sketches = [
+            Sketch.objects.create(user=user, title='sketch%d' % i)
+            for i in range(5)]
+        # Rows with the same created time are ordered on ID.
+        Sketch.objects.filter(
+            id__in=[s.id for s in self.sketches[1:3]]).update(
+                created=self.sketches[1].created)
+        self.queryset = Sketch.objects.filter(user=user)
+
+    def test_walk_forward_and_back(self):
+        """Pages should cover all rows once, in both directions."""
+        expected = list(reversed(self.sketches))
+        rows, next_cursor, previous_cursor = keyset_page(
+            self.queryset, page_size=2)
+        self.assertEqual(rows, expected[:2])
+        self.assertIsNone(previous_cursor)
+        rows, next_cursor, previous_cursor = keyset_page(
+            self.queryset, after=next_cursor, page_size=2)
+        self.assertEqual(rows, expected[2:4])
+        rows, last_cursor, _ = keyset_page(
+            self.queryset, after=next_cursor, page_size=2)
+        self.assertEqual(rows, expected[4:])
+        self.assertIsNone(last_cursor)
+        rows, next_cursor, previous_cursor = keyset_page(
+            self.queryset, before=previous_cursor, page_size=2)
+        self.assertEqual(rows, expected[:2])
+        self.assertIsNone(previous_cursor)
+
+    def test_ascending(self):
+        rows, next_cursor, _ = keyset_page(
+            self.queryset, page_size=3, descending=False)
+        self.assertEqual(rows, self.sketches[:3])
+        rows, _, _ = keyset_page(
+            self.queryset, after=next_cursor, page_size=3, descending=False)
+        self.assertEqual(rows, self.sketches[3:])
+
+    def test_paginate(self):
+        """Page links should keep other parameters."""
+        request = RequestFactory().get('/', {'other_after': 'x'})
+        page = paginate(request, self.queryset, page_size=4)
+        self.assertEqual(len(page), 4)
+        self.assertIsNone(page.previous_query)
+        self.assertIn('other_after=x', page.next_query)
+        request = RequestFactory().get('/?' + page.next_query)
+        page = paginate(request, self.queryset, page_size=4)
+        self.assertEqual(list(page), [self.sketches[0]])
+        self.assertIsNone(page.next_query)
+        request = RequestFactory().get('/', {'after': 'invalid'})
+        page = paginate(request, self.queryset, page_size=4)
+        self.assertEqual(len(page), 4)
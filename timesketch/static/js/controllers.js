@@ -37,7 +37,7 @@ timesketch.config(function($httpProvider) {
     $httpProvider.defaults.xsrfHeaderName = 'X-CSRFToken';
 });
 
-timesketch.controller('ExploreCtrl', function($scope, $http) {
+timesketch.controller('ExploreCtrl', function($scope, $http, ColumnarResult) {
         $scope.init = function(sketch, view, timelines) {
             $scope.sketch = sketch;
             $scope.star = false;
@@ -78,7 +78,6 @@ timesketch.controller('ExploreCtrl', function($scope, $http) {
                 return
             }
             $scope.filter.star = false
-            $scope.noisy = false
             if (!$scope.query) {
                 return
             }
@@ -86,15 +85,51 @@ timesketch.controller('ExploreCtrl', function($scope, $http) {
                 q: $scope.query,
                 sketch: $scope.sketch,
                 filter: $scope.filter,
-                limit: 500
+                limit: 500,
+                format: "columnar"
             }}
             $scope.events = []
             $http.get("/api/v1/search/", params).success(function(data) {
-                $scope.events = data.objects;
+                $scope.events = ColumnarResult.toObjects(data);
                 $scope.meta = data.meta;
-                if (data.meta.es_total_count > 500) {
-                    $scope.noisy = true
+                $scope.next = data.meta.next;
+            });
+            $scope.getHistogram();
+        }
+
+        $scope.getHistogram = function() {
+            var params = {params: {
+                q: $scope.query,
+                sketch: $scope.sketch,
+                filter: $scope.filter
+            }}
+            $http.get("/api/v1/histogram/", params).success(function(data) {
+                var max = 0;
+                for (var i = 0; i < data.objects.length; i++) {
+                    max = Math.max(max, data.objects[i].count);
                 }
+                $scope.histogram = data.objects;
+                $scope.histogramMax = max;
+            });
+        }
+
+        $scope.loadMore = function() {
+            if (!$scope.next) {
+                return
+            }
+            var params = {params: {
+                q: $scope.query,
+                sketch: $scope.sketch,
+                filter: $scope.filter,
+                limit: 500,
+                next: $scope.next,
+                format: "columnar"
+            }}
+            $scope.next = null
+            $http.get("/api/v1/search/", params).success(function(data) {
+                $scope.events = $scope.events.concat(
+                    ColumnarResult.toObjects(data));
+                $scope.next = data.meta.next;
             });
         }
 
@@ -103,22 +138,32 @@ timesketch.controller('ExploreCtrl', function($scope, $http) {
             $scope.filter.time_start = "";
             $scope.filter.time_end = "";
             $scope.showFilters = false;
-            $scope.noisy = false;
 
             var params = {params: {
                 q: "",
                 sketch: $scope.sketch,
                 filter: $scope.filter,
-                limit: 500
+                limit: 500,
+                format: "columnar"
             }}
             $scope.events = [];
             $scope.query = "";
             $http.get("/api/v1/search/", params).success(function(data) {
-                $scope.events = data.objects;
+                $scope.events = ColumnarResult.toObjects(data);
                 $scope.meta = data.meta;
+                $scope.next = data.meta.next;
             });
         }
 
+        $scope.exportUrl = function(format) {
+            return "/api/v1/export/?" + $.param({
+                q: $scope.query || "",
+                sketch: $scope.sketch,
+                filter: angular.toJson($scope.filter),
+                format: format
+            })
+        }
+
         $scope.clearFilter = function() {
             $scope.filter.time_start = "";
             $scope.filter.time_end = "";
@@ -45,3 +45,36 @@ services.factory('AddLabel', function($http) {
     };
     return AddLabel;
 });
+
+// Turn a columnar search response, with one list per field, back into a list
+// of events. Dictionary encoded fields hold positions in the list of distinct
+// values for the field, or lists of positions for tags and labels.
+services.factory('ColumnarResult', function() {
+    var ColumnarResult = {};
+    ColumnarResult.toObjects = function(data) {
+        var events = [];
+        var names = Object.keys(data.columns);
+        for (var i = 0; i < data.length; i++) {
+            events.push({});
+        }
+        names.forEach(function(name) {
+            var column = data.columns[name];
+            var values = data.dictionaries[name];
+            for (var i = 0; i < data.length; i++) {
+                var value = column[i];
+                if (values && value !== null) {
+                    if (angular.isArray(value)) {
+                        value = value.map(function(code) {
+                            return values[code];
+                        });
+                    } else {
+                        value = values[value];
+                    }
+                }
+                events[i][name] = value;
+            }
+        });
+        return events;
+    };
+    return ColumnarResult;
+});
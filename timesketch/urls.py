@@ -24,8 +24,11 @@ from timesketch.apps.api import v1_resources
 
 v1_api = Api(api_name='v1')
 v1_api.register(v1_resources.SearchResource())
+v1_api.register(v1_resources.HistogramResource())
 v1_api.register(v1_resources.EventResource())
+v1_api.register(v1_resources.MultiEventResource())
 v1_api.register(v1_resources.CommentResource())
+v1_api.register(v1_resources.CommentCountResource())
 v1_api.register(v1_resources.LabelResource())
 v1_api.register(v1_resources.ViewResource())
 v1_api.register(v1_resources.SketchTimelineResource())
@@ -61,6 +64,7 @@ urlpatterns = patterns(
     url(r'^user/profile/$', 'timesketch.apps.ui.views.user_profile'),
 
     # API
+    url(r'^api/v1/export/$', 'timesketch.apps.api.views.export'),
     (r'^api/', include(v1_api.urls)),
 
     # Login/Logout
@@ -22,6 +22,7 @@ import sys
 import django
 from pyelasticsearch import ElasticSearch
 from pyelasticsearch.exceptions import ConnectionError
+from pyelasticsearch.exceptions import ElasticHttpError
 from pyelasticsearch.exceptions import ElasticHttpNotFoundError
 
 
@@ -36,7 +37,9 @@ django.setup()
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import IntegrityError
+from timesketch.apps.sketch import timelinestats
 from timesketch.apps.sketch.models import Timeline
+from timesketch.lib.datastores import elasticsearch_datastore
 
 
 def main():
@@ -75,21 +78,10 @@ def main():
     elasticsearch = ElasticSearch('http://{server}:{port}'.format(
         server=args.server, port=args.port))
 
-    # Tell ElasticSearch that a timesketch label is a nested documents.
-    # This makes it possible to filter on labels.
-    mapping = {
-        'plaso_event': {
-            u'properties': {
-                u'timesketch_label': {
-                    'type': 'nested'}
-            }
-        },
-    }
-
     try:
-        # Make sure ElasticSearch is ready.
+        # Make sure ElasticSearch is ready and that the index exists.
         elasticsearch.health(wait_for_status='yellow')
-        elasticsearch.put_mapping(args.index, 'plaso_event', mapping)
+        elasticsearch.get_settings(args.index)
     except (ConnectionError, ElasticHttpNotFoundError) as e:
         sys.stderr.write('ERROR: ElasticSearch - {0:s}\n'.format(repr(e)))
         return 1
@@ -104,6 +96,16 @@ def main():
     except (IntegrityError, ValueError) as e:
         sys.stderr.write('ERROR: Timesketch - {0:s}\n'.format(repr(e)))
         return 1
+    # Count the events and values for the timeline pages. This also records
+    # the time of the first and last event so searches in a time range can
+    # skip the index.
+    es_datastore = elasticsearch_datastore.ElasticSearchDataStore(
+        server=args.server, port=args.port)
+    try:
+        timelinestats.update_statistics(timeline, es_datastore)
+    except (ConnectionError, ElasticHttpError) as e:
+        sys.stderr.write(
+            'WARNING: Statistics not recorded - {0:s}\n'.format(repr(e)))
     # Make the timeline public by default.
     timeline.make_public(user)
     return 0
@@ -0,0 +1,135 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark turning search hits into the search API response.
+
+Compares the tastypie path (a DatastoreObject and a bundle per event, then
+full_dehydrate() and the tastypie serializer) with SearchResource.
+serialize_hits() and json.dumps().
+"""
+
+# Note: The reason we need to do some funky import order here is because Django
+# needs some special setup in order to get it's environment correct.
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+import django
+
+
+# We need to add the parent directory to the Python path in order to be able
+# to import timesketch modules.
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent_dir)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'timesketch.settings')
+django.setup()
+
+# Django and timesketch imports
+from django.core.serializers.json import DjangoJSONEncoder
+from timesketch.apps.api.v1_resources import DatastoreObject
+from timesketch.apps.api.v1_resources import SearchResource
+
+
+def make_hits(count):
+    """Create search hits that look like plaso events.
+
+    Returns:
+        List of hits
+    """
+    hits = []
+    for i in range(count):
+        hits.append({
+            '_index': 'benchmark',
+            '_id': 'event%d' % i,
+            '_source': {
+                'datetime': '2014-09-16T20:43:00+00:00',
+                'timestamp': 1410900180184000 + i,
+                'timestamp_desc': 'Last Written',
+                'message': u'[C:/Windows/System32/evil%d.exe] run' % i,
+                'tag': [],
+                'timesketch_label': [
+                    {'name': '__ts_star', 'user': 1, 'sketch': '1'}
+                ] if i % 10 == 0 else []
+            }
+        })
+    return hits
+
+
+def tastypie_path(resource, hits):
+    """Serialize hits the way tastypie does for a list of resources."""
+    bundles = []
+    for hit in hits:
+        hit['_source']['req_user'] = 1
+        hit['_source']['sketch'] = '1'
+        bundle = resource.build_bundle(obj=DatastoreObject(initial=hit))
+        bundles.append(resource.full_dehydrate(bundle, for_list=True))
+    return resource._meta.serializer.serialize(
+        {'objects': bundles}, 'application/json')
+
+
+def fast_path(resource, hits):
+    """Serialize hits with the search resource fast path."""
+    return json.dumps(
+        {'objects': resource.serialize_hits(hits, 1, '1')},
+        cls=DjangoJSONEncoder, ensure_ascii=False)
+
+
+def timeit(function, resource, hits, repeat):
+    """Run a function on fresh copies of the hits and time it.
+
+    Returns:
+        Best time in milliseconds
+    """
+    best = None
+    for _ in range(repeat):
+        hits_copy = copy.deepcopy(hits)
+        start_time = time.time()
+        function(resource, hits_copy)
+        elapsed = (time.time() - start_time) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='Number of runs for each size, the best run is reported')
+    parser.add_argument(
+        'sizes', nargs='*', type=int, default=[500, 5000, 50000],
+        help='Number of hits to serialize')
+    args = parser.parse_args()
+
+    resource = SearchResource()
+    sys.stdout.write('{0:>8s} {1:>12s} {2:>12s} {3:>8s}\n'.format(
+        'hits', 'tastypie ms', 'fast ms', 'speedup'))
+    for size in args.sizes:
+        hits = make_hits(size)
+        if json.loads(tastypie_path(resource, copy.deepcopy(hits))) != \
+                json.loads(fast_path(resource, copy.deepcopy(hits))):
+            sys.stderr.write('ERROR: The outputs are not the same\n')
+            return 1
+        legacy = timeit(tastypie_path, resource, hits, args.repeat)
+        current = timeit(fast_path, resource, hits, args.repeat)
+        sys.stdout.write('{0:8d} {1:12.1f} {2:12.1f} {3:7.1f}x\n'.format(
+            size, legacy, current, legacy / current))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Index plaso output in ElasticSearch and add it to Timesketch.
+
+Reads plaso JSON lines or CSV files, indexes the events with bulk requests
+from a pool of worker processes and then creates the timeline, the same way
+as add_timeline.py. Refresh and replicas are turned off for the index while
+loading.
+"""
+
+# Note: The reason we need to do some funky import order here is because Django
+# needs some special setup in order to get it's environment correct.
+import argparse
+import collections
+import csv
+import datetime
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import django
+from pyelasticsearch.exceptions import ConnectionError
+from pyelasticsearch.exceptions import ElasticHttpError
+from pyelasticsearch.exceptions import IndexAlreadyExistsError
+
+
+# We need to add the parent directory to the Python path in order to be able
+# to import timesketch modules.
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent_dir)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'timesketch.settings')
+django.setup()
+
+# Django and timesketch imports
+from django.contrib.auth.models import User
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError
+from timesketch.apps.sketch import timelinestats
+from timesketch.apps.sketch.models import Timeline
+from timesketch.lib import datastore
+from timesketch.lib.datastores import elasticsearch_datastore
+
+
+# Number of events in each bulk request.
+CHUNK_SIZE = 1000
+
+# How many times a rejected bulk request is retried, and the number of seconds
+# to wait before the first retry. The wait is doubled for every retry.
+MAX_RETRIES = 10
+RETRY_DELAY = 0.5
+
+# Set in each worker process by init_worker().
+_INDEX = None
+_SERVER = None
+_PORT = None
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    """Read a plaso output file in chunks.
+
+    JSON lines are passed on unparsed so that decoding is done by the workers.
+    CSV files need the header, so every chunk is a list of rows.
+
+    Args:
+        path -- string, path to a .jsonl/.json or .csv file
+        chunk_size -- integer, number of events per chunk
+
+    Returns:
+        Generator of (format, header, rows) tuples
+    """
+    with open(path, 'rb') as input_file:
+        if path.lower().endswith('.csv'):
+            reader = csv.reader(input_file)
+            header = next(reader)
+            fmt, rows = 'csv', reader
+        else:
+            header = None
+            fmt, rows = 'json', (line for line in input_file if line.strip())
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield fmt, header, chunk
+                chunk = []
+        if chunk:
+            yield fmt, header, chunk
+
+
+def parse_event(fmt, header, row):
+    """Make an event document from a line of plaso output.
+
+    Makes sure both timestamp (microseconds since epoch) and datetime are set
+    since the UI sorts and filters on them.
+
+    Args:
+        fmt -- string, json or csv
+        header -- list, CSV column names
+        row -- JSON string or list of CSV values
+
+    Returns:
+        Event dictionary
+
+    Raises:
+        ValueError if the row is not a valid event.
+    """
+    if fmt == 'csv':
+        event = dict(zip(header, [v.decode('utf-8') for v in row]))
+    else:
+        event = json.loads(row)
+        if not isinstance(event, dict):
+            raise ValueError('Not an event: %s' % row)
+    if event.get('timestamp', None) not in (None, ''):
+        event['timestamp'] = int(event['timestamp'])
+        if not event.get('datetime', None):
+            event['datetime'] = datetime.datetime.utcfromtimestamp(
+                event['timestamp'] / 1000000.0).isoformat() + '+00:00'
+    elif event.get('datetime', None):
+        event['timestamp'] = datastore.datetime_to_millis(
+            event['datetime']) * 1000
+    return event
+
+
+def init_worker(index, server, port):
+    """Set up a worker process."""
+    global _INDEX, _SERVER, _PORT  # pylint: disable=global-statement
+    _INDEX, _SERVER, _PORT = index, server, port
+
+
+def index_chunk(chunk):
+    """Index a chunk of events with bulk requests.
+
+    Events that ElasticSearch rejects because its queues are full (HTTP 429)
+    are sent again after a delay. Other errors, and rows that can't be
+    parsed, are counted as failed.
+
+    Args:
+        chunk -- tuple of format, header and rows from read_chunks()
+
+    Returns:
+        Tuple of number of indexed and failed events
+    """
+    fmt, header, rows = chunk
+    client = elasticsearch_datastore.get_client(server=_SERVER, port=_PORT)
+    action = json.dumps({'index': {}})
+    events = []
+    failed = 0
+    for row in rows:
+        try:
+            events.append(json.dumps(parse_event(fmt, header, row)))
+        except (TypeError, ValueError):
+            failed += 1
+    if not events:
+        return 0, failed
+    delay = RETRY_DELAY
+    for retry in range(MAX_RETRIES + 1):
+        body = ''.join('%s\n%s\n' % (action, event) for event in events)
+        try:
+            result = client.send_request(
+                'POST', [_INDEX, 'plaso_event', '_bulk'], body,
+                encode_body=False)
+        except ElasticHttpError as e:
+            if e.status_code != 429 or retry == MAX_RETRIES:
+                raise
+            time.sleep(delay)
+            delay *= 2
+            continue
+        rejected = []
+        for event, item in zip(events, result['items']):
+            status = item.values()[0].get('status', 200)
+            if status == 429:
+                rejected.append(event)
+            elif status >= 300:
+                failed += 1
+        events = rejected
+        if not events:
+            break
+        if retry < MAX_RETRIES:
+            time.sleep(delay)
+            delay *= 2
+    failed += len(events)
+    return len(rows) - failed, failed
+
+
+def get_index_settings(client, index):
+    """Get the refresh interval and number of replicas of an index.
+
+    Returns:
+        Dictionary with the settings to restore after loading
+    """
+    index_settings = client.get_settings(index)[index]['settings']
+    if 'index' in index_settings:
+        index_settings = dict(
+            ('index.%s' % k, v) for k, v in index_settings['index'].items())
+    return {
+        'index': {
+            'refresh_interval': index_settings.get(
+                'index.refresh_interval', '1s'),
+            'number_of_replicas': index_settings.get(
+                'index.number_of_replicas', 1)
+        }
+    }
+
+
+def main():
+    """
+    Index plaso output in ElasticSearch and create a timeline for it in
+    Timesketch.
+
+    Returns:
+        0 on success and 1 on error.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-u', '--user', required=True,
+        help='Timesketch username to set as owner of the timeline')
+    parser.add_argument(
+        '-s', '--server', default='127.0.0.1',
+        help='IP address or hostname for ElasticSearch server')
+    parser.add_argument(
+        '-p', '--port', default='9200',
+        help='Port number on ElasticSearch server')
+    parser.add_argument(
+        '-n', '--name', required=True,
+        help='The name of the timeline in Timesketch')
+    parser.add_argument(
+        '-i', '--index', required=True,
+        help='The name of the index in ElasticSearch')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='Number of worker processes')
+    parser.add_argument(
+        '-c', '--chunk_size', type=int, default=CHUNK_SIZE,
+        help='Number of events in each bulk request')
+    parser.add_argument(
+        'files', nargs='+', metavar='FILE',
+        help='Plaso JSON lines (.jsonl) or CSV (.csv) file')
+    args = parser.parse_args()
+
+    try:
+        user = User.objects.get(username=args.user)
+    except ObjectDoesNotExist:
+        sys.stderr.write('ERROR: User does not exist\n')
+        return 1
+    if Timeline.objects.filter(datastore_index=args.index).exists():
+        sys.stderr.write('ERROR: Timeline already exists\n')
+        return 1
+
+    client = elasticsearch_datastore.get_client(
+        server=args.server, port=args.port)
+    try:
+        # Make sure ElasticSearch is ready.
+        client.health(wait_for_status='yellow')
+        try:
+            client.create_index(args.index)
+        except IndexAlreadyExistsError:
+            pass
+        original_settings = get_index_settings(client, args.index)
+        client.update_settings(args.index, {
+            'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+    except (ConnectionError, ElasticHttpError) as e:
+        sys.stderr.write('ERROR: ElasticSearch - {0:s}\n'.format(repr(e)))
+        return 1
+
+    indexed = failed = 0
+    start_time = time.time()
+    # The pool reads its whole input up front, so submit chunks one at a time
+    # and wait for the oldest when too many are in flight. This keeps memory
+    # use bounded no matter how big the input is.
+    max_in_flight = args.workers * 2
+    in_flight = collections.deque()
+    pool = multiprocessing.Pool(
+        args.workers, init_worker, (args.index, args.server, args.port))
+    try:
+        try:
+            for path in args.files:
+                for chunk in read_chunks(path, args.chunk_size):
+                    if len(in_flight) >= max_in_flight:
+                        chunk_indexed, chunk_failed = (
+                            in_flight.popleft().get())
+                        indexed += chunk_indexed
+                        failed += chunk_failed
+                    in_flight.append(pool.apply_async(index_chunk, (chunk,)))
+            while in_flight:
+                chunk_indexed, chunk_failed = in_flight.popleft().get()
+                indexed += chunk_indexed
+                failed += chunk_failed
+            pool.close()
+        except BaseException:
+            # Stop the workers on any error, also on Ctrl-C.
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    except (ConnectionError, ElasticHttpError) as e:
+        sys.stderr.write('ERROR: ElasticSearch - {0:s}\n'.format(repr(e)))
+        return 1
+    finally:
+        # Always turn refresh and replicas back on, or the index is left
+        # in bulk load mode.
+        client.update_settings(args.index, original_settings)
+        client.refresh(args.index)
+
+    seconds = time.time() - start_time
+    sys.stdout.write(
+        'Indexed {0:d} events in {1:.1f} seconds ({2:.0f} events/s), '
+        '{3:d} failed\n'.format(
+            indexed, seconds, indexed / max(seconds, 0.001), failed))
+
+    try:
+        timeline = Timeline.objects.create(
+            user=user, title=args.name, description=args.name,
+            datastore_index=args.index)
+    except (IntegrityError, ValueError) as e:
+        sys.stderr.write('ERROR: Timesketch - {0:s}\n'.format(repr(e)))
+        return 1
+    # Count the events and values for the timeline pages. This also records
+    # the time of the first and last event so searches in a time range can
+    # skip the index.
+    es_datastore = elasticsearch_datastore.ElasticSearchDataStore(
+        server=args.server, port=args.port)
+    try:
+        timelinestats.update_statistics(timeline, es_datastore)
+    except (ConnectionError, ElasticHttpError) as e:
+        sys.stderr.write(
+            'WARNING: Statistics not recorded - {0:s}\n'.format(repr(e)))
+    # Make the timeline public by default.
+    timeline.make_public(user)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Import plaso JSON lines output to the SQLite datastore in Timesketch"""
+
+# Note: The reason we need to do some funky import order here is because Django
+# needs some special setup in order to get it's environment correct.
+import argparse
+import json
+import os
+import sys
+
+import django
+
+
+# We need to add the parent directory to the Python path in order to be able
+# to import timesketch modules.
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent_dir)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'timesketch.settings')
+django.setup()
+
+# Django and timesketch imports
+from django.contrib.auth.models import User
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError
+from timesketch.apps.sketch import timelinestats
+from timesketch.apps.sketch.models import Timeline
+from timesketch.lib.datastores import sqlite_datastore
+
+
+def read_events(json_file):
+    """Read events from a file with one JSON document per line.
+
+    Args:
+        json_file -- file object
+
+    Returns:
+        Generator of event dictionaries
+    """
+    for line in json_file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def main():
+    """
+    Import events to the SQLite datastore and create a timeline for them in
+    Timesketch.
+
+    Returns:
+        0 on success and 1 on error.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-u', '--user', required=True,
+        help='Timesketch username to set as owner of the timeline')
+    parser.add_argument(
+        '-n', '--name', required=True,
+        help='The name of the timeline in Timesketch')
+    parser.add_argument(
+        '-i', '--index', required=True,
+        help='The name of the index to add the events to')
+    parser.add_argument(
+        '-f', '--file', required=True,
+        help='Plaso JSON lines file to import, - for standard input')
+    parser.add_argument(
+        '-d', '--database', default=None,
+        help='SQLite database file, defaults to SQLITE_DATASTORE_PATH')
+    args = parser.parse_args()
+
+    try:
+        user = User.objects.get(username=args.user)
+    except ObjectDoesNotExist:
+        sys.stderr.write('ERROR: User does not exist\n')
+        return 1
+
+    if Timeline.objects.filter(datastore_index=args.index).exists():
+        sys.stderr.write('ERROR: Timeline already exists\n')
+        return 1
+
+    datastore = sqlite_datastore.SQLiteDataStore(path=args.database)
+    if args.file == '-':
+        count = datastore.import_events(args.index, read_events(sys.stdin))
+    else:
+        with open(args.file) as json_file:
+            count = datastore.import_events(
+                args.index, read_events(json_file))
+    sys.stdout.write('Imported {0:d} events\n'.format(count))
+
+    try:
+        timeline = Timeline.objects.create(
+            user=user, title=args.name, description=args.name,
+            datastore_index=args.index)
+    except (IntegrityError, ValueError) as e:
+        sys.stderr.write('ERROR: Timesketch - {0:s}\n'.format(repr(e)))
+        return 1
+    # Count the events and values for the timeline pages. This also records
+    # the time of the first and last event so searches in a time range can
+    # skip the index.
+    timelinestats.update_statistics(timeline, datastore)
+    # Make the timeline public by default.
+    timeline.make_public(user)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())